@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import argparse
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+# Default number of connections kept open to each host
+DEFAULT_POOL_SIZE = 10
+
+# One long-lived session per host (and Retry-After behaviour), shared by
+# every API call in the process
+SESSIONS = {}
+SESSION_SETTINGS = {'pool_size': DEFAULT_POOL_SIZE, 'keep_alive': True}
+SESSIONS_LOCK = threading.Lock()
+
+
+def add_session_arguments(parser):
+    '''
+    Add the command line arguments that configure the shared sessions to a
+    script's argument parser
+        inputs:
+            parser (argparse.ArgumentParser): the script's argument parser
+        outputs:
+            None
+    '''
+    parser.add_argument(
+        '--pool_size', type=int, default=DEFAULT_POOL_SIZE,
+        help="Maximum number of connections to keep open to each API host"
+    )
+    parser.add_argument(
+        '--no_keep_alive', action='store_true',
+        help="Close the connection after every API request"
+    )
+
+
+def positive_int(value):
+    '''
+    Argument type for options that must be a whole number above zero
+        inputs:
+            value (str): value given on the command line
+        outputs:
+            number (int): the value as an int
+    '''
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            f"{value} is not a positive whole number"
+        )
+    return number
+
+
+def configure_sessions(pool_size=DEFAULT_POOL_SIZE, keep_alive=True):
+    '''
+    Set the pool size and keep-alive behaviour of sessions made after this
+    is called
+        inputs:
+            pool_size (int): maximum number of connections to keep open to
+            each host
+            keep_alive (bool): whether connections are reused between
+            requests
+        outputs:
+            None
+    '''
+    with SESSIONS_LOCK:
+        SESSION_SETTINGS['pool_size'] = pool_size
+        SESSION_SETTINGS['keep_alive'] = keep_alive
+
+
+def get_session(url, respect_retry_after=True):
+    '''
+    Get the shared requests session for the host of a url, making it on first
+    use. The session has a connection pool and retries so can attempt again if
+    the API is temporarily offline
+        inputs:
+            url (str): any url on the API host
+            respect_retry_after (bool): if True, rate limited (429 or 503)
+            responses with a Retry-After header are retried after the wait
+            the API asks for, however long. If False they are returned
+            straight away, for callers that schedule their own retries
+        outputs:
+            session: requests session for the host
+    '''
+    host = urlsplit(url).netloc
+    with SESSIONS_LOCK:
+        session = SESSIONS.get((host, respect_retry_after))
+        if session is None:
+            session = requests.Session()
+            retries = Retry(
+                total=10, backoff_factor=0.5,
+                respect_retry_after_header=respect_retry_after
+            )
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=SESSION_SETTINGS['pool_size'],
+                max_retries=retries
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            if not SESSION_SETTINGS['keep_alive']:
+                session.headers['Connection'] = 'close'
+            SESSIONS[(host, respect_retry_after)] = session
+    return session
+
+
+def parse_retry_after(retry_after):
+    '''
+    Convert the value of a Retry-After header to a number of seconds
+        inputs:
+            retry_after (str): Retry-After header, either a number of seconds
+            or an HTTP date
+        outputs:
+            seconds (float): seconds to wait, or None if the header is missing
+            or invalid
+    '''
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    try:
+        retry_date = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_date - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+def connection_stats():
+    '''
+    Count the requests made and connections opened by each shared session
+        outputs:
+            stats (dict): for each host, the number of requests, new
+            connections and requests that reused an open connection
+    '''
+    stats = {}
+    with SESSIONS_LOCK:
+        for (host, _), session in SESSIONS.items():
+            # A host may have a session for each Retry-After behaviour
+            host_stats = stats.get(host, {'requests': 0, 'connections': 0})
+            requests_made = host_stats['requests']
+            connections = host_stats['connections']
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        requests_made += pool.num_requests
+                        connections += pool.num_connections
+            stats[host] = {
+                'requests': requests_made,
+                'connections': connections,
+                'reused': requests_made - connections
+            }
+    return stats
+
+
+def print_connection_stats():
+    '''
+    Print how often each shared session reused an open connection
+    '''
+    for host, stats in connection_stats().items():
+        print(
+            f"{host}: {stats['requests']} requests, {stats['connections']} "
+            f"connections opened, {stats['reused']} reused"
+        )
+
+
+def close_sessions():
+    '''
+    Close every shared session and its open connections
+    '''
+    with SESSIONS_LOCK:
+        for session in SESSIONS.values():
+            session.close()
+        SESSIONS.clear()
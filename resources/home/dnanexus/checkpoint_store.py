@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+import sqlite3
+from datetime import datetime
+
+# States a variant moves through as it is submitted to ClinVar
+BUILT = "built"
+SUBMITTED = "submitted"
+ACCESSIONED = "accessioned"
+
+
+def open_store(path):
+    '''
+    Open the SQLite checkpoint store recording how far each variant has got
+    through ClinVar submission, creating it if it does not exist. Every
+    update is committed straight away so an interrupted run can resume from
+    the store
+        inputs:
+            path (str): path to the SQLite database file
+        outputs:
+            store: connection to the checkpoint store
+    '''
+    store = sqlite3.connect(path, isolation_level=None)
+    store.execute("PRAGMA journal_mode=WAL")
+    store.execute(
+        "CREATE TABLE IF NOT EXISTS records ("
+        "local_id TEXT PRIMARY KEY, "
+        "state TEXT NOT NULL, "
+        "submission_id TEXT, "
+        "accession_id TEXT, "
+        "updated TEXT NOT NULL)"
+    )
+    return store
+
+
+def mark_built(store, local_id):
+    '''
+    Record that the data for a variant has been built, unless the variant is
+    already in the store
+        inputs:
+            store: connection to the checkpoint store
+            local_id (str): local ID of the variant
+        outputs:
+            None
+    '''
+    store.execute(
+        "INSERT OR IGNORE INTO records (local_id, state, updated) "
+        "VALUES (?, ?, ?)",
+        (local_id, BUILT, datetime.now().isoformat())
+    )
+
+
+def mark_submitted(store, local_id, submission_id):
+    '''
+    Record the ClinVar submission ID of a variant
+        inputs:
+            store: connection to the checkpoint store
+            local_id (str): local ID of the variant
+            submission_id (str): ClinVar submission ID
+        outputs:
+            None
+    '''
+    store.execute(
+        "INSERT INTO records (local_id, state, submission_id, updated) "
+        "VALUES (?, ?, ?, ?) ON CONFLICT(local_id) DO UPDATE SET "
+        "state = excluded.state, submission_id = excluded.submission_id, "
+        "updated = excluded.updated",
+        (local_id, SUBMITTED, submission_id, datetime.now().isoformat())
+    )
+
+
+def mark_accessioned(store, local_id, accession_id):
+    '''
+    Record the ClinVar accession ID of a variant
+        inputs:
+            store: connection to the checkpoint store
+            local_id (str): local ID of the variant
+            accession_id (str): ClinVar accession ID
+        outputs:
+            None
+    '''
+    store.execute(
+        "UPDATE records SET state = ?, accession_id = ?, updated = ? "
+        "WHERE local_id = ?",
+        (ACCESSIONED, accession_id, datetime.now().isoformat(), local_id)
+    )
+
+
+def get_submission_ids(store):
+    '''
+    Get the submission ID of every variant that has been submitted
+        inputs:
+            store: connection to the checkpoint store
+        outputs:
+            submission_ids (dict): submission ID for each local ID, in the
+            order the variants were added to the store
+    '''
+    rows = store.execute(
+        "SELECT local_id, submission_id FROM records "
+        "WHERE state IN (?, ?) ORDER BY rowid",
+        (SUBMITTED, ACCESSIONED)
+    )
+    return dict(rows.fetchall())
+
+
+def get_accession_ids(store):
+    '''
+    Get the accession ID of every variant that has been accessioned
+        inputs:
+            store: connection to the checkpoint store
+        outputs:
+            accession_ids (dict): accession ID for each local ID
+    '''
+    rows = store.execute(
+        "SELECT local_id, accession_id FROM records WHERE state = ? "
+        "ORDER BY rowid",
+        (ACCESSIONED,)
+    )
+    return dict(rows.fetchall())
+
+
+def get_local_ids(store):
+    '''
+    Get the local ID of every variant in the store
+        inputs:
+            store: connection to the checkpoint store
+        outputs:
+            local_ids (list): local IDs in the order they were added
+    '''
+    rows = store.execute("SELECT local_id FROM records ORDER BY rowid")
+    return [local_id for (local_id,) in rows.fetchall()]
@@ -2,9 +2,65 @@ import os
 import json
 import argparse
 import time
-import requests
+import random
 import pandas as pd
-from push_to_clinvar import make_headers, select_api_url
+from push_to_clinvar import make_headers, select_api_url, SUBMISSION_ERROR
+from api_client import (
+    add_session_arguments, configure_sessions, get_session,
+    parse_retry_after, print_connection_stats
+)
+from checkpoint_store import (
+    open_store, mark_submitted, mark_accessioned, get_accession_ids
+)
+
+# Default schedule for polling ClinVar for accession IDs: start with short
+# intervals and back off exponentially with jitter, until the deadline (in
+# seconds) has passed
+DEFAULT_POLL_POLICY = {
+    'initial_interval': 30,
+    'max_interval': 600,
+    'processing_interval': 60,
+    'factor': 2,
+    'jitter': 0.2,
+    'deadline': 3600
+}
+
+# Action statuses after which no accession ID will appear for a submission
+TERMINAL_STATUSES = ["processed", "error"]
+
+# Parsed summary files, with the validators needed to re-fetch them
+# conditionally, keyed by summary file url
+SUMMARY_FILE_CACHE = {}
+
+
+def next_poll_interval(attempt, policy, statuses=(), retry_after=None):
+    '''
+    Work out how long to wait before the next round of polling. The interval
+    grows exponentially with each attempt up to a maximum, with random jitter
+    so many jobs don't poll in step. If every pending submission is already
+    being processed the interval is capped, as an accession is expected soon,
+    and the API's Retry-After is always honoured
+    Inputs:
+        attempt (int): number of rounds of polling done so far
+        policy (dict): polling policy, see DEFAULT_POLL_POLICY
+        statuses: action statuses of the pending submissions
+        retry_after (float): seconds the API asked us to wait, optional
+    Outputs:
+        interval (float): seconds to wait
+    '''
+    interval = min(
+        policy['max_interval'],
+        policy['initial_interval'] * policy['factor'] ** attempt
+    )
+    if statuses and all(status == "processing" for status in statuses):
+        interval = min(interval, policy['processing_interval'])
+
+    jitter = policy['jitter']
+    interval *= random.uniform(1 - jitter, 1 + jitter)
+
+    if retry_after is not None:
+        interval = max(interval, retry_after)
+    return interval
 
 
 def submission_status_check(submission_id, headers, api_url):
@@ -18,13 +74,43 @@ def submission_status_check(submission_id, headers, api_url):
     Outputs:
         status_response: the API response
     '''
+    status_response, _, _ = fetch_submission_status(
+        submission_id, headers, api_url
+    )
+    return status_response
+
+
+def fetch_submission_status(submission_id, headers, api_url):
+    '''
+    Queries ClinVar API about a submission ID to obtain its processing status
+    and more details about its submission record.
+    Inputs:
+        submission_id:  the generated submission id from ClinVar when a
+        submission has been posted to their API
+        headers: the required API url
+    Outputs:
+        status_response: the API response, or the summary file if one is
+        listed. None if the API asked us to retry later
+        status (str): processing status of the submission action, e.g.
+        submitted, processing, processed or error
+        retry_after (float): seconds the API asked us to wait before the next
+        request, or None
+    '''
 
     url = os.path.join(api_url, submission_id, "actions")
-    response = requests.get(url, headers=headers)
+    # Rate limited responses are returned rather than waited on by the
+    # session, so the poll schedule decides how long to wait
+    response = get_session(url, respect_retry_after=False).get(
+        url, headers=headers
+    )
     response_content = response.content.decode("UTF-8")
     for k, v in response.headers.items():
         print(f"{k}: {v}")
     print(response_content)
+    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+    if response.status_code in [429, 503]:
+        print(f"Status check for {submission_id} rate limited, retry later")
+        return None, None, retry_after
     if response.status_code not in [200]:
         raise RuntimeError(
             "Status check failed:\n" + str(headers) + "\n" + url
@@ -57,42 +143,105 @@ def submission_status_check(submission_id, headers, api_url):
             )
 
         if f_url is not None:
-            print("GET " + f_url)
-            f_response = requests.get(f_url, headers=headers)
-            f_response_content = f_response.content.decode("UTF-8")
-            if f_response.status_code not in [200]:
-                raise RuntimeError(
-                    "Status check summary file fetch failed:"
-                    f"{f_response_content}"
-                )
-            file_content = json.loads(f_response_content)
-            status_response = file_content
+            status_response = fetch_summary_file(f_url, headers, status)
 
-    return status_response
+    return status_response, status, retry_after
+
+
+def fetch_summary_file(f_url, headers, status, cache=None):
+    '''
+    Fetch and parse the summary file for a submission, keeping the parsed
+    file in a cache keyed by its url. Later fetches of the same file send the
+    ETag/Last-Modified from the cached copy so an unchanged file is not sent
+    again, and once a summary file is final it is not fetched again at all
+    Inputs:
+        f_url (str): url of the summary file
+        headers (dict): headers for API call
+        status (str): processing status of the submission action
+        cache (dict): summary file cache, defaults to SUMMARY_FILE_CACHE
+    Outputs:
+        file_content (dict): the parsed summary file
+    '''
+    if cache is None:
+        cache = SUMMARY_FILE_CACHE
+
+    cached = cache.get(f_url)
+    if cached is not None and cached['terminal']:
+        print(f"Summary file {f_url} is final, using cached copy")
+        return cached['content']
+
+    request_headers = dict(headers)
+    if cached is not None:
+        if cached['etag']:
+            request_headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            request_headers['If-Modified-Since'] = cached['last_modified']
+
+    print("GET " + f_url)
+    f_response = get_session(f_url, respect_retry_after=False).get(
+        f_url, headers=request_headers
+    )
+    if f_response.status_code == 304 and cached is not None:
+        print(f"Summary file {f_url} not modified, using cached copy")
+        file_content = cached['content']
+        etag = f_response.headers.get('ETag', cached['etag'])
+        last_modified = f_response.headers.get(
+            'Last-Modified', cached['last_modified']
+        )
+    elif f_response.status_code not in [200]:
+        raise RuntimeError(
+            "Status check summary file fetch failed:"
+            f"{f_response.content.decode('UTF-8')}"
+        )
+    else:
+        file_content = json.loads(f_response.content)
+        etag = f_response.headers.get('ETag')
+        last_modified = f_response.headers.get('Last-Modified')
+
+    cache[f_url] = {
+        'etag': etag,
+        'last_modified': last_modified,
+        'content': file_content,
+        # The summary file of a batch still being processed also has a
+        # batchProcessingStatus, so only the action status says it is final
+        'terminal': status in TERMINAL_STATUSES
+    }
+    return file_content
 
 
-def get_accession_id(api_response):
+def get_accession_id(api_response, local_id=None):
     '''
     Check if clinvar accession ID is present in response dict, if not report
-    this to user by printing to terminal
+    this to user by printing to terminal. A submission made in batch mode has
+    a record for each variant in the batch, so if a local ID is given only
+    the record with a matching local ID is used; otherwise the first record
+    is used
     Inputs:
         api_response (dict): dict of reponse of API to query about submission
         ID of variant
+        local_id (str): local ID of the variant, optional
     Outputs:
         accession: ClinVar accession ID, or None, if no accession ID found
     '''
     print(f"response is {api_response}")
 
     try:
-        accession = api_response["submissions"][0]["identifiers"][
-            "clinvarAccession"
-        ]
-    except KeyError:
+        submissions = api_response["submissions"]
+        if local_id is None:
+            submission = submissions[0]
+        else:
+            submission = next(
+                record for record in submissions
+                if record.get("identifiers", {}).get("localID") == local_id
+            )
+        accession = submission["identifiers"]["clinvarAccession"]
+    except (KeyError, IndexError, StopIteration):
         accession = None
         print(
-            "clinvarAccession field not found in response json. Submission may"
-            " not have been processed yet. Please check back again or check "
-            f"API response for more information\n {api_response}"
+            "clinvarAccession field not found in response json"
+            f"{'' if local_id is None else f' for {local_id}'}. Submission "
+            "may not have been processed yet. Please check back again or "
+            f"check API response for more information\n {api_response}"
         )
 
     return accession
@@ -120,33 +269,124 @@ def write_accession_id_to_file(local_id, accession):
         f.write(f'{local_id}\t{accession}\n')
 
 
-def run_submission_status_check(local_id,
-                                submission_id,
-                                headers,
-                                api_url):
+def poll_submissions(submissions, headers, api_url, policy=None,
+                     store=None):
     '''
-    Run the submission status check, if accession_id is returned, quit function
-    if not, wait 5 mins, run again
-    Function will quit after 12 attempts = an hour of querying the API
+    Poll the ClinVar API for the accession IDs of many submissions at once.
+    Each round checks every outstanding submission ID, retires the local IDs
+    that have an accession (or whose submission has finished without one),
+    then sleeps once before the next round, so the total time is bounded by
+    the slowest submission rather than the sum of all of them. Submission IDs
+    shared by several variants (batch submissions) are only queried once per
+    round. The time between rounds follows the polling policy. If a
+    checkpoint store is given, variants it records as accessioned by an
+    earlier run are not polled again and new accessions are saved to it
+    Inputs:
+        submissions (list): (local ID, submission ID) pairs
+        headers (dict): headers for API call
+        api_url (str): API endpoint URL
+        policy (dict): polling policy, defaults to DEFAULT_POLL_POLICY
+        store: connection to the checkpoint store, optional
+    Outputs:
+        accessions (dict): accession ID (or None if not found) for each local
+        ID, in the order given
     '''
-    print(f"Querying {api_url} with {submission_id}")
-    response = submission_status_check(submission_id, headers, api_url)
-    accession_id = get_accession_id(response)
-    counter = 0
-    if accession_id is not None:
+    policy = {**DEFAULT_POLL_POLICY, **(policy or {})}
+    deadline = time.monotonic() + policy['deadline']
+    accessions = {local_id: None for local_id, _ in submissions}
+    stored = get_accession_ids(store) if store is not None else {}
+
+    # Local IDs still waiting for an accession, grouped by submission ID
+    pending = {}
+    for local_id, submission_id in submissions:
+        if submission_id == SUBMISSION_ERROR:
+            print(f"{local_id} was not submitted, skipping")
+            continue
+        if local_id in stored:
+            print(f"{local_id} already accessioned as {stored[local_id]}")
+            accessions[local_id] = stored[local_id]
+            continue
+        if store is not None:
+            mark_submitted(store, local_id, submission_id)
+        pending.setdefault(submission_id, []).append(local_id)
+
+    rounds = 0
+    while pending:
+        statuses = []
+        retry_after = None
+        for submission_id in list(pending):
+            print(f"Querying {api_url} with {submission_id}")
+            try:
+                response, status, wait = fetch_submission_status(
+                    submission_id, headers, api_url
+                )
+            except RuntimeError as error:
+                print(f"{error}\nWill retry {submission_id} next round")
+                continue
+
+            if wait is not None:
+                retry_after = max(retry_after or 0, wait)
+            if response is None:
+                continue
+
+            for local_id in list(pending[submission_id]):
+                accession_id = get_accession_id(response, local_id)
+                if accession_id is not None:
+                    print(
+                        f"ClinVar accession ID for {local_id} found to be "
+                        f"{accession_id}"
+                    )
+                    accessions[local_id] = accession_id
+                    pending[submission_id].remove(local_id)
+                    if store is not None:
+                        mark_accessioned(store, local_id, accession_id)
+
+            if status in TERMINAL_STATUSES and pending[submission_id]:
+                print(
+                    f"Submission {submission_id} has status {status}, no "
+                    "accession ID will be generated for "
+                    f"{pending[submission_id]}"
+                )
+                pending[submission_id] = []
+
+            if pending[submission_id]:
+                statuses.append(status)
+            else:
+                del pending[submission_id]
+
+        remaining = deadline - time.monotonic()
+        if not pending or remaining <= 0:
+            break
+
+        interval = min(
+            next_poll_interval(rounds, policy, statuses, retry_after),
+            remaining
+        )
         print(
-            f"ClinVar accession ID found to be {accession_id}. \nWriting to "
-            "file..."
+            f"{len(pending)} submissions still pending, checking again in "
+            f"{interval:.0f} seconds"
         )
-        write_accession_id_to_file(local_id, accession_id)
+        time.sleep(interval)
+        rounds += 1
 
-    else:
-        while counter < 12 and accession_id is None:
-            time.sleep(300)
-            response = submission_status_check(submission_id, headers, api_url)
-            counter += 1
-            accession_id = get_accession_id(response)
-        write_accession_id_to_file(local_id, str(accession_id))
+    return accessions
+
+
+def run_submission_status_check(local_id,
+                                submission_id,
+                                headers,
+                                api_url,
+                                policy=None):
+    '''
+    Run the submission status check for one submission, if accession_id is
+    returned, quit function if not, wait and run again following the default
+    polling policy
+    Function will quit after an hour of querying the API
+    '''
+    accessions = poll_submissions(
+        [(local_id, submission_id)], headers, api_url, policy
+    )
+    write_accession_id_to_file(local_id, str(accessions[local_id]))
 
 
 def main():
@@ -165,36 +405,76 @@ def main():
     parser.add_argument('--local_id')
     parser.add_argument('--clinvar_api_key')
     parser.add_argument('--clinvar_testing')
+    parser.add_argument(
+        '--poll_initial_interval', type=float,
+        default=DEFAULT_POLL_POLICY['initial_interval'],
+        help="Seconds to wait before the second check for accession IDs"
+    )
+    parser.add_argument(
+        '--poll_max_interval', type=float,
+        default=DEFAULT_POLL_POLICY['max_interval'],
+        help="Maximum seconds to wait between checks for accession IDs"
+    )
+    parser.add_argument(
+        '--poll_deadline', type=float,
+        default=DEFAULT_POLL_POLICY['deadline'],
+        help="Seconds after which to stop checking for accession IDs"
+    )
+    parser.add_argument(
+        '--state_db',
+        help="SQLite checkpoint store. Variants it records as accessioned "
+        "are not polled again, so an interrupted run can be restarted"
+    )
+    add_session_arguments(parser)
     args = parser.parse_args()
 
+    poll_policy = {
+        'initial_interval': args.poll_initial_interval,
+        'max_interval': args.poll_max_interval,
+        'deadline': args.poll_deadline
+    }
+
+    configure_sessions(args.pool_size, not args.no_keep_alive)
+
     with open(args.clinvar_api_key) as f:
         api_key = f.readlines()[0].strip()
 
     headers = make_headers(api_key)
     api_url = select_api_url(args.clinvar_testing)
 
+    store = open_store(args.state_db) if args.state_db else None
+
     if args.submission_file:
         with open(args.submission_file) as f:
-            df = pd.read_csv(f, delim_whitespace=True)
+            df = pd.read_csv(f, sep=r'\s+')
 
         print(df)
 
-        for index, row in df.iterrows():
-            run_submission_status_check(
-                row["Local_ID"],
-                row["ClinVar_Submission_ID"],
-                headers,
-                api_url
-            )
+        accessions = poll_submissions(
+            list(zip(df["Local_ID"], df["ClinVar_Submission_ID"])),
+            headers,
+            api_url,
+            poll_policy,
+            store
+        )
+        for local_id, accession_id in accessions.items():
+            write_accession_id_to_file(local_id, str(accession_id))
 
     if args.submission_id:
         run_submission_status_check(
             args.local_id,
             args.submission_id,
             headers,
-            api_url
+            api_url,
+            poll_policy
         )
 
+    if store is not None:
+        # Closing the store writes its log back into the database file
+        store.close()
+
+    print_connection_stats()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Compact index of the HPO ontology, used to check and normalise phenotype
+terms before they are submitted to DECIPHER.
+
+The index is built once from hp.obo or hp.json into a binary file of
+fixed-width arrays, which is memory-mapped when first used so looking up a
+term does not need the ontology to be parsed or read into memory. The
+arrays are written in the byte order of the machine that builds the index.
+
+Index layout, all values unsigned 32-bit integers:
+    header:  magic (8 bytes), number of IDs, number of parent links
+    ids:     every HPO ID in the ontology (including alternative and
+             obsolete IDs) as an integer, sorted
+    targets: the current ID each ID should be submitted as, or 0 if the ID
+             is obsolete and has no replacement
+    offsets: start of each ID's parents in the parents array, plus the end
+    parents: the is_a parents of each ID
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+
+INDEX_MAGIC = b"HPOIDX01"
+HEADER = struct.Struct("=8sII")
+HPO_PREFIX = "HP:"
+OBO_URL_PREFIX = "http://purl.obolibrary.org/obo/HP_"
+REPLACED_BY_PREDICATE = "http://purl.obolibrary.org/obo/IAO_0100001"
+ALT_ID_PREDICATE = (
+    "http://www.geneontology.org/formats/oboInOwl#hasAlternativeId"
+)
+
+
+def hpo_id_to_int(term):
+    '''
+    Convert an HPO ID to the integer stored in the index
+        inputs:
+            term (str): an HPO ID, e.g. HP:0000118, HP_0000118 or 0000118
+        outputs:
+            number (int): the number of the term, or None if the ID is not an
+            HPO ID
+    '''
+    term = str(term).strip()
+    if term.startswith(OBO_URL_PREFIX):
+        term = term[len(OBO_URL_PREFIX):]
+    elif term[:3] in ("HP:", "HP_"):
+        term = term[3:]
+    return int(term) if term.isdigit() else None
+
+
+def int_to_hpo_id(number):
+    '''
+    Convert an integer stored in the index to an HPO ID
+        inputs:
+            number (int): the number of the term
+        outputs:
+            term (str): the HPO ID, e.g. HP:0000118
+    '''
+    return f"{HPO_PREFIX}{number:07d}"
+
+
+def parse_obo(ontology_file):
+    '''
+    Read the terms of an HPO ontology in OBO format
+        inputs:
+            ontology_file (str): path to hp.obo
+        outputs:
+            terms (dict): for each term number, a dictionary of its alt_ids,
+            replaced_by, whether it is obsolete and its is_a parents
+    '''
+    terms = {}
+    term = None
+    with open(ontology_file, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("["):
+                term = {"alt_ids": [], "replaced_by": None,
+                        "obsolete": False, "parents": []} \
+                    if line == "[Term]" else None
+                continue
+            if term is None or ":" not in line:
+                continue
+            key, _, value = line.partition(":")
+            value = value.split("!")[0].strip()
+            if key == "id":
+                number = hpo_id_to_int(value)
+                if number is not None:
+                    terms[number] = term
+            elif key == "alt_id":
+                term["alt_ids"].append(hpo_id_to_int(value))
+            elif key == "replaced_by":
+                term["replaced_by"] = hpo_id_to_int(value)
+            elif key == "is_obsolete":
+                term["obsolete"] = value == "true"
+            elif key == "is_a":
+                term["parents"].append(hpo_id_to_int(value))
+    return terms
+
+
+def parse_obographs_json(ontology_file):
+    '''
+    Read the terms of an HPO ontology in OBO Graphs JSON format
+        inputs:
+            ontology_file (str): path to hp.json
+        outputs:
+            terms (dict): for each term number, a dictionary of its alt_ids,
+            replaced_by, whether it is obsolete and its is_a parents
+    '''
+    with open(ontology_file, "r", encoding="utf-8") as f:
+        graph = json.load(f)["graphs"][0]
+
+    terms = {}
+    for node in graph.get("nodes", []):
+        number = hpo_id_to_int(node["id"])
+        if number is None:
+            continue
+        meta = node.get("meta", {})
+        term = {"alt_ids": [], "replaced_by": None,
+                "obsolete": bool(meta.get("deprecated")), "parents": []}
+        for value in meta.get("basicPropertyValues", []):
+            if value["pred"] == REPLACED_BY_PREDICATE:
+                term["replaced_by"] = hpo_id_to_int(value["val"])
+            elif value["pred"] == ALT_ID_PREDICATE:
+                term["alt_ids"].append(hpo_id_to_int(value["val"]))
+        terms[number] = term
+
+    for edge in graph.get("edges", []):
+        child, parent = hpo_id_to_int(edge["sub"]), hpo_id_to_int(edge["obj"])
+        if edge["pred"] == "is_a" and child in terms and parent is not None:
+            terms[child]["parents"].append(parent)
+    return terms
+
+
+def build_hpo_index(ontology_file, index_file):
+    '''
+    Build the HPO index file from an HPO ontology
+        inputs:
+            ontology_file (str): path to hp.obo or hp.json
+            index_file (str): path of the index file to write
+        outputs:
+            None
+    '''
+    if ontology_file.endswith(".json"):
+        terms = parse_obographs_json(ontology_file)
+    else:
+        terms = parse_obo(ontology_file)
+
+    # Work out the current ID to submit for every ID, following obsolete
+    # terms to their replacement and alternative IDs to their primary ID
+    targets = {}
+    for number, term in terms.items():
+        targets[number] = 0 if term["obsolete"] else number
+        for alt_id in term["alt_ids"]:
+            if alt_id is not None:
+                targets.setdefault(alt_id, number)
+    for number, term in terms.items():
+        if term["obsolete"] and term["replaced_by"] is not None:
+            targets[number] = term["replaced_by"]
+    for number in targets:
+        seen = set()
+        target = targets[number]
+        while target and target in targets and targets[target] != target \
+                and target not in seen:
+            seen.add(target)
+            target = targets[target]
+        targets[number] = target if target in terms else 0
+
+    ids = array("I", sorted(targets))
+    target_array = array("I", (targets[number] for number in ids))
+    offsets = array("I", [0])
+    parents = array("I")
+    for number in ids:
+        term = terms.get(number)
+        if term is not None and number == targets[number]:
+            parents.extend(p for p in term["parents"] if p is not None)
+        offsets.append(len(parents))
+
+    tmp_file = f"{index_file}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(HEADER.pack(INDEX_MAGIC, len(ids), len(parents)))
+        for values in (ids, target_array, offsets, parents):
+            values.tofile(f)
+    os.replace(tmp_file, index_file)
+
+
+class HpoIndex:
+    """
+    Read-only view of an HPO index file. The file is memory-mapped the
+    first time a term is looked up, and can then be shared between threads
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self._mmap = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._mmap is not None:
+            return
+        with self._lock:
+            if self._mmap is None:
+                self._map()
+
+    def _map(self):
+        with open(self.index_file, "rb") as f:
+            index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, id_count, parent_count = HEADER.unpack_from(index_map)
+        if magic != INDEX_MAGIC:
+            index_map.close()
+            raise ValueError(f"{self.index_file} is not an HPO index file")
+        view = memoryview(index_map)[HEADER.size:].cast("I")
+        self._ids = view[:id_count]
+        self._targets = view[id_count:2 * id_count]
+        self._offsets = view[2 * id_count:3 * id_count + 1]
+        self._parents = view[3 * id_count + 1:3 * id_count + 1 + parent_count]
+        self._views = [
+            view, self._ids, self._targets, self._offsets, self._parents
+        ]
+        # Set last, as other threads use the index once this is set
+        self._mmap = index_map
+
+    def _position(self, number):
+        self._load()
+        position = bisect_left(self._ids, number)
+        if position < len(self._ids) and self._ids[position] == number:
+            return position
+        return None
+
+    def normalise(self, term):
+        '''
+        Get the current HPO ID to submit for a term
+            inputs:
+                term (str): an HPO ID
+            outputs:
+                term (str): the current HPO ID for the term, which is the
+                primary ID for an alternative ID and the replacement for an
+                obsolete term, or None if the term is unknown or obsolete
+                with no replacement
+        '''
+        number = hpo_id_to_int(term)
+        position = None if number is None else self._position(number)
+        if position is None or not self._targets[position]:
+            return None
+        return int_to_hpo_id(self._targets[position])
+
+    def parents(self, term):
+        '''
+        Get the is_a parents of a current HPO term
+            inputs:
+                term (str): a current HPO ID
+            outputs:
+                parents (list): the HPO IDs of the term's parents
+        '''
+        position = self._position(hpo_id_to_int(term))
+        if position is None:
+            return []
+        start, end = self._offsets[position], self._offsets[position + 1]
+        return [int_to_hpo_id(number) for number in self._parents[start:end]]
+
+    def ancestors(self, term):
+        '''
+        Get every ancestor of a current HPO term
+            inputs:
+                term (str): a current HPO ID
+            outputs:
+                ancestors (set): the HPO IDs of the term's ancestors
+        '''
+        ancestors = set()
+        to_visit = self.parents(term)
+        while to_visit:
+            parent = to_visit.pop()
+            if parent not in ancestors:
+                ancestors.add(parent)
+                to_visit.extend(self.parents(parent))
+        return ancestors
+
+    def close(self):
+        if self._mmap is not None:
+            for view in reversed(self._views):
+                view.release()
+            self._mmap.close()
+            self._mmap = None
+
+
+def load_hpo_index(path):
+    '''
+    Get the HPO index for an ontology or index file. An index is built next
+    to an ontology file the first time it is used, and rebuilt if the
+    ontology file is newer than it
+        inputs:
+            path (str): path to hp.obo, hp.json or an index built from them
+        outputs:
+            hpo_index (HpoIndex): the HPO index
+    '''
+    with open(path, "rb") as f:
+        is_index = f.read(len(INDEX_MAGIC)) == INDEX_MAGIC
+    if is_index:
+        return HpoIndex(path)
+
+    index_file = f"{path}.idx"
+    if not os.path.exists(index_file) or \
+            os.path.getmtime(index_file) < os.path.getmtime(path):
+        build_hpo_index(path, index_file)
+    return HpoIndex(index_file)
+
+
+def normalise_phenotypes(phenotypes, hpo_index, prune_ancestors=False):
+    '''
+    Check a list of HPO terms against the HPO index, replacing alternative
+    and obsolete IDs with their current ID and removing unknown terms and
+    duplicates
+        inputs:
+            phenotypes (list): HPO IDs
+            hpo_index (HpoIndex): the HPO index
+            prune_ancestors (bool): if True, also remove terms that are an
+            ancestor of another term in the list
+        outputs:
+            normalised (list): the current HPO IDs to submit, in input order
+            rejected (list): the input HPO IDs that are unknown or obsolete
+            with no replacement
+    '''
+    normalised = []
+    rejected = []
+    for phenotype in phenotypes:
+        term = hpo_index.normalise(phenotype)
+        if term is None:
+            rejected.append(phenotype)
+        elif term not in normalised:
+            normalised.append(term)
+
+    if prune_ancestors:
+        implied = set()
+        for term in normalised:
+            implied.update(hpo_index.ancestors(term))
+        normalised = [term for term in normalised if term not in implied]
+    return normalised, rejected
+
+
+def main():
+    '''
+    Build an HPO index file from hp.obo or hp.json
+    '''
+    parser = argparse.ArgumentParser(
+                            description="Build an HPO index file",
+                            formatter_class=(
+                                argparse.ArgumentDefaultsHelpFormatter
+                                )
+                        )
+    parser.add_argument("--ontology", required=True,
+                        help="HPO ontology in OBO or OBO Graphs JSON format")
+    parser.add_argument("--index", required=True,
+                        help="Path of the index file to write")
+    args = parser.parse_args()
+
+    build_hpo_index(args.ontology, args.index)
+
+
+if __name__ == "__main__":
+    main()
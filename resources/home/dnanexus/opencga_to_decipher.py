@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import queue
+import threading
+from api_client import (
+    configure_sessions, positive_int, print_connection_stats
+)
+from hpo_index import load_hpo_index
+from reference_fasta import ReferenceFasta
+from pull_from_opencga import (
+    add_opencga_arguments, get_finding_lists, login_to_opencga, pull_case,
+    read_case_ids, write_case_json
+)
+from push_to_decipher import (
+    add_decipher_arguments, create_decipher_url, load_patient_cache,
+    read_decipher_headers, run_decipher_submission, save_patient_cache,
+    submit_case_to_decipher, write_skipped_items
+)
+
+DEFAULT_FETCH_WORKERS = 2
+DEFAULT_PUSH_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 4
+
+# Marks the end of the cases on the queue between fetch and push workers
+END_OF_CASES = object()
+
+
+def run_case_pipeline(cases, fetch, push, fetch_workers=DEFAULT_FETCH_WORKERS,
+                      push_workers=DEFAULT_PUSH_WORKERS,
+                      queue_size=DEFAULT_QUEUE_SIZE):
+    '''
+    Fetch and push many cases in a staged pipeline. Fetch workers pull cases
+    and put them on a bounded queue, which push workers take them from, so
+    fetching the next cases overlaps with pushing earlier ones and the run is
+    limited by the slower of the two stages. The queue stops the fetch
+    workers getting more than queue_size cases ahead of the push workers
+        inputs:
+            cases (list): the case IDs
+            fetch: function taking a case ID and returning its case data
+            push: function taking a case ID and its case data and returning a
+            dictionary of results for the case
+            fetch_workers (int): the number of cases to fetch at once
+            push_workers (int): the number of cases to push at once
+            queue_size (int): the number of fetched cases that can wait to be
+            pushed
+        outputs:
+            report (list): a dictionary for each case, in input order, with
+            the case_id, whether it was "submitted" or "failed", the stage it
+            failed at and the error, plus the results of push
+    '''
+    to_fetch = iter(cases)
+    to_fetch_lock = threading.Lock()
+    fetched = queue.Queue(maxsize=queue_size)
+    report = {}
+
+    def fetch_worker():
+        while True:
+            with to_fetch_lock:
+                case_id = next(to_fetch, None)
+            if case_id is None:
+                return
+            try:
+                fetched.put((case_id, fetch(case_id), None))
+            except Exception as error:
+                fetched.put((case_id, None, error))
+
+    def push_worker():
+        while True:
+            item = fetched.get()
+            if item is END_OF_CASES:
+                return
+            case_id, case, error = item
+            result = {'case_id': case_id}
+            if error is not None:
+                result.update(
+                    status='failed', stage='fetch', error=str(error)
+                )
+            else:
+                try:
+                    result.update(push(case_id, case))
+                    result['status'] = 'submitted'
+                except Exception as error:
+                    result.update(
+                        status='failed', stage='push', error=str(error)
+                    )
+            report[case_id] = result
+
+    fetchers = [
+        threading.Thread(target=fetch_worker) for _ in range(fetch_workers)
+    ]
+    pushers = [
+        threading.Thread(target=push_worker) for _ in range(push_workers)
+    ]
+    for worker in fetchers + pushers:
+        worker.start()
+    for worker in fetchers:
+        worker.join()
+    for _ in pushers:
+        fetched.put(END_OF_CASES)
+    for worker in pushers:
+        worker.join()
+
+    return [report[case_id] for case_id in dict.fromkeys(cases)]
+
+
+def share_cases(cases, oc, headers, args):
+    '''
+    Pull many cases from OpenCGA and submit them to DECIPHER through the
+    case pipeline, with the options given on the command line
+        inputs:
+            cases (list): the case IDs
+            oc: an instance of the OpenCGA client, logged in
+            headers (dict): the DECIPHER API request headers
+            args: parsed command line arguments
+        outputs:
+            report (list): the result for each case, see run_case_pipeline()
+    '''
+    finding_lists = get_finding_lists(args.include_secondary_findings)
+    patient_cache = load_patient_cache(args.patient_cache)
+    hpo_index = None
+    if args.hpo_ontology:
+        hpo_index = load_hpo_index(args.hpo_ontology)
+    reference = None
+    if args.reference_fasta:
+        reference = ReferenceFasta(args.reference_fasta)
+
+    def fetch(case_id):
+        case = pull_case(
+            case_id, args.study, oc, finding_lists, args.stream_findings
+        )
+        # Read streamed findings here, so only fetch workers call OpenCGA and
+        # only the parsed variants wait on the queue
+        case['variant_list'] = list(case['variant_list'])
+        return case
+
+    def push(case_id, case):
+        patient_id, skipped = submit_case_to_decipher(
+            case, headers, args.submitter, patient_cache, hpo_index,
+            args.prune_hpo_ancestors, args.variant_chunk_size, reference
+        )
+        return {
+            'decipher_url': create_decipher_url(patient_id),
+            'skipped_items': [{'case_id': case_id, **item} for item in skipped]
+        }
+
+    report = run_case_pipeline(
+        cases, fetch, push, args.fetch_workers, args.push_workers,
+        args.queue_size
+    )
+    if args.patient_cache:
+        save_patient_cache(patient_cache, args.patient_cache)
+    return report
+
+
+def main():
+    '''
+    The entry point function of this script. Pulls cases from OpenCGA and
+    submits them to DECIPHER in one process, passing the case data straight
+    from pull_from_opencga.py's functions to push_to_decipher.py's functions
+    rather than through a JSON file
+    '''
+    parser = argparse.ArgumentParser(
+                                description="Pull cases from OpenCGA and "
+                                "submit them to DECIPHER",
+                                formatter_class=(
+                                   argparse.ArgumentDefaultsHelpFormatter
+                                   )
+                            )
+
+    parser.add_argument("--opencga_configuration", help="OpenCGA login")
+    parser.add_argument("--decipher_configuration",
+                        help="API keys for DECIPHER"
+                        )
+    parser.add_argument("-c", "--case",
+                        help="OpenCGA case ID that is to be uploaded to DECIPHER"
+                        )
+    parser.add_argument("--cases", nargs="+",
+                        help="OpenCGA case IDs to upload in one batch"
+                        )
+    parser.add_argument("--case_file",
+                        help="File of OpenCGA case IDs to upload in one "
+                        "batch, one per line"
+                        )
+    parser.add_argument("--submitter", help="DECIPHER submitter ID")
+    parser.add_argument("--case_json",
+                        help="Also write the case data to this JSON file, "
+                        "for debugging. Single case only"
+                        )
+    parser.add_argument("--fetch_workers", type=positive_int,
+                        default=DEFAULT_FETCH_WORKERS,
+                        help="Number of batch cases to pull from OpenCGA at "
+                        "once"
+                        )
+    parser.add_argument("--push_workers", type=positive_int,
+                        default=DEFAULT_PUSH_WORKERS,
+                        help="Number of batch cases to submit to DECIPHER at "
+                        "once"
+                        )
+    parser.add_argument("--queue_size", type=positive_int,
+                        default=DEFAULT_QUEUE_SIZE,
+                        help="Number of pulled batch cases that can wait to "
+                        "be submitted"
+                        )
+    parser.add_argument("--report", default="decipher_report.json",
+                        help="JSON file to write the result of each batch "
+                        "case to"
+                        )
+    add_opencga_arguments(parser)
+    add_decipher_arguments(parser)
+
+    args = parser.parse_args()
+
+    configure_sessions(
+        max(args.pool_size, args.push_workers), not args.no_keep_alive
+    )
+    decipher_api_request_headers = read_decipher_headers(
+        args.decipher_configuration
+    )
+    oc = login_to_opencga(args.opencga_configuration, args.host)
+
+    if args.cases or args.case_file:
+        report = share_cases(
+            read_case_ids(args.cases, args.case_file), oc,
+            decipher_api_request_headers, args
+        )
+        skipped = [
+            item for result in report
+            for item in result.pop('skipped_items', [])
+        ]
+        write_skipped_items(skipped, args.skipped_items)
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+        print_connection_stats()
+
+        failed = [
+            result['case_id'] for result in report
+            if result['status'] == 'failed'
+        ]
+        print(
+            f"Submitted {len(report) - len(failed)} of {len(report)} cases "
+            f"to DECIPHER, see {args.report}"
+        )
+        if failed:
+            raise RuntimeError(
+                "Cases could not be submitted to DECIPHER: "
+                f"{', '.join(failed)}"
+            )
+        return
+
+    case = pull_case(
+        args.case, args.study, oc,
+        get_finding_lists(args.include_secondary_findings),
+        args.stream_findings
+    )
+    if args.case_json:
+        # Read streamed findings once, for both the JSON and the submission
+        case['variant_list'] = list(case['variant_list'])
+        write_case_json(case, args.case_json)
+
+    run_decipher_submission(case, decipher_api_request_headers, args)
+    print_connection_stats()
+
+
+if __name__ == "__main__":
+    main()
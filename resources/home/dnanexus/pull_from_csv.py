@@ -1,7 +1,68 @@
 import pandas as pd
 import json
+import gzip
 import argparse
 from pathlib import Path
+from reference_fasta import find_ref_mismatches, load_reference_fastas
+
+# Clinical significance strings accepted by ClinVar's API
+CLINICAL_SIGNIFICANCE_VALID = [
+    "Pathogenic",
+    "Likely pathogenic",
+    "Uncertain significance",
+    "Likely benign",
+    "Benign",
+    "Pathogenic, low penetrance",
+    "Uncertain risk allele",
+    "Likely pathogenic, low penetrance",
+    "Established risk allele",
+    "Likely risk allele",
+    "affects",
+    "association",
+    "drug response",
+    "confers sensitivity",
+    "protective",
+    "other",
+    "not provided"
+]
+
+# VEP reference genome used by the dias pipeline and its genome build
+REF_GENOME_ASSEMBLIES = {
+    "GRCh37.p13": "GRCh37",
+    "GRCh38.p13": "GRCh38",
+}
+
+# ClinVar organisation ID of each submitting lab and the url of its assertion
+# criteria
+ASSERTION_CRITERIA_URLS = {
+    # NUH
+    509428: 'https://submit.ncbi.nlm.nih.gov/api/2.0/files/iptxgqju/uk-practi'
+    'ce-guidelines-for-variant-classification-v4-01-2020.pdf/?format=attachm'
+    'ent',
+    # CUH
+    288359: 'https://submit.ncbi.nlm.nih.gov/api/2.0/files/kf4l0sn8/uk-practi'
+    'ce-guidelines-for-variant-classification-v4-01-2020.pdf/?format=attachm'
+    'ent',
+}
+
+# Columns of the variant CSV read when formatting a variant for ClinVar
+VARIANT_CSV_COLUMNS = [
+    "Local ID", "Linking ID", "Gene symbol", "Chromosome", "Start",
+    "Reference allele", "Alternate allele", "Preferred condition name",
+    "Germline classification", "Date last evaluated",
+    "Comment on classification", "Collection method", "Allele origin",
+    "Affected status", "Ref genome", "Organisation ID"
+]
+
+# Columns that must have a value in every row. Comment on classification can
+# be empty, and the columns checked against a list of valid values are
+# checked for empty values by that
+REQUIRED_VALUE_COLUMNS = [
+    "Local ID", "Linking ID", "Gene symbol", "Chromosome", "Start",
+    "Reference allele", "Alternate allele", "Preferred condition name",
+    "Date last evaluated", "Collection method", "Allele origin",
+    "Affected status"
+]
 
 
 def extract_clinvar_information(variant):
@@ -18,6 +79,270 @@ def extract_clinvar_information(variant):
     comment = convert_comment(variant["Comment on classification"])
     assembly = determine_assembly(variant["Ref genome"])
 
+    clinvar_dict = format_clinvar_dict(
+        variant, clinical_significance, comment, assembly
+    )
+
+    clinvar_dict = add_lab_specific_guidelines(
+        variant["Organisation ID"], clinvar_dict
+    )
+
+    return clinvar_dict
+
+
+def extract_clinvar_information_from_df(df):
+    '''
+    Extract information for every variant in the variant dataframe and
+    reformat into dictionaries. Gives the same output as calling
+    extract_clinvar_information() on each row, but the classification, ref
+    genome and organisation ID columns are validated and mapped once per
+    distinct value rather than once per row.
+    Inputs:
+        df (pd.DataFrame): dataframe of variants read from the variant CSV
+    Outputs:
+        clinvar_dicts (list): list of dictionaries of data to submit to
+        clinvar, one per row of the dataframe
+    '''
+    clinical_significances = map_column(
+        df["Germline classification"], check_clinical_significance
+    )
+    assemblies = map_column(df["Ref genome"], determine_assembly)
+    guideline_urls = map_column(
+        df["Organisation ID"], get_assertion_criteria_url
+    )
+    comments = [
+        convert_comment(comment)
+        for comment in df["Comment on classification"].tolist()
+    ]
+
+    clinvar_dicts = []
+    for variant, clinical_significance, comment, assembly, url in zip(
+        df.to_dict('records'), clinical_significances, comments, assemblies,
+        guideline_urls
+    ):
+        clinvar_dict = format_clinvar_dict(
+            variant, clinical_significance, comment, assembly
+        )
+        clinvar_dict['assertionCriteria'] = {'url': url}
+        clinvar_dicts.append(clinvar_dict)
+
+    return clinvar_dicts
+
+
+def stream_clinvar_information(variant_csv, chunksize):
+    '''
+    Read the variant CSV in chunks of a bounded number of rows and yield the
+    data to submit to clinvar for each variant as it is extracted, so memory
+    use does not grow with the size of the CSV
+    Inputs:
+        variant_csv (str): path to the variant CSV
+        chunksize (int): maximum number of rows to hold in memory at once
+    Outputs:
+        clinvar_dict: generator of dictionaries of data to submit to clinvar,
+        one per row of the CSV
+    '''
+    with open(variant_csv, 'r', encoding='utf-8') as f:
+        for chunk in pd.read_csv(f, chunksize=chunksize):
+            yield from extract_clinvar_information_from_df(chunk)
+
+
+def map_column(column, function):
+    '''
+    Apply a validating/mapping function to each distinct value in a column
+    and map the results back onto every row
+    Inputs:
+        column (pd.Series): column of the variant dataframe
+        function: function taking one value and returning its mapped value,
+        raising an error if the value is invalid
+    Outputs:
+        mapped (list): mapped value for each row of the column
+    '''
+    values = column.tolist()
+    lookup = {value: function(value) for value in set(values)}
+    return [lookup[value] for value in values]
+
+
+def validate_variant_df(df, seen_local_ids=None, references=None):
+    '''
+    Check every row of the variant dataframe at once, so all problems with
+    the variant CSV are found before any variant is written out or submitted.
+    Each check is made on whole columns, rather than row by row as the
+    variants are extracted
+    Inputs:
+        df (pd.DataFrame): dataframe of variants read from the variant CSV
+        seen_local_ids (dict): Local IDs already seen in earlier chunks of
+        the CSV and the row each was on, updated with the Local IDs in df
+        references (dict): the ReferenceFasta of each assembly, to check the
+        reference alleles of variants on that assembly against. Optional
+    Outputs:
+        errors (list): a dictionary for each error, with the row of the CSV
+        it is on (counting the header as row 1, or None if it is about the
+        whole file), the column, the invalid value and the error
+    '''
+    errors = []
+    rows = df.index + 2
+
+    def add_errors(mask, column, error):
+        for row, value in zip(rows[mask], df.loc[mask, column].tolist()):
+            errors.append({
+                'row': int(row),
+                'column': column,
+                'value': None if pd.isna(value) else str(value),
+                'error': error
+            })
+
+    missing_columns = [
+        column for column in VARIANT_CSV_COLUMNS if column not in df.columns
+    ]
+    for column in missing_columns:
+        errors.append({
+            'row': None, 'column': column, 'value': None,
+            'error': "Column is missing from the variant CSV"
+        })
+
+    for column in REQUIRED_VALUE_COLUMNS:
+        if column not in missing_columns:
+            add_errors(df[column].isna().to_numpy(), column, "Value is empty")
+
+    if "Start" not in missing_columns:
+        start = pd.to_numeric(df["Start"], errors='coerce')
+        valid_start = (start > 0) & (start % 1 == 0)
+        add_errors(
+            (df["Start"].notna() & ~valid_start).to_numpy(), "Start",
+            "Start is not a positive integer"
+        )
+
+    valid_values = {
+        "Germline classification": (
+            CLINICAL_SIGNIFICANCE_VALID,
+            "Clinical significance is not in the list of strings for "
+            "clinical significance that will be accepted by ClinVar"
+        ),
+        "Ref genome": (
+            list(REF_GENOME_ASSEMBLIES),
+            "Could not determine genome build from ref genome"
+        ),
+        "Organisation ID": (
+            list(ASSERTION_CRITERIA_URLS),
+            "Organisation ID is not a valid option"
+        ),
+    }
+    for column, (valid, error) in valid_values.items():
+        if column not in missing_columns:
+            add_errors((~df[column].isin(valid)).to_numpy(), column, error)
+
+    ref_columns = ["Chromosome", "Start", "Reference allele", "Ref genome"]
+    if references and not set(ref_columns) & set(missing_columns):
+        # Check the reference alleles of each assembly against its genome in
+        # one pass
+        assemblies = df["Ref genome"].map(REF_GENOME_ASSEMBLIES)
+        checkable = (
+            assemblies.isin(list(references)) & valid_start
+            & df["Reference allele"].notna()
+        )
+        for assembly, variants in df[checkable].groupby(
+            assemblies[checkable]
+        ):
+            mismatches = find_ref_mismatches(references[assembly], zip(
+                variants.index, variants["Chromosome"],
+                start[variants.index].astype(int),
+                variants["Reference allele"]
+            ))
+            for index, sequence in mismatches:
+                position = f"{df.at[index, 'Chromosome']}:" \
+                    f"{int(start[index])}"
+                errors.append({
+                    'row': int(index) + 2,
+                    'column': "Reference allele",
+                    'value': str(df.at[index, "Reference allele"]),
+                    'error': (
+                        f"Reference allele does not match {assembly} at "
+                        f"{position}, which is {sequence}"
+                        if sequence else f"{position} is not in {assembly}"
+                    )
+                })
+
+    if "Local ID" not in missing_columns:
+        # Each variant's JSON file is named after its Local ID, and ClinVar
+        # needs them to be unique, so a repeated Local ID would overwrite or
+        # be rejected
+        if seen_local_ids is None:
+            seen_local_ids = {}
+        local_ids = df["Local ID"]
+        duplicated = local_ids.notna() & (
+            local_ids.duplicated() | local_ids.isin(list(seen_local_ids))
+        )
+        add_errors(
+            duplicated.to_numpy(), "Local ID",
+            "Local ID is used by an earlier row"
+        )
+        for local_id, row in zip(local_ids.tolist(), rows):
+            seen_local_ids.setdefault(local_id, int(row))
+
+    errors.sort(key=lambda error: (error['row'] or 0, error['column']))
+    return errors
+
+
+def validate_variant_csv(variant_csv, chunksize=None, references=None):
+    '''
+    Check the whole variant CSV with validate_variant_df(), reading it in
+    chunks if a chunk size is given
+    Inputs:
+        variant_csv (str): path to the variant CSV
+        chunksize (int): maximum number of rows to hold in memory at once, or
+        None to read the whole file at once
+        references (dict): the ReferenceFasta of each assembly, to check
+        reference alleles against. Optional
+    Outputs:
+        errors (list): every error in the variant CSV, as described in
+        validate_variant_df()
+    '''
+    errors = []
+    seen_local_ids = {}
+    with open(variant_csv, 'r', encoding='utf-8') as f:
+        if chunksize:
+            for chunk in pd.read_csv(f, chunksize=chunksize):
+                errors.extend(
+                    validate_variant_df(chunk, seen_local_ids, references)
+                )
+        else:
+            errors.extend(validate_variant_df(
+                pd.read_csv(f), seen_local_ids, references
+            ))
+    return errors
+
+
+def write_validation_report(errors, report_file):
+    '''
+    Write the errors found in the variant CSV to a JSON report
+    Inputs:
+        errors (list): the errors, as described in validate_variant_df()
+        report_file (str): path of the JSON report to write
+    Outputs:
+        None
+    '''
+    report = {
+        'valid': not errors,
+        'error_count': len(errors),
+        'errors': errors
+    }
+    with open(report_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+
+
+def format_clinvar_dict(variant, clinical_significance, comment, assembly):
+    '''
+    Format the data for one variant into the dictionary structure accepted by
+    the ClinVar API
+    Inputs:
+        variant: row from variant dataframe (or dict of the row) with data for
+        one variant
+        clinical_significance (str): validated clinical significance
+        comment (str): comment on classification
+        assembly (str): genome build of the variant
+    Outputs:
+        clinvar_dict: dictionary of data to submit to clinvar
+    '''
     clinvar_dict = {
         'clinvarSubmission': [{
             'clinicalSignificance': {
@@ -53,10 +378,6 @@ def extract_clinvar_information(variant):
         }],
     }
 
-    clinvar_dict = add_lab_specific_guidelines(
-        variant["Organisation ID"], clinvar_dict
-    )
-
     return clinvar_dict
 
 
@@ -72,32 +393,12 @@ def check_clinical_significance(clinical_significance_description):
         variant CSV, validated to check it is compatible with ClinVar
     '''
 
-    clinical_significance_valid = [
-        "Pathogenic",
-        "Likely pathogenic",
-        "Uncertain significance",
-        "Likely benign",
-        "Benign",
-        "Pathogenic, low penetrance",
-        "Uncertain risk allele",
-        "Likely pathogenic, low penetrance",
-        "Established risk allele",
-        "Likely risk allele",
-        "affects",
-        "association",
-        "drug response",
-        "confers sensitivity",
-        "protective",
-        "other",
-        "not provided"
-    ]
-
-    if clinical_significance_description not in clinical_significance_valid:
+    if clinical_significance_description not in CLINICAL_SIGNIFICANCE_VALID:
         raise RuntimeError(
             f"Clinical significance value {clinical_significance_description} "
             "is not in the list of strings for clinical significance that will"
             " be accepted by ClinVar \n"
-            f"The list: {clinical_significance_valid}"
+            f"The list: {CLINICAL_SIGNIFICANCE_VALID}"
         )
 
     return clinical_significance_description
@@ -130,20 +431,14 @@ def determine_assembly(ref_genome):
     Outputs:
         assembly (str): genome build of the reference genome (GRCh37 or GRCh38)
     '''
-    if ref_genome == "GRCh37.p13":
-        assembly = "GRCh37"
-        print(
-            f"Selected GRCh37 as assembly, because ref genome is {ref_genome}"
-        )
-    elif ref_genome == "GRCh38.p13":
-        assembly = "GRCh38"
-        print(
-            f"Selected GRCh38 as assembly, because ref genome is {ref_genome}"
-        )
-    else:
+    assembly = REF_GENOME_ASSEMBLIES.get(ref_genome)
+    if assembly is None:
         raise RuntimeError(
             f"Could not determine genome build from ref genome {ref_genome}"
         )
+    print(
+        f"Selected {assembly} as assembly, because ref genome is {ref_genome}"
+    )
     return assembly
 
 
@@ -158,24 +453,66 @@ def add_lab_specific_guidelines(organisation_id, clinvar_dict):
         clinvar_dict (dict): dictionary of info to submit to clinvar, edited
         to add url for assertion criteria which is specific to CUH or NUH
     '''
-    # If NUH
-    if organisation_id == 509428:
-        clinvar_dict['assertionCriteria'] = {'url': 'https://submit.ncbi.nlm.n'
-        'ih.gov/api/2.0/files/iptxgqju/uk-practice-guidelines-for-variant-clas'
-        'sification-v4-01-2020.pdf/?format=attachment'}
+    clinvar_dict['assertionCriteria'] = {
+        'url': get_assertion_criteria_url(organisation_id)
+    }
+    return clinvar_dict
 
-    # If CUH
-    elif organisation_id == 288359:
-        clinvar_dict['assertionCriteria'] = {'url': 'https://submit.ncbi.nlm.n'
-        'ih.gov/api/2.0/files/kf4l0sn8/uk-practice-guidelines-for-variant-clas'
-        'sification-v4-01-2020.pdf/?format=attachment'}
 
-    else:
+def get_assertion_criteria_url(organisation_id):
+    '''
+    Look up the url for the assertion criteria of the submitting lab
+    Inputs:
+        organisation_id (int): ClinVar organisation ID for submitting lab (CUH
+        or NUH)
+    Outputs:
+        url (str): url for assertion criteria which is specific to CUH or NUH
+    '''
+    url = ASSERTION_CRITERIA_URLS.get(organisation_id)
+    if url is None:
         raise ValueError(
             f"Value given for organisation ID {organisation_id} is not a valid"
             " option.\nValid options:\n288359 - CUH\n509428 - NUH"
         )
-    return clinvar_dict
+    return url
+
+
+def write_clinvar_json_files(clinvar_dicts, file_name):
+    '''
+    Write the data to submit to clinvar for each variant to its own JSON file
+    named {file_name}-{Local ID}_clinvar_data.json
+    Inputs:
+        clinvar_dicts: iterable of dictionaries of data to submit to clinvar
+        file_name (str): stem of the variant CSV
+    Outputs:
+        None, creates one JSON file per variant
+    '''
+    for clinvar_dict in clinvar_dicts:
+        local_id = clinvar_dict['clinvarSubmission'][0]['localID']
+        prefix = file_name + '-' + local_id
+
+        with open(f"{prefix}_clinvar_data.json", 'w', encoding='utf-8') as f:
+            json.dump(clinvar_dict, f, ensure_ascii=False, indent=4)
+
+
+def write_clinvar_ndjson(clinvar_dicts, output_file):
+    '''
+    Write the data to submit to clinvar for all variants to a single
+    newline-delimited JSON file, one variant per line. The file is gzip
+    compressed if its name ends in .gz
+    Inputs:
+        clinvar_dicts: iterable of dictionaries of data to submit to clinvar
+        output_file (str): path of the NDJSON file to write
+    Outputs:
+        count (int): number of variants written to the file
+    '''
+    opener = gzip.open if str(output_file).endswith('.gz') else open
+    count = 0
+    with opener(output_file, 'wt', encoding='utf-8') as f:
+        for clinvar_dict in clinvar_dicts:
+            f.write(json.dumps(clinvar_dict, ensure_ascii=False) + '\n')
+            count += 1
+    return count
 
 
 def main():
@@ -190,20 +527,72 @@ def main():
                             )
 
     parser.add_argument('--variant_csv')
+    parser.add_argument(
+        '--chunksize', type=int, default=None,
+        help="Read the variant CSV this many rows at a time rather than "
+        "loading the whole file into memory"
+    )
+    parser.add_argument(
+        '--output_format', choices=['json', 'ndjson'], default='json',
+        help="Write one JSON file per variant (json) or all variants to a "
+        "single newline-delimited JSON file (ndjson)"
+    )
+    parser.add_argument(
+        '--output_file', default=None,
+        help="NDJSON file to write in ndjson mode, gzip compressed if it ends "
+        "in .gz. Defaults to {variant_csv stem}_clinvar_data.ndjson"
+    )
+    parser.add_argument(
+        '--validation_report', default=None,
+        help="JSON file to write the errors found in the variant CSV to. "
+        "Defaults to {variant_csv stem}_validation_report.json"
+    )
+    parser.add_argument(
+        '--reference_fasta', nargs='+', default=[],
+        help="Indexed reference FASTA to check the reference alleles of "
+        "variants on each genome build against, as ASSEMBLY=PATH, e.g. "
+        "GRCh37=hs37d5.fa.gz GRCh38=GRCh38.fa.gz"
+    )
     args = parser.parse_args()
 
-    with open(args.variant_csv, 'r', encoding='utf-8') as f:
-        df = pd.read_csv(f)
+    # Check the whole CSV before any variant is written out, so every error
+    # is reported at once and nothing is submitted from an invalid CSV
+    file_name = Path(args.variant_csv).stem
+    report_file = args.validation_report or \
+        f"{file_name}_validation_report.json"
+    errors = validate_variant_csv(
+        args.variant_csv, args.chunksize,
+        load_reference_fastas(args.reference_fasta)
+    )
+    write_validation_report(errors, report_file)
+    if errors:
+        for error in errors:
+            print(
+                f"Row {error['row']}, column {error['column']}: "
+                f"{error['error']} ({error['value']})"
+            )
+        raise RuntimeError(
+            f"Found {len(errors)} errors in {args.variant_csv}, see "
+            f"{report_file}"
+        )
 
-    for index, row in df.iterrows():
-        clinvar_dict = extract_clinvar_information(row)
+    if args.chunksize:
+        clinvar_dicts = stream_clinvar_information(
+            args.variant_csv, args.chunksize
+        )
+    else:
+        with open(args.variant_csv, 'r', encoding='utf-8') as f:
+            df = pd.read_csv(f)
+        clinvar_dicts = extract_clinvar_information_from_df(df)
 
-        file_name = Path(args.variant_csv).stem
-        print(file_name)
-        prefix = file_name + '-' + row['Local ID']
+    print(file_name)
 
-        with open(f"{prefix}_clinvar_data.json", 'w', encoding='utf-8') as f:
-            json.dump(clinvar_dict, f, ensure_ascii=False, indent=4)
+    if args.output_format == 'ndjson':
+        output_file = args.output_file or f"{file_name}_clinvar_data.ndjson"
+        count = write_clinvar_ndjson(clinvar_dicts, output_file)
+        print(f"Wrote {count} variants to {output_file}")
+    else:
+        write_clinvar_json_files(clinvar_dicts, file_name)
 
 
 if __name__ == "__main__":
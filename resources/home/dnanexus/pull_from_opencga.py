@@ -3,9 +3,63 @@ import json
 import argparse
 from pyopencga.opencga_config import ClientConfiguration
 from pyopencga.opencga_client import OpencgaClient
+from variant_record import VariantRecord, variant_record_json
 
+OPENCGA_HOST = "https://uat.eglh.app.zettagenomics.com/opencga/"
 
-def extract_case_from_opencga(case, study, oc):
+# Maximum number of case IDs OpenCGA accepts in one clinical analysis search
+CASE_BATCH_SIZE = 100
+
+# Fields of the proband and of each finding read by the extract functions
+# below. Only these are requested from OpenCGA, so add any field an extract
+# function starts to use here too
+PROBAND_FIELDS = ["id", "sex.id", "phenotypes.id"]
+FINDING_FIELDS = [
+    "id", "type", "studies.files.call.variantId", "studies.samples.data"
+]
+
+
+# Interpretation finding lists that can be shared with DECIPHER
+PRIMARY_FINDINGS = "primaryFindings"
+SECONDARY_FINDINGS = "secondaryFindings"
+
+
+def finding_include_fields(finding_lists, prefix=""):
+    '''
+    Build the list of finding fields to request from OpenCGA
+        inputs:
+            finding_lists (tuple): the interpretation finding lists to include
+            prefix (str): path of the interpretation in the result
+        outputs:
+            fields (list): field paths for the OpenCGA include option
+    '''
+    return [
+        f"{prefix}{finding_list}.{field}"
+        for finding_list in finding_lists for field in FINDING_FIELDS
+    ]
+
+
+def case_include_fields(findings=(PRIMARY_FINDINGS,)):
+    '''
+    Build the list of clinical analysis fields to request from OpenCGA
+        inputs:
+            findings (tuple): the interpretation finding lists to include,
+            none if the findings are fetched separately
+        outputs:
+            include (str): comma-separated field paths for the OpenCGA include
+            option
+    '''
+    fields = ["id", "interpretation.id"] + [
+        f"proband.{field}" for field in PROBAND_FIELDS
+    ]
+    fields += finding_include_fields(findings, "interpretation.")
+    return ",".join(fields)
+
+
+CASE_INCLUDE = case_include_fields()
+
+
+def extract_case_from_opencga(case, study, oc, include=CASE_INCLUDE):
     '''
     Retreives the case information from the Analysis - Clinical client of the
     OpenCGA API
@@ -14,15 +68,153 @@ def extract_case_from_opencga(case, study, oc):
             study (str): the study that contains the case
             oc: an instance of the OpenCGA client, logged in with a user and
             password
+            include (str): the fields to request, see case_include_fields()
         outputs:
             clinical_anlaysis: a dictionary of case information returned from
             the OpenCGA API
     '''
-    # Find this case from the 
-    clinical_analysis = oc.clinical.search(study=study, id=case)
+    # Find this case from the clinical analyses, requesting only the fields
+    # that are used
+    clinical_analysis = oc.clinical.search(
+        study=study, id=case, include=include
+    )
     return clinical_analysis
 
 
+def read_case_ids(cases=None, case_file=None):
+    '''
+    Collect the case IDs given on the command line and in a case file,
+    without duplicates
+        inputs:
+            cases (list): case IDs, optional
+            case_file (str): path to a file with one case ID per line,
+            optional
+        outputs:
+            case_ids (list): the case IDs in the order they were given
+    '''
+    case_ids = list(cases or [])
+    if case_file:
+        with open(case_file, 'r', encoding='utf-8') as f:
+            case_ids += [line.strip() for line in f]
+    return list(dict.fromkeys(case_id for case_id in case_ids if case_id))
+
+
+def extract_cases_from_opencga(cases, study, oc, batch_size=CASE_BATCH_SIZE,
+                               include=CASE_INCLUDE):
+    '''
+    Retrieve many cases from the Analysis - Clinical client of the OpenCGA
+    API, searching for a batch of comma-separated case IDs at a time
+        inputs:
+            cases (list): the case names in OpenCGA
+            study (str): the study that contains the cases
+            oc: an instance of the OpenCGA client, logged in with a user and
+            password
+            batch_size (int): the number of cases to search for at once
+            include (str): the fields to request, see case_include_fields()
+        outputs:
+            generator of (case, clinical_analysis) tuples, where
+            clinical_analysis is the case information returned from the
+            OpenCGA API or None if the case was not found
+    '''
+    for i in range(0, len(cases), batch_size):
+        batch = cases[i:i + batch_size]
+        response = oc.clinical.search(
+            study=study, id=",".join(batch), limit=len(batch),
+            include=include
+        )
+        found = {
+            result['id']: result for result in response.get_results()
+        }
+        for case in batch:
+            yield case, found.get(case)
+
+
+def iter_interpretation_findings(interpretation_id, study, oc,
+                                 finding_lists=(PRIMARY_FINDINGS,)):
+    '''
+    Fetch the findings of an interpretation one finding list at a time, so
+    only one list is held in memory at once
+        inputs:
+            interpretation_id (str): the interpretation ID in OpenCGA
+            study (str): the study that contains the case
+            oc: an instance of the OpenCGA client, logged in with a user and
+            password
+            finding_lists (tuple): the finding lists to fetch, in order
+        outputs:
+            generator of findings
+    '''
+    for finding_list in finding_lists:
+        response = oc.clinical.info_interpretation(
+            interpretation_id, study=study,
+            include=",".join(finding_include_fields([finding_list]))
+        )
+        for interpretation in response.get_results():
+            yield from interpretation.get(finding_list) or []
+
+
+def case_findings(clinical_analysis, finding_lists=(PRIMARY_FINDINGS,),
+                  study=None, oc=None):
+    '''
+    Get the findings of a case from the requested finding lists. If the case
+    was fetched without its findings, they are fetched from its
+    interpretation one list at a time
+        inputs:
+            clinical_analysis (dict): the case information returned from the
+            OpenCGA API
+            finding_lists (tuple): the finding lists to include, in order
+            study (str): the study that contains the case, needed if the
+            findings are fetched separately
+            oc: an instance of the OpenCGA client, needed if the findings are
+            fetched separately
+        outputs:
+            generator of findings
+    '''
+    interpretation = clinical_analysis['interpretation']
+    if oc is not None and not any(
+        finding_list in interpretation for finding_list in finding_lists
+    ):
+        yield from iter_interpretation_findings(
+            interpretation['id'], study, oc, finding_lists
+        )
+        return
+    for finding_list in finding_lists:
+        yield from interpretation.get(finding_list) or []
+
+
+def build_case_json(clinical_analysis, findings=None, stream_variants=False):
+    '''
+    Extract the data needed to submit a case to DECIPHER from its clinical
+    analysis
+        inputs:
+            clinical_analysis (dict): the case information returned from the
+            OpenCGA API
+            findings (iterable): the findings to share, if not the primary
+            findings in the clinical analysis, e.g. from case_findings()
+            stream_variants (bool): if True, the variant list is a generator
+            that parses each finding only as the variant list is read, so
+            findings fetched from OpenCGA are never all held in memory
+        outputs:
+            case_dict (dict): a dictionary of case information that is needed
+            to submit the case to DECIPHER
+    '''
+    proband = clinical_analysis['proband']
+    if findings is None:
+        findings = clinical_analysis['interpretation'][PRIMARY_FINDINGS]
+
+    # Call functions to extract required data
+    sex = extract_proband_sex(proband)
+    phenotype_list = extract_proband_phenotypes(proband)
+    if stream_variants:
+        variant_list = iter_proband_variants(findings)
+    else:
+        variant_list = extract_proband_variants(findings)
+
+    # Format the required data into a case dictionary
+    return format_required_data_into_case_json(
+        proband, sex, phenotype_list, variant_list
+        )
+
+
 def extract_proband_sex(proband):
     '''
     Patients are not routinely karyotyped, so karyotype information is not in
@@ -61,41 +253,34 @@ def extract_proband_phenotypes(proband):
     return phenotype_list
 
 
+def iter_proband_variants(interpretation):
+    '''
+    Extract the variants from the findings of an interpretation one at a time,
+    so findings can be streamed through without all being held in memory
+       inputs:
+            interpretation (iterable): the findings from the OpenCGA analysis
+            client, e.g. the primary findings of causative variants
+        outputs:
+            generator of interpreted variants, as VariantRecords
+    '''
+    for finding in interpretation:
+        variant = VariantRecord.from_finding(finding)
+        if variant is not None:
+            yield variant
+
+
 def extract_proband_variants(interpretation):
     '''
     Extract the variants from the primary interpretaion of the case
        inputs:
-            interpretation (dict): the interpretaion information from the
+            interpretation (iterable): the interpretaion information from the
             OpenCGA analysis client; this has the primary findings of causative
-            variants.
-        outputs:
-            variant_list (list): a list of interpreted variants
-    '''
-    variant_list = []
-    for variant in interpretation:
-        variant_type = variant['type']
-
-        if variant_type in ("INDEL", "DELETION", "INSERTION"):
-            # For INDELS, ref is stored as a dash in ['id'] need to get the
-            # nomenclature from ['call']
-            variant_id = variant['studies'][0]['files'][0]['call']['variantId']
-        elif variant_type == "SNV":
-            # For SNVS, ref is stored under the ['id'] key
-            variant_id = variant['id']
-        else:
-            print("Could not determine variant type")
-
-        zygosity = variant['studies'][0]['samples'][0]['data'][0]
-
-        # Structure the variant information into a dictionary and add to a list
-        # of variants that have been reviewed for this case
-        data_dict = {
-            'variant_id': variant_id,
-            'type': variant_type,
-            'zygosity': zygosity
-            }
-        variant_list.append(data_dict)
-    return variant_list
+            variants. May be a generator of findings
+        outputs:
+            variant_list (list): a list of interpreted variants, as
+            VariantRecords
+    '''
+    return VariantRecord.from_findings(interpretation)
 
 
 def format_required_data_into_case_json(proband, sex, phenotypes, variants):
@@ -107,7 +292,7 @@ def format_required_data_into_case_json(proband, sex, phenotypes, variants):
             client
             sex (str): the proband sex
             phenotypes (list): a list of phenotype data
-            variants (list): a list of variant data
+            variants (iterable): a list, or generator, of variant data
         outputs:
             case_dict (dict): a dictionary of case information that is needed
             to submit the case to DECIPHER
@@ -146,6 +331,165 @@ def extract_clinvar_information(proband):
     return disorder, date_evaluated
 
 
+def write_case_batch(cases, study, oc, output_file,
+                     finding_lists=(PRIMARY_FINDINGS,), stream_findings=False):
+    '''
+    Pull many cases from OpenCGA and write the data needed to submit each one
+    to DECIPHER as one line of a newline-delimited JSON file
+        inputs:
+            cases (list): the case names in OpenCGA
+            study (str): the study that contains the cases
+            oc: an instance of the OpenCGA client, logged in with a user and
+            password
+            output_file (str): path of the NDJSON file to write
+            finding_lists (tuple): the finding lists to share
+            stream_findings (bool): if True, fetch the findings of each case
+            separately, one finding list at a time
+        outputs:
+            missing (list): the case IDs that were not found in OpenCGA
+    '''
+    include = case_include_fields(() if stream_findings else finding_lists)
+    missing = []
+    with open(output_file, 'w', encoding='utf-8') as f:
+        for case, clinical_analysis in extract_cases_from_opencga(
+            cases, study, oc, include=include
+        ):
+            if clinical_analysis is None:
+                print(f"Case {case} was not found in OpenCGA study {study}")
+                missing.append(case)
+                continue
+            findings = case_findings(
+                clinical_analysis, finding_lists, study,
+                oc if stream_findings else None
+            )
+            case_dict = {
+                'case_id': case,
+                **build_case_json(clinical_analysis, findings, stream_findings)
+            }
+            f.write(json.dumps(
+                case_dict, ensure_ascii=False, default=variant_record_json
+            ) + "\n")
+    return missing
+
+
+def login_to_opencga(configuration, host=OPENCGA_HOST):
+    '''
+    Create an OpenCGA client and log in with the user and password in the
+    OpenCGA configuration file
+        inputs:
+            configuration (str): path to the JSON file of OpenCGA login data
+            host (str): the OpenCGA host
+        outputs:
+            oc: an instance of the OpenCGA client, logged in
+    '''
+    # Extract and open JSON file containing OpenCGA login data
+    with open(configuration, 'r', encoding='utf-8') as f:
+        datastore = json.load(f)
+
+    # Retrieve keys from JSON
+    USER = datastore["USER"]
+    PASSWORD = datastore["PASSWORD"]
+
+    # Create an instance of OpencgaClient passing the configuration
+    config = ClientConfiguration({"rest": {"host": host}})
+    oc = OpencgaClient(config)
+    oc.login(user=USER, password=PASSWORD)
+    return oc
+
+
+def get_finding_lists(include_secondary_findings=False):
+    '''
+    Get the interpretation finding lists to share
+        inputs:
+            include_secondary_findings (bool): if True, share secondary
+            findings as well as primary findings
+        outputs:
+            finding_lists (tuple): the finding lists to share
+    '''
+    finding_lists = (PRIMARY_FINDINGS,)
+    if include_secondary_findings:
+        finding_lists += (SECONDARY_FINDINGS,)
+    return finding_lists
+
+
+def pull_case(case, study, oc, finding_lists=(PRIMARY_FINDINGS,),
+              stream_findings=False):
+    '''
+    Pull a case from OpenCGA and extract the data needed to submit it to
+    DECIPHER
+        inputs:
+            case (str): the case name in OpenCGA
+            study (str): the study that contains the case
+            oc: an instance of the OpenCGA client, logged in with a user and
+            password
+            finding_lists (tuple): the finding lists to share
+            stream_findings (bool): if True, fetch the findings separately,
+            one finding list at a time, and only as the variant list of the
+            case is read
+        outputs:
+            case_dict (dict): a dictionary of case information that is needed
+            to submit the case to DECIPHER
+    '''
+    case_from_opencga = extract_case_from_opencga(
+        case, study, oc,
+        case_include_fields(() if stream_findings else finding_lists)
+    )
+    results = case_from_opencga.get_results()
+    if not results:
+        raise RuntimeError(f"Case {case} was not found in OpenCGA study {study}")
+    clinical_analysis = results[0]
+    return build_case_json(
+        clinical_analysis,
+        case_findings(
+            clinical_analysis, finding_lists, study,
+            oc if stream_findings else None
+        ),
+        stream_findings
+    )
+
+
+def write_case_json(case_dict, output_file):
+    '''
+    Write the data needed to submit a case to DECIPHER to a JSON file
+        inputs:
+            case_dict (dict): the case information
+            output_file (str): path of the JSON file to write
+        outputs:
+            None
+    '''
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(
+            case_dict, f, ensure_ascii=False, indent=4,
+            default=variant_record_json
+        )
+
+
+def add_opencga_arguments(parser):
+    '''
+    Add the options for pulling cases from OpenCGA to a script's arguments
+        inputs:
+            parser: the argparse parser of the script
+        outputs:
+            None
+    '''
+    parser.add_argument("-s", "--study",
+                        help="OpenCGA study where this case is located"
+                        )
+    parser.add_argument("--host", default=OPENCGA_HOST,
+                        help="OpenCGA host to pull the case from"
+                        )
+    parser.add_argument("--include_secondary_findings", action="store_true",
+                        help="Share secondary findings as well as primary "
+                        "findings"
+                        )
+    parser.add_argument("--stream_findings", action="store_true",
+                        help="Fetch findings separately from the case, one "
+                        "finding list at a time, and parse each finding into "
+                        "a variant only as it is written or submitted, for "
+                        "cases with many findings"
+                        )
+
+
 def main():
     '''
     The entry point function of this script. Parses the command line arguments
@@ -163,46 +507,48 @@ def main():
     parser.add_argument("-c", "--case",
                         help="OpenCGA case ID that is to be uploaded to DECIPHER"
                         )
-    parser.add_argument("-s", "--study",
-                        help="OpenCGA study where this case is located"
+    parser.add_argument("--cases", nargs="+",
+                        help="OpenCGA case IDs to pull in one batch"
+                        )
+    parser.add_argument("--case_file",
+                        help="File of OpenCGA case IDs to pull in one batch, "
+                        "one per line"
                         )
+    parser.add_argument("--batch_output",
+                        default="case_phenotype_and_variant_data.ndjson",
+                        help="NDJSON file to write batch cases to, one case "
+                        "per line"
+                        )
+    add_opencga_arguments(parser)
 
     args = parser.parse_args()
 
-    # Extract and open JSON file containing OpenCGA login data
-    login_details = args.configuration
-    with open(login_details, 'r', encoding='utf-8') as f:
-        datastore = json.load(f)
-
-    # Retrieve keys from JSON
-    USER = datastore["USER"]
-    PASSWORD = datastore["PASSWORD"]
-
-    # Create an instance of OpencgaClient passing the configuration
-    config = ClientConfiguration(
-        {"rest": {"host": "https://uat.eglh.app.zettagenomics.com/opencga/"}}
-    )
-    oc = OpencgaClient(config)
-    oc.login(user=USER, password=PASSWORD)
+    oc = login_to_opencga(args.configuration, args.host)
+    finding_lists = get_finding_lists(args.include_secondary_findings)
 
-    case_from_opencga = extract_case_from_opencga(args.case, args.study, oc)
-    proband = case_from_opencga.get_result(result_pos=0)['proband']
-    interpretation = case_from_opencga.get_result(result_pos=0)['interpretation']['primaryFindings']
-
-    # Call functions to extract required data
-    sex = extract_proband_sex(proband)
-    phenotype_list = extract_proband_phenotypes(proband)
-    variant_list = extract_proband_variants(interpretation)
-
-    # Format the required data into a case dictionary
-    info_to_send_to_decipher = format_required_data_into_case_json(
-        proband, sex, phenotype_list, variant_list
+    # Pull a batch of cases over the one logged in client
+    if args.cases or args.case_file:
+        cases = read_case_ids(args.cases, args.case_file)
+        missing = write_case_batch(
+            cases, args.study, oc, args.batch_output, finding_lists,
+            args.stream_findings
+        )
+        print(
+            f"Wrote {len(cases) - len(missing)} of {len(cases)} cases to "
+            f"{args.batch_output}"
         )
+        if missing:
+            raise RuntimeError(
+                f"Cases not found in OpenCGA: {', '.join(missing)}"
+            )
+        return
 
-    with open(
-        'case_phenotype_and_variant_data.json', 'w', encoding='utf-8'
-    ) as f:
-        json.dump(info_to_send_to_decipher, f, ensure_ascii=False, indent=4)
+    info_to_send_to_decipher = pull_case(
+        args.case, args.study, oc, finding_lists, args.stream_findings
+    )
+    write_case_json(
+        info_to_send_to_decipher, 'case_phenotype_and_variant_data.json'
+    )
 
 
 if __name__ == "__main__":
@@ -1,8 +1,31 @@
 import json
-import requests
-from requests.adapters import HTTPAdapter, Retry
+import gzip
+import glob
 import argparse
 import os.path
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.exceptions import RequestException
+from api_client import (
+    add_session_arguments, configure_sessions, get_session,
+    parse_retry_after, positive_int, print_connection_stats
+)
+from checkpoint_store import (
+    open_store, mark_built, mark_submitted, get_submission_ids, get_local_ids
+)
+
+# Default maximum size in bytes of the combined clinvarSubmission array when
+# submitting variants in batches
+DEFAULT_BATCH_MAX_BYTES = 1000000
+
+# Written in place of a submission ID when a submission fails
+SUBMISSION_ERROR = 'Submission_error_check_logs'
+
+# Times a rate limited (429) submission is sent again before it is recorded
+# as failed, and the seconds to wait first if the API gives no Retry-After
+RATE_LIMIT_RETRIES = 5
+RATE_LIMIT_WAIT = 30
 
 
 def make_headers(api_key: str):
@@ -44,13 +67,15 @@ def select_api_url(testing):
     return api_url
 
 
-def clinvar_api_request(url, header, data):
+def clinvar_api_request(url, header, data, session=None):
     '''
     Make request to the ClinVar API endpoint specified.
     Inputs:
         url (str): API endpoint URL
         header (dict): headers for API call
         data (dict): clinvar data to submit
+        session: requests session to use, optional. The shared session for
+        the API host is used if not given
     Returns:
         response: API response object
     '''
@@ -65,9 +90,7 @@ def clinvar_api_request(url, header, data):
     print("JSON to submit:")
     print(json.dumps(clinvar_data, indent='⠀⠀'))
 
-    s = requests.Session()
-    retries = Retry(total=10, backoff_factor=0.5)
-    s.mount('https://', HTTPAdapter(max_retries=retries))
+    s = session or get_session(url)
     response = s.post(url, data=json.dumps(clinvar_data), headers=header)
     return response
 
@@ -98,7 +121,263 @@ def write_response_to_file(local_id, response):
             f.write(f'{local_id}\t{submission_id}\n')
     else:
         with open('submission_ids.txt', 'a', encoding='utf-8') as f:
-            f.write(f'{local_id}\tSubmission_error_check_logs\n')
+            f.write(f'{local_id}\t{SUBMISSION_ERROR}\n')
+
+
+def read_clinvar_ndjson(clinvar_ndjson):
+    '''
+    Read the data to submit to clinvar for each variant from a
+    newline-delimited JSON file made by pull_from_csv.py, one variant at a
+    time. Files ending in .gz are read as gzip compressed
+    Inputs:
+        clinvar_ndjson (str): path to NDJSON file
+    Outputs:
+        data: generator of dicts of clinvar data to submit, one per variant
+    '''
+    opener = gzip.open if str(clinvar_ndjson).endswith('.gz') else open
+    with opener(clinvar_ndjson, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def batch_clinvar_records(records, batch_size, max_bytes):
+    '''
+    Pack the data for many variants into combined submissions, each with up
+    to batch_size records in its clinvarSubmission array and at most
+    max_bytes of serialised records. Records can only share a submission if
+    the rest of their data (i.e. the assertion criteria of the submitting
+    lab) is the same. A record larger than max_bytes is submitted on its own
+    Inputs:
+        records: iterable of dicts of clinvar data, one per variant
+        batch_size (int): maximum number of records per submission
+        max_bytes (int): maximum size of the records in one submission
+    Outputs:
+        batch (dict): generator of dicts of clinvar data to submit, each with
+        one or more records in its clinvarSubmission array
+    '''
+    # Open batches keyed on the data shared by all records in the batch
+    open_batches = {}
+
+    for data in records:
+        shared = {k: v for k, v in data.items() if k != 'clinvarSubmission'}
+        key = json.dumps(shared, sort_keys=True)
+
+        for record in data['clinvarSubmission']:
+            record_bytes = len(json.dumps(record, ensure_ascii=False))
+            batch, batch_bytes = open_batches.get(key, (None, 0))
+
+            if batch is not None and (
+                len(batch['clinvarSubmission']) >= batch_size
+                or batch_bytes + record_bytes > max_bytes
+            ):
+                yield batch
+                batch, batch_bytes = None, 0
+
+            if batch is None:
+                batch = {'clinvarSubmission': [], **shared}
+
+            batch['clinvarSubmission'].append(record)
+            open_batches[key] = (batch, batch_bytes + record_bytes)
+
+    for batch, _ in open_batches.values():
+        if batch['clinvarSubmission']:
+            yield batch
+
+
+def find_clinvar_records(clinvar_input):
+    '''
+    Find the data to submit to clinvar from a directory of per-variant JSON
+    files made by pull_from_csv.py, a glob pattern matching JSON or NDJSON
+    files, or a single JSON or NDJSON file
+    Inputs:
+        clinvar_input (str): directory, glob pattern or file path
+    Outputs:
+        data: generator of dicts of clinvar data to submit
+    '''
+    if os.path.isdir(clinvar_input):
+        paths = sorted(
+            glob.glob(os.path.join(clinvar_input, '*_clinvar_data.json'))
+        )
+    elif os.path.isfile(clinvar_input):
+        paths = [clinvar_input]
+    else:
+        paths = sorted(glob.glob(clinvar_input))
+
+    if not paths:
+        raise RuntimeError(f"No ClinVar data found for {clinvar_input}")
+
+    for path in paths:
+        if path.endswith(('.ndjson', '.ndjson.gz', '.jsonl', '.jsonl.gz')):
+            yield from read_clinvar_ndjson(path)
+        else:
+            with open(path, encoding='utf-8') as f:
+                yield json.load(f)
+
+
+def post_clinvar_record(api_url, headers, data, session=None):
+    '''
+    Submit the data for one variant, or a batch of variants, to ClinVar. If
+    the API rate limits the submission it is sent again after the wait given
+    in its Retry-After header, up to RATE_LIMIT_RETRIES times. If the request
+    fails the error is returned in place of the API response so that it is
+    recorded as a failed submission
+    Inputs:
+        api_url (str): API endpoint URL
+        headers (dict): headers for API call
+        data (dict): clinvar data to submit
+        session: requests session to use, optional
+    Outputs:
+        response_dict (dict): response json from the ClinVar API
+    '''
+    try:
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            response = clinvar_api_request(api_url, headers, data, session)
+            if response.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+                break
+            wait = parse_retry_after(response.headers.get('Retry-After'))
+            if wait is None:
+                wait = RATE_LIMIT_WAIT
+            print(f"Submission rate limited, retrying in {wait} seconds")
+            time.sleep(wait)
+        response_dict = response.json()
+    except (RequestException, ValueError) as error:
+        response_dict = {'error': str(error)}
+
+    # print to logs, use braille blank character so DNAnexus won't strip
+    # whitespace
+    print(json.dumps(response_dict, indent='⠀⠀'))
+    return response_dict
+
+
+def write_clinvar_response(data, response_dict, store=None):
+    '''
+    Record the submission ID, or a submission error, against the local ID of
+    every variant in the submitted data in submission_ids.txt, and in the
+    checkpoint store if one is given
+    Inputs:
+        data (dict): clinvar data that was submitted
+        response_dict (dict): response json from the ClinVar API
+        store: connection to the checkpoint store, optional
+    Outputs:
+        None, modifies/creates file for upload to DNAnexus
+    '''
+    for record in data["clinvarSubmission"]:
+        write_response_to_file(record["localID"], response_dict)
+        if store is not None and 'id' in response_dict:
+            mark_submitted(store, record["localID"], response_dict['id'])
+
+
+def skip_submitted_records(records, store):
+    '''
+    Record each variant as built in the checkpoint store, and drop variants
+    that the store shows were submitted by an earlier run so that a
+    restarted run does not submit them again
+    Inputs:
+        records: iterable of dicts of clinvar data to submit
+        store: connection to the checkpoint store
+    Outputs:
+        data (dict): generator of dicts of clinvar data that still need to be
+        submitted
+    '''
+    submitted = get_submission_ids(store)
+    for data in records:
+        remaining = []
+        for record in data['clinvarSubmission']:
+            local_id = record['localID']
+            if local_id in submitted:
+                print(
+                    f"{local_id} already submitted as {submitted[local_id]}, "
+                    "skipping"
+                )
+            else:
+                mark_built(store, local_id)
+                remaining.append(record)
+        if remaining:
+            yield {**data, 'clinvarSubmission': remaining}
+
+
+def write_submission_ids_from_store(store):
+    '''
+    Rewrite submission_ids.txt with the submission ID of every variant in the
+    checkpoint store, so that it includes variants submitted by earlier runs
+    Inputs:
+        store: connection to the checkpoint store
+    Outputs:
+        None, creates file for upload to DNAnexus
+    '''
+    submission_ids = get_submission_ids(store)
+    with open('submission_ids.txt', 'w', encoding='utf-8') as f:
+        f.write('Local_ID\tClinVar_Submission_ID\n')
+        for local_id in get_local_ids(store):
+            submission_id = submission_ids.get(local_id, SUBMISSION_ERROR)
+            f.write(f'{local_id}\t{submission_id}\n')
+
+
+def submit_clinvar_record(api_url, headers, data, session=None):
+    '''
+    Submit the data for one variant, or a batch of variants, to ClinVar and
+    record the submission ID against the local ID of every variant in
+    submission_ids.txt
+    Inputs:
+        api_url (str): API endpoint URL
+        headers (dict): headers for API call
+        data (dict): clinvar data to submit
+        session: requests session to use, optional
+    Outputs:
+        response_dict (dict): response json from the ClinVar API
+    '''
+    response_dict = post_clinvar_record(api_url, headers, data, session)
+    write_clinvar_response(data, response_dict)
+    return response_dict
+
+
+def submit_clinvar_records(api_url, headers, records, max_in_flight=1,
+                           store=None):
+    '''
+    Submit many variants (or batches of variants) to ClinVar with up to
+    max_in_flight requests in progress at once. Responses are written to
+    submission_ids.txt in the same order as the input records, whatever
+    order the requests finish in
+    Inputs:
+        api_url (str): API endpoint URL
+        headers (dict): headers for API call
+        records: iterable of dicts of clinvar data to submit
+        max_in_flight (int): maximum number of concurrent requests
+        store: connection to the checkpoint store, optional
+    Outputs:
+        succeeded (int): number of submissions given a submission ID
+        failed (int): number of submissions that failed
+    '''
+    succeeded = 0
+    failed = 0
+    in_flight = deque()
+
+    def record_oldest():
+        nonlocal succeeded, failed
+        data, future = in_flight.popleft()
+        response_dict = future.result()
+        write_clinvar_response(data, response_dict, store)
+        if 'id' in response_dict:
+            succeeded += 1
+        else:
+            failed += 1
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for data in records:
+            in_flight.append((data, executor.submit(
+                post_clinvar_record, api_url, headers, data
+            )))
+            # Wait for the oldest request before reading more records so no
+            # more than max_in_flight requests are queued at once
+            if len(in_flight) >= max_in_flight:
+                record_oldest()
+
+        while in_flight:
+            record_oldest()
+
+    print(f"{succeeded} submissions succeeded, {failed} failed")
+    return succeeded, failed
 
 
 def main():
@@ -112,31 +391,76 @@ def main():
                                 )
                         )
 
-    parser.add_argument('--clinvar_json')
+    parser.add_argument(
+        '--clinvar_input',
+        help="Directory of per-variant JSON files, glob pattern, or JSON or "
+        "newline-delimited JSON (optionally gzipped) file of variants to "
+        "submit. All variants are submitted from this one process"
+    )
+    # Older names for --clinvar_input, kept so existing commands still work
+    parser.add_argument(
+        '--clinvar_json', '--clinvar_ndjson', dest='clinvar_input',
+        help="Deprecated, use --clinvar_input"
+    )
     parser.add_argument('--clinvar_api_key')
     parser.add_argument('--clinvar_testing')
+    parser.add_argument(
+        '--batch_size', type=int, default=1,
+        help="Maximum number of variants to submit to ClinVar in one "
+        "submission"
+    )
+    parser.add_argument(
+        '--batch_max_bytes', type=int, default=DEFAULT_BATCH_MAX_BYTES,
+        help="Maximum size in bytes of the variant records in one submission"
+    )
+    parser.add_argument(
+        '--max_in_flight', type=positive_int, default=1,
+        help="Maximum number of submissions to ClinVar in progress at once"
+    )
+    parser.add_argument(
+        '--state_db',
+        help="SQLite checkpoint store. Variants it records as submitted are "
+        "skipped, so an interrupted run can be restarted"
+    )
+    add_session_arguments(parser)
     args = parser.parse_args()
+    if not args.clinvar_input:
+        parser.error("--clinvar_input is required")
+
+    # Keep enough connections open for every concurrent submission
+    configure_sessions(
+        max(args.pool_size, args.max_in_flight), not args.no_keep_alive
+    )
 
     with open(args.clinvar_api_key) as f:
         api_key = f.readlines()[0].strip()
 
-    with open(args.clinvar_json) as f:
-        data = json.load(f)
+    records = find_clinvar_records(args.clinvar_input)
 
     api_url = select_api_url(args.clinvar_testing)
 
     headers = make_headers(api_key)
 
-    response = clinvar_api_request(api_url, headers, data)
-    response_dict = response.json()
+    store = None
+    if args.state_db:
+        store = open_store(args.state_db)
+        records = skip_submitted_records(records, store)
 
-    # print to logs, use braille blank character so DNAnexus won't strip
-    # whitespace
-    print(json.dumps(response_dict, indent='⠀⠀'))
+    if args.batch_size > 1:
+        records = batch_clinvar_records(
+            records, args.batch_size, args.batch_max_bytes
+        )
+
+    submit_clinvar_records(
+        api_url, headers, records, args.max_in_flight, store
+    )
 
-    local_id = data["clinvarSubmission"][0]["localID"]
+    if store is not None:
+        write_submission_ids_from_store(store)
+        # Closing the store writes its log back into the database file
+        store.close()
 
-    write_response_to_file(local_id, response_dict)
+    print_connection_stats()
 
 
 if __name__ == "__main__":
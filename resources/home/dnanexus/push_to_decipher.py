@@ -1,9 +1,20 @@
 #!/usr/bin/env python3
 import json                             # Need this to format response
 import argparse                         # To parse command line arguments
-import requests                         # This is needed to talk to the API
 import os                               # For export from script to shell
-from requests.adapters import HTTPAdapter, Retry
+from urllib.parse import urlencode      # To build patient search queries
+from itertools import islice           # To read variants a chunk at a time
+from api_client import (                # Shared sessions to talk to the API
+    add_session_arguments, configure_sessions, get_session, positive_int,
+    print_connection_stats
+)
+from hpo_index import (                 # To check HPO terms before submitting
+    load_hpo_index, normalise_phenotypes
+)
+from variant_record import as_variant_record  # Variants parsed once
+from reference_fasta import (           # To check REF alleles against genome
+    ReferenceFasta, find_ref_mismatches
+)
 
 # Base url
 API_URL = "https://www.deciphergenomics.org/api/"
@@ -14,11 +25,22 @@ PEOPLE_URL = "people"
 VARIANT_URL = "variants"
 PHENOTYPE_URL = "phenotypes"
 
+# Number of patients to request per page when looking up a patient
+PATIENT_PAGE_SIZE = 100
+
+# Number of variants to submit to DECIPHER in each request
+DEFAULT_VARIANT_CHUNK_SIZE = 50
+
+# Response statuses DECIPHER uses to reject invalid items in a request. Any
+# other failure, e.g. bad credentials or a server error, fails the case
+VALIDATION_ERROR_STATUSES = [400, 422]
+
 
 def decipher_api_request(req_type, url, header, data=None):
     '''
-    Make a DECIPHER API request.This function includes retries so can attempt
-    again if the DECIPHER API is temporarily offline
+    Make a DECIPHER API request using the shared session for the DECIPHER
+    host. This session includes retries so can attempt again if the DECIPHER
+    API is temporarily offline
         inputs:
             req_type (str): the API request type. This function only handles
             "GET" and "POST" as these are the only ones used in the script
@@ -30,9 +52,7 @@ def decipher_api_request(req_type, url, header, data=None):
         outputs:
             r: the API response
     '''
-    s = requests.Session()
-    retries = Retry(total=10, backoff_factor=0.5)
-    s.mount('https://', HTTPAdapter(max_retries=retries))
+    s = get_session(url)
     if req_type == "GET":
         r = s.get(url, headers=header)
     if req_type == "POST":
@@ -40,24 +60,104 @@ def decipher_api_request(req_type, url, header, data=None):
     return r
 
 
-def submit_patient_to_decipher(case, headers, submitter_id):
+def load_patient_cache(cache_file):
+    '''
+    Load the local cache of DECIPHER patients submitted by previous runs
+        inputs:
+            cache_file (str): path to the JSON cache file, optional
+        outputs:
+            patient_cache (dict): the person ID and patient ID of each
+            clinical reference, or an empty dictionary if there is no cache
+    '''
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+    with open(cache_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_patient_cache(patient_cache, cache_file):
+    '''
+    Save the local cache of DECIPHER patients so later runs can use it
+        inputs:
+            patient_cache (dict): the person ID and patient ID of each
+            clinical reference
+            cache_file (str): path to the JSON cache file
+        outputs:
+            None
+    '''
+    with open(cache_file, 'w', encoding='utf-8') as f:
+        json.dump(patient_cache, f, indent=4)
+
+
+def find_decipher_patient(proband_id, headers):
+    '''
+    Find an existing patient in DECIPHER by clinical reference. The patients
+    are filtered by clinical reference on the server, and every page of the
+    results is checked in case the filter is not applied
+        inputs:
+            proband_id (str): the clinical reference of the patient
+            headers (dict): the DECIPHER API request headers
+        outputs:
+            patient_person_id (int) = the Person ID of the patient in DECIPHER,
+            or None if the patient was not found
+            patient_id (int) = the Patient ID of the patient in DECIPHER, or
+            None if the patient was not found
+    '''
+    url = API_URL + PATIENT_URL + '?' + urlencode({
+        'filter[clinical_reference]': proband_id,
+        'page[size]': PATIENT_PAGE_SIZE
+    })
+    while url:
+        response = decipher_api_request("GET", url, headers)
+        response_json = json.loads(response.text)
+        for patient in response_json.get('data', []):
+            if patient['attributes']['clinical_reference'] == proband_id:
+                # Request the API to get the patient's "person ID" and
+                # patient ID
+                person_response = decipher_api_request(
+                    "GET",
+                    API_URL + PATIENT_URL + '/' + patient['id'] + '/people',
+                    headers
+                )
+                print(person_response.text)
+                person_response_json = json.loads(person_response.text)
+                person = person_response_json["data"][0]
+                return person["id"], person["attributes"]["patient_id"]
+        url = (response_json.get('links') or {}).get('next')
+    return None, None
+
+
+def submit_patient_to_decipher(case, headers, submitter_id,
+                               patient_cache=None):
     """
     Take the json made by the pull_from_opencga.py script and submit the
     patient information from this json to DECIPHER. This creates a patient 
     record for the proband or retrieves the patient ID if there is an existing
-    patient record
+    patient record. Patients in the local patient cache are not looked up in
+    DECIPHER again
         inputs:
             case (json) = the json from the pull_from_opencga.py script
             submitter_id (int) = the ID of the user submitting data to DECIPHER
+            patient_cache (dict) = the person ID and patient ID of patients
+            already submitted, by clinical reference; updated with this
+            patient. Optional
         outputs:
             patient_person_id (int) = the Person ID of the patient in DECIPHER
             patient_id (int) = the Patient ID of the patient in DECIPHER
     """
+    proband_id = case['clinical_reference']
+    if patient_cache is not None and proband_id in patient_cache:
+        print(
+            f'Patient with the clinical reference {proband_id} found in the '
+            'local patient cache'
+        )
+        cached = patient_cache[proband_id]
+        return cached['person_id'], cached['patient_id']
+
     patient_person_id = None
 
     # Extract patient info from case json and format into patient dictionary
     # compatible with DECIPHER API
-    proband_id = case['clinical_reference']
     attribute_dict = {
         'contact_account_id': submitter_id,
         'chromosomal_sex': case['sex'],
@@ -93,89 +193,211 @@ def submit_patient_to_decipher(case, headers, submitter_id):
                 f'{proband_id} already exists in decipher'
                 )
 
-            # If the patient exists, do an API "GET" request to get all the
-            # existing patients in DECIPHER
-            updated_response = decipher_api_request(
-                "GET", API_URL + PATIENT_URL, headers
-                )
-            updated_response_json = json.loads(updated_response.text)
-
-            # For each patient, check if the clinical reference number matches
-            # the current case
-            for patient in updated_response_json['data']:
-                if patient['attributes']['clinical_reference'] == proband_id:
-
-                    # If the the clinical reference numbers match, request
-                    # the API to get the patient's "person ID" and patient ID
-                    person_response = decipher_api_request(
-                        "GET",
-                        API_URL + PATIENT_URL + '/' + patient['id'] + '/people',
-                        headers
-                    )
-                    print(person_response.text)
-                    person_response_json = json.loads(person_response.text)
-                    patient_person_id = person_response_json["data"][0]["id"]
-                    patient_id = person_response_json["data"][0]["attributes"]["patient_id"]
-
-    # If the person ID has not been obtained by the previous for loop, aka
-    # the patient is not already in DECIPHER, set the patient ID and patient ID
+            # If the patient exists, look it up by its clinical reference
+            patient_person_id, patient_id = find_decipher_patient(
+                proband_id, headers
+            )
+
+    # If the person ID has not been obtained by the lookup, aka the patient
+    # is not already in DECIPHER, set the patient ID and patient ID
     if not patient_person_id:
         patient_person_id = response_json['data'][0]['relationships']['People']['data'][0]['id']
         patient_id = response_json['data'][0]["id"]
 
+    if patient_cache is not None:
+        patient_cache[proband_id] = {
+            'person_id': patient_person_id,
+            'patient_id': patient_id
+        }
+
     return patient_person_id, patient_id
 
 
-def submit_phenotypes_to_decipher(case, headers, patient_person_id):
+def pointer_index(error):
+    '''
+    Get the index of the array item that a JSON:API error refers to, from the
+    error's source pointer, e.g. "/data/3" refers to item 3
+        inputs:
+            error (dict): an error from a DECIPHER API response
+        outputs:
+            index (int): the index of the item the error refers to, or None if
+            the error does not point at an item of the array
+    '''
+    pointer = (error.get('source') or {}).get('pointer', '')
+    parts = pointer.strip('/').split('/')
+    if len(parts) >= 2 and parts[0] == 'data' and parts[1].isdigit():
+        return int(parts[1])
+    return None
+
+
+def post_json_api_array(url, headers, items):
+    '''
+    POST an array of items to a DECIPHER JSON:API endpoint. Raises an error
+    if the request fails for any reason other than DECIPHER rejecting invalid
+    items, e.g. bad credentials or a server error
+        inputs:
+            url (str): the API url
+            headers (dict): the DECIPHER API request headers
+            items (list): (id, item) tuples to submit
+        outputs:
+            errors (list): the validation errors in the response, empty if the
+            items were all accepted
+    '''
+    data_json = json.dumps({"data": [item for _, item in items]})
+    response = decipher_api_request("POST", url, headers, data_json)
+    print(response.text)
+    if response.ok:
+        return []
+
+    errors = None
+    if response.status_code in VALIDATION_ERROR_STATUSES:
+        try:
+            errors = json.loads(response.text).get('errors')
+        except (ValueError, AttributeError):
+            pass
+    if not errors:
+        raise RuntimeError(
+            f"DECIPHER request to {url} failed with HTTP "
+            f"{response.status_code}: {response.text}"
+        )
+    return errors
+
+
+def submit_json_api_array(url, headers, items):
+    '''
+    Submit an array of items to a DECIPHER JSON:API endpoint, leaving out any
+    items DECIPHER rejects as invalid. DECIPHER rejects the whole array if
+    any item in it is invalid, so after a validation error:
+        - every item an error points at is removed at once and the rest of
+          the array is submitted again
+        - if no error points at an item, the array is split in half and each
+          half submitted separately, so n items with a few bad ones take
+          O(log n) requests to isolate the bad ones
+    Any other failed request raises an error, so the case fails rather than
+    its items being reported as invalid
+        inputs:
+            url (str): the API url
+            headers (dict): the DECIPHER API request headers
+            items (list): (id, item) tuples to submit, where id identifies the
+            item in reports, e.g. a variant_id or HPO term
+        outputs:
+            skipped (list): a dictionary for each item that could not be
+            submitted, with the endpoint, the id, the error detail(s) and the
+            item's attributes
+    '''
+    resource = url.rstrip('/').rpartition('/')[-1]
+    skipped = []
+
+    def skip(item, details):
+        print(
+            f"{item[0]} could not be submitted to DECIPHER {resource}: "
+            + "; ".join(str(detail) for detail in details)
+        )
+        skipped.append({
+            'resource': resource,
+            'id': item[0],
+            'detail': details,
+            'attributes': item[1].get('attributes')
+        })
+
+    to_submit = [items] if items else []
+    while to_submit:
+        batch = to_submit.pop()
+        errors = post_json_api_array(url, headers, batch)
+        if not errors:
+            continue
+
+        pointed = {}
+        for error in errors:
+            index = pointer_index(error)
+            if index is not None and index < len(batch):
+                pointed.setdefault(index, []).append(error.get('detail'))
+
+        if pointed:
+            for index, details in sorted(pointed.items()):
+                skip(batch[index], details)
+            remaining = [
+                item for index, item in enumerate(batch)
+                if index not in pointed
+            ]
+            if remaining:
+                to_submit.append(remaining)
+        elif len(batch) == 1:
+            skip(batch[0], [error.get('detail') for error in errors])
+        else:
+            middle = len(batch) // 2
+            to_submit += [batch[middle:], batch[:middle]]
+    return skipped
+
+
+def write_skipped_items(skipped, skipped_file):
+    '''
+    Write the items that could not be submitted to DECIPHER to a JSON file
+        inputs:
+            skipped (list): the skipped items from submit_json_api_array()
+            skipped_file (str): path of the JSON file to write
+        outputs:
+            None
+    '''
+    with open(skipped_file, 'w', encoding='utf-8') as f:
+        json.dump(skipped, f, indent=4)
+
+
+def submit_phenotypes_to_decipher(case, headers, patient_person_id,
+                                  hpo_index=None, prune_ancestors=False):
     """
     Take the json made by the pull_from_opencga.py script and submit the
-    phenotype information from this json to DECIPHER.
+    phenotype information from this json to DECIPHER. If an HPO index is
+    given, the terms are checked against it first so that obsolete and
+    alternative IDs are submitted as their current ID and unknown terms are
+    not submitted
         inputs:
             case (json) = the json from the pull_from_opencga.py script
             patient_person_id (int) = the Person ID of the proband in DECIPHER
+            hpo_index (HpoIndex) = the HPO index to check terms against.
+            Optional
+            prune_ancestors (bool) = if True, terms implied by a more specific
+            term in the case are not submitted. Needs an HPO index
         outputs:
-            None
+            skipped (list) = the phenotypes that could not be submitted, as
+            described in submit_json_api_array(), with the HPO term as id
     """
-    # If the case has phenotypes, submit the phenotypes to DECIPHER
-    # Define empty list to submit as data input to DECIPHER API
+    phenotypes = case.get('phenotype_list', [])
+    skipped = []
+    if hpo_index is not None:
+        phenotypes, rejected = normalise_phenotypes(
+            phenotypes, hpo_index, prune_ancestors
+        )
+        for phenotype in rejected:
+            print(
+                f"{phenotype} is not a current HPO term and will not be "
+                "submitted to DECIPHER"
+            )
+            skipped.append({
+                'resource': PHENOTYPE_URL,
+                'id': phenotype,
+                'detail': ['Not a current HPO term in the HPO ontology'],
+                'attributes': None
+            })
+
+    # Format the phenotypes from the case json for the DECIPHER API
     phenotypes_to_submit = []
-
-    # Populate this list from the case json
-    for phenotype in case.get('phenotype_list', []):
-        phenotypes_to_submit.append({
+    for phenotype in phenotypes:
+        phenotypes_to_submit.append((phenotype, {
             "type": "Phenotype",
             "attributes": {
                 "person_id": patient_person_id,
                 "hpo_term_id": phenotype.strip("HP:"),
                 "is_present": True},
-        })
-    phen_data = {"data": phenotypes_to_submit}
-    print(phen_data)
+        }))
 
-    # Submit phenotypes to DECIPHER
-    phenotype_json = json.dumps(phen_data)
-    phen_response = decipher_api_request(
-        "POST", API_URL + PHENOTYPE_URL, headers, phenotype_json
-    )
+    # Submit phenotypes to DECIPHER, leaving out any invalid HPO terms.
+    # Missing phenotypes can be added manually in the GUI
     print("Querying " + API_URL + PHENOTYPE_URL)
-    phen_response_json = json.loads(phen_response.text)
-    print(phen_response_json)
-
-    if 'errors' in phen_response_json.keys():
-        if phen_response_json['errors'][0]['detail'] == 'Invalid HPO term':
-            # If one of the HPO terms is not valid, remove it from the
-            # phenotype dictionary and submit the other terms
-            # Missing phenotypes can be added manually in the GUI
-            invalid_hpo = phen_response_json['errors'][0]['source']["pointer"].rpartition('/')[-1]
-            print(invalid_hpo)
-            print(phen_data["data"][int(invalid_hpo)])
-            del phen_data["data"][int(invalid_hpo)]
-            print(phen_data)
-            phenotype_json = json.dumps(phen_data)
-            phen_response = decipher_api_request(
-                "POST", API_URL + PHENOTYPE_URL, headers, phenotype_json
-            )
-            print(phen_response.text)
+    skipped.extend(submit_json_api_array(
+        API_URL + PHENOTYPE_URL, headers, phenotypes_to_submit
+    ))
+    return skipped
 
 
 def calculate_variant_type(variant):
@@ -203,26 +425,27 @@ def calculate_zygosity(variant, sex):
     '''
     Work out the zygosity from the OpenCGA case json for the case['variant']
         input:
-            a variant
+            a variant, as a VariantRecord or a variant dictionary from the
+            case json
         output:
             zygosity (str): the zygosity of the variant or None if the input
             for zygosity is invalid.
     '''
-    # Split on '/' or '|' and store as a two-item list
-    variant_index = variant["zygosity"].replace("|", "/").split("/")
+    variant = as_variant_record(variant)
+    variant_index = variant.genotype
 
-    # If the first and second item in this list are not equal then it is
-    # heterozygous, if they are different it is homozygous
-    if variant_index[0] != variant_index[1]:
+    # If the alleles in the genotype are not all equal then it is
+    # heterozygous, if they are the same it is homozygous
+    if len(set(variant_index)) > 1:
         zygosity = "heterozygous"
-    elif variant_index[0] == variant_index[1]:
+    elif variant_index:
         zygosity = "homozygous"
     else:
         print(f"Could not determine zygosity from the input {variant_index}")
         zygosity = None
 
     # handle hemizygous variants if patient sex is male
-    if sex == "46_xy" and variant["variant_id"].split(":")[0] in ['X', 'Y']:
+    if sex == "46_xy" and variant.chrom in ['X', 'Y']:
         zygosity = "hemizygous"
 
     return zygosity
@@ -232,7 +455,8 @@ def format_variant_json_for_decipher(variant, person_id, zygosity, var_type):
     '''
     Formats the variant info into a DECIPHER-compatible dictionary
         inputs:
-            variant: the variant from the OpenCGA case json
+            variant: the variant, as a VariantRecord or a variant dictionary
+            from the OpenCGA case json
             patient_person_id: the person ID of the patient record in DECIPHER
             to which these variants should be added.
             zygosity: the zygosity of the variant
@@ -240,70 +464,129 @@ def format_variant_json_for_decipher(variant, person_id, zygosity, var_type):
         outputs:
             variant_dict: a variant dictonary which is in the format needed for
             submission to the DECIPHER API
-
     '''
-    # Split the variant zygosity on '/' or '|' and store as a two-item list
-    variant_index = variant["zygosity"].replace("|", "/").split("/")
+    variant = as_variant_record(variant)
 
-    # The variant index will have two of the same value if the variant
-    # is homozygous. Using set(variant_index) removes duplicate variant
-    # indices ensuring that homozygous variants are not submitted twice
-    variant_dict_list = []
+    # Each distinct non-zero allele index in the genotype is an alt allele
+    # the proband has, so homozygous variants are not submitted twice. If the
+    # zygosity were 0/0 this function should return None
+    alt_indices = variant.alt_indices()
+    if not alt_indices:
+        return None
 
-    # If the zygosity were 0/0 this function should return None
-    if set(variant_index) == {"0"}:
-        variant_dict_list = None
-
-    for i in sorted(set(variant_index)):
-        # All non-zero indices indicate that that variant exists
-        # and should be submitted to DECIPHER
-        if i != "0":
-            # If the index is not zero go to that index in the
-            # variant nomenclature and submit that variant
-            variant_dict = {"data": {
-                    "type": "Variant",
-                    "attributes": {
-                        "person_id": person_id,
-                        "variant_class": var_type,
-                        "assembly": "GRCh38",
-                        "chr": variant["variant_id"].split(":")[0],
-                        "start": variant["variant_id"].split(":")[1],
-                        "ref_sequence": variant["variant_id"].split(":")[2],
-                        "alt_sequence": variant["variant_id"].split(":")[3].split(",")[int(i)-1],
-                        "inheritance": "unknown",
-                        "genotype": zygosity,
-                        "can_be_public": False,
-                    }
-                }}
-            variant_dict_list.append(variant_dict)
+    variant_dict_list = []
+    for i in alt_indices:
+        # Go to that index in the alt alleles and submit that variant
+        variant_dict = {"data": {
+                "type": "Variant",
+                "attributes": {
+                    "person_id": person_id,
+                    "variant_class": var_type,
+                    "assembly": "GRCh38",
+                    "chr": variant.chrom,
+                    "start": str(variant.pos),
+                    "ref_sequence": variant.ref,
+                    "alt_sequence": variant.alts[i - 1],
+                    "inheritance": "unknown",
+                    "genotype": zygosity,
+                    "can_be_public": False,
+                }
+            }}
+        variant_dict_list.append(variant_dict)
 
     return variant_dict_list
 
 
-def submit_variants_to_decipher(case, headers, patient_person_id):
+def submit_variants_to_decipher(case, headers, patient_person_id,
+                                chunk_size=DEFAULT_VARIANT_CHUNK_SIZE,
+                                reference=None):
     """
     Take the json made by the pull_from_opencga.py script and submit the
-    variant information from this json to DECIPHER.
+    variant information from this json to DECIPHER. Variants are submitted
+    as arrays of up to chunk_size alleles, leaving out any that DECIPHER
+    rejects. If a reference genome is given, the REF of every variant is
+    checked against it first and variants that don't match are not submitted.
+    The variant list is read chunk_size variants at a time, so a variant list
+    streamed from OpenCGA is submitted as it is read rather than held in full
         inputs:
             case (json) = the json from the pull_from_opencga.py script
             patient_person_id (int) = the Person ID of the proband in DECIPHER
+            chunk_size (int) = the number of alleles to submit per request
+            reference (ReferenceFasta) = the GRCh38 reference genome to check
+            REF alleles against. Optional
         outputs:
-            None
+            skipped (list) = the alleles that could not be submitted, as
+            described in submit_json_api_array(), with the variant_id as id
     """
-    for variant in case['variant_list']:
-        variant_type = calculate_variant_type(variant)
-        zygosity = calculate_zygosity(variant, case["sex"])
-
-        # Submit variants only if variant type and zygosity have been worked
-        # out correctly
-        if variant_type and zygosity is not None:
-            variant_dict_list = format_variant_json_for_decipher(variant, patient_person_id, zygosity, variant_type)
-            for variant_dict in variant_dict_list:
-                variant_json_to_submit = json.dumps(variant_dict)
-                response = decipher_api_request(
-                    "POST", API_URL + VARIANT_URL, headers, variant_json_to_submit
+    if chunk_size < 1:
+        raise ValueError(
+            f"Variant chunk size {chunk_size} is not a positive whole number"
+        )
+    skipped = []
+
+    def check_ref(variants):
+        mismatches = find_ref_mismatches(reference, (
+            (i, variant.chrom, variant.pos, variant.ref)
+            for i, variant in enumerate(variants)
+        ))
+        for i, sequence in mismatches:
+            variant = variants[i]
+            detail = (
+                f"Reference allele {variant.ref} does not match GRCh38, "
+                f"which is {sequence}" if sequence else
+                f"{variant.chrom}:{variant.pos} is not in GRCh38"
+            )
+            print(f"{variant.variant_id} will not be submitted: {detail}")
+            skipped.append({
+                'resource': VARIANT_URL,
+                'id': variant.variant_id,
+                'detail': [detail],
+                'attributes': None
+            })
+        mismatched = {i for i, _ in mismatches}
+        return [
+            variant for i, variant in enumerate(variants)
+            if i not in mismatched
+        ]
+
+    # Parse each variant once for the REF check, zygosity and payload builders
+    variant_list = (
+        as_variant_record(variant) for variant in case['variant_list']
+    )
+    alleles = []
+    while True:
+        variants = list(islice(variant_list, chunk_size))
+        if not variants:
+            break
+        if reference is not None:
+            variants = check_ref(variants)
+
+        # Format every allele to submit, keeping the variant it came from so
+        # errors can be reported against it
+        for variant in variants:
+            variant_type = calculate_variant_type(variant)
+            zygosity = calculate_zygosity(variant, case["sex"])
+
+            # Submit variants only if variant type and zygosity have been
+            # worked out correctly
+            if variant_type and zygosity is not None:
+                variant_dict_list = format_variant_json_for_decipher(
+                    variant, patient_person_id, zygosity, variant_type
                 )
-                print(response.text)
+                for variant_dict in variant_dict_list or []:
+                    alleles.append((variant.variant_id, variant_dict['data']))
+
+        while len(alleles) >= chunk_size:
+            skipped.extend(submit_json_api_array(
+                API_URL + VARIANT_URL, headers, alleles[:chunk_size]
+            ))
+            alleles = alleles[chunk_size:]
+
+    if alleles:
+        skipped.extend(submit_json_api_array(
+            API_URL + VARIANT_URL, headers, alleles
+        ))
+    return skipped
 
 
 def create_decipher_url(patient_id):
@@ -319,6 +602,154 @@ def create_decipher_url(patient_id):
     return decipher_url
 
 
+def read_decipher_headers(keys_file):
+    '''
+    Read the DECIPHER API keys and make the headers for DECIPHER API requests
+        inputs:
+            keys_file (str): path to the JSON file containing the DECIPHER
+            client key and user key
+        outputs:
+            headers (dict): the DECIPHER API request headers
+    '''
+    with open(keys_file, 'r', encoding='utf-8') as f:
+        decipher_api_keys = json.load(f)
+
+    # Retrieve keys from JSON and set as headers for API call
+    CLIENT_KEY = decipher_api_keys["CLIENT_KEY"]
+    USER_KEY = decipher_api_keys["USER_KEY"]
+
+    return {
+        "Content-Type": "application/vnd.api+json",
+        "X-Auth-Token-Client": CLIENT_KEY,
+        "X-Auth-Token-Account": USER_KEY
+    }
+
+
+def submit_case_to_decipher(case, headers, submitter_id, patient_cache=None,
+                            hpo_index=None, prune_ancestors=False,
+                            chunk_size=DEFAULT_VARIANT_CHUNK_SIZE,
+                            reference=None):
+    '''
+    Submit a case to DECIPHER: create or find the patient, then add the
+    phenotypes and variants
+        inputs:
+            case (dict): the case data, as made by pull_from_opencga.py
+            headers (dict): the DECIPHER API request headers
+            submitter_id (int): the ID of the user submitting data to DECIPHER
+            patient_cache (dict): the local patient cache, optional
+            hpo_index (HpoIndex): the HPO index to check terms against,
+            optional
+            prune_ancestors (bool): if True, don't submit HPO terms implied by
+            a more specific term in the case
+            chunk_size (int): the number of alleles to submit per request
+            reference (ReferenceFasta): the GRCh38 reference genome to check
+            REF alleles against, optional
+        outputs:
+            patient_id (int): the Patient ID of the patient in DECIPHER
+            skipped (list): the phenotypes and variants that could not be
+            submitted
+    '''
+    # Create the patient, retrieving the Person ID (needed to add variants
+    # and phenotypes) and the Patient ID (needed to generate a URL to the
+    # patient record in DECIPHER)
+    person_id, patient_id = submit_patient_to_decipher(
+        case, headers, submitter_id, patient_cache
+        )
+
+    # Submit variants and phenotypes
+    skipped = submit_phenotypes_to_decipher(
+        case, headers, person_id, hpo_index, prune_ancestors
+        )
+    skipped += submit_variants_to_decipher(
+        case, headers, person_id, chunk_size, reference
+        )
+    return patient_id, skipped
+
+
+def add_decipher_arguments(parser):
+    '''
+    Add the options for submitting cases to DECIPHER to a script's arguments
+        inputs:
+            parser: the argparse parser of the script
+        outputs:
+            None
+    '''
+    parser.add_argument(
+        "--patient_cache",
+        help="JSON file caching the DECIPHER IDs of patients already "
+        "submitted; read if it exists and updated with this patient"
+        )
+    parser.add_argument(
+        "--hpo_ontology",
+        help="HPO ontology (hp.obo or hp.json) or an index built from it, "
+        "to check phenotype terms against before submitting them"
+        )
+    parser.add_argument(
+        "--prune_hpo_ancestors", action="store_true",
+        help="Don't submit HPO terms implied by a more specific term in the "
+        "case. Needs --hpo_ontology"
+        )
+    parser.add_argument(
+        "--skipped_items", default="decipher_skipped_items.json",
+        help="JSON file to write the phenotypes and variants that could not "
+        "be submitted to"
+        )
+    parser.add_argument(
+        "--variant_chunk_size", type=positive_int,
+        default=DEFAULT_VARIANT_CHUNK_SIZE,
+        help="Number of variant alleles to submit to DECIPHER per request"
+        )
+    parser.add_argument(
+        "--reference_fasta",
+        help="Indexed GRCh38 reference FASTA, plain or bgzip compressed, to "
+        "check the REF of variants against before submitting them"
+        )
+    add_session_arguments(parser)
+
+
+def run_decipher_submission(case, headers, args):
+    '''
+    Submit a case to DECIPHER with the options given on the command line,
+    then write the skipped items and the link to the patient record
+        inputs:
+            case (dict): the case data, as made by pull_from_opencga.py
+            headers (dict): the DECIPHER API request headers
+            args: parsed command line arguments, including the options from
+            add_decipher_arguments() and the submitter ID
+        outputs:
+            None
+    '''
+    patient_cache = load_patient_cache(args.patient_cache)
+    hpo_index = None
+    if args.hpo_ontology:
+        hpo_index = load_hpo_index(args.hpo_ontology)
+    reference = None
+    if args.reference_fasta:
+        reference = ReferenceFasta(args.reference_fasta)
+
+    decipher_patient_id, skipped = submit_case_to_decipher(
+        case, headers, args.submitter, patient_cache, hpo_index,
+        args.prune_hpo_ancestors, args.variant_chunk_size, reference
+        )
+    if args.patient_cache:
+        save_patient_cache(patient_cache, args.patient_cache)
+
+    # Record anything that could not be submitted so it can be added to
+    # DECIPHER manually
+    write_skipped_items(skipped, args.skipped_items)
+    if skipped:
+        print(
+            f"{len(skipped)} item(s) could not be submitted to DECIPHER, see "
+            f"{args.skipped_items}"
+        )
+
+    # Generate URL linking the patient in DECIPHER and add to text file so it
+    # can be uploaded as an output by the pandora.sh script
+    link_to_patient_in_decipher = create_decipher_url(decipher_patient_id)
+    with open('decipher_url.txt', 'w', encoding='utf-8') as f:
+        f.write(link_to_patient_in_decipher)
+
+
 def main():
     '''
     The entry point function of this script. Parses the command line arguments
@@ -336,49 +767,22 @@ def main():
     parser.add_argument("-k", "--configuration", help="API keys for DECIPHER")
     parser.add_argument("-c", "--data_for_decipher", help="case data JSON")
     parser.add_argument("-s", "--submitter", help="DECIPHER submitter ID")
+    add_decipher_arguments(parser)
 
     args = parser.parse_args()
 
-    # Extract and open JSON file containing API keys
-    decipher_api_keys_file = args.configuration
-    with open(decipher_api_keys_file, 'r', encoding='utf-8') as f:
-        decipher_api_keys = json.load(f)
-
-    # Retrieve keys from JSON and set as headers for API call
-    CLIENT_KEY = decipher_api_keys["CLIENT_KEY"]
-    USER_KEY = decipher_api_keys["USER_KEY"]
-
-    decipher_api_request_headers = {
-        "Content-Type": "application/vnd.api+json",
-        "X-Auth-Token-Client": CLIENT_KEY,
-        "X-Auth-Token-Account": USER_KEY
-    }
+    configure_sessions(args.pool_size, not args.no_keep_alive)
+    decipher_api_request_headers = read_decipher_headers(args.configuration)
 
     # Access data from JSON created by pull_from_opencga.py script
     data_to_submit = args.data_for_decipher
     with open(data_to_submit, 'r', encoding='utf-8') as f:
         data_to_submit_json = json.load(f)
 
-    # Submit this to the function that creates a patient, retrieving the Person
-    # ID (needed to add variants and phenotypes) and the Patient ID (needed to
-    # generate a URL to the patient record in DECIPHER)
-    decipher_person_id, decipher_patient_id = submit_patient_to_decipher(
-        data_to_submit_json, decipher_api_request_headers, args.submitter
-        )
-
-    # Submit variants and phenotypes from JSON created by pull_from_opencga.py
-    submit_phenotypes_to_decipher(
-        data_to_submit_json, decipher_api_request_headers, decipher_person_id
-        )
-    submit_variants_to_decipher(
-        data_to_submit_json, decipher_api_request_headers, decipher_person_id
-        )
-
-    # Generate URL linking the patient in DECIPHER and add to text file so it
-    # can be uploaded as an output by the pandora.sh script
-    link_to_patient_in_decipher = create_decipher_url(decipher_patient_id)
-    with open('decipher_url.txt', 'w', encoding='utf-8') as f:
-        f.write(link_to_patient_in_decipher)
+    run_decipher_submission(
+        data_to_submit_json, decipher_api_request_headers, args
+    )
+    print_connection_stats()
 
 
 if __name__ == "__main__":
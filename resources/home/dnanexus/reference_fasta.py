@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Random access to a reference genome FASTA, used to check the reference
+alleles of variants against the genome before they are submitted to ClinVar
+or DECIPHER.
+
+The FASTA needs a samtools faidx index (.fai) next to it. It can be plain
+text, or bgzip compressed with its .gzi block index too (made with
+bgzip -i, or samtools faidx on the compressed file). The file is
+memory-mapped when first used, and only the lines (or compressed blocks)
+holding the requested bases are read, so the genome is never loaded into
+memory.
+
+Reference FASTAs are given as ASSEMBLY=PATH, e.g. GRCh38=GRCh38.fa.gz, so
+each genome build a variant can be on maps to its own FASTA.
+"""
+import mmap
+import struct
+import threading
+import zlib
+from bisect import bisect_right
+from functools import lru_cache
+
+# Number of decompressed bgzip blocks of 64 KB kept for nearby lookups
+BGZF_CACHE_BLOCKS = 64
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+
+# Other names a chromosome may have in a FASTA
+CHROMOSOME_ALIASES = {"MT": "chrM", "M": "chrM", "chrM": "MT", "chrMT": "MT"}
+
+
+def read_fai(fai_file):
+    '''
+    Read a samtools faidx index
+        inputs:
+            fai_file (str): path to the .fai index
+        outputs:
+            sequences (dict): for each sequence name, its length, the offset
+            of its first base, the bases per line and the bytes per line
+    '''
+    sequences = {}
+    with open(fai_file, "r", encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 5:
+                sequences[fields[0]] = tuple(int(x) for x in fields[1:5])
+    return sequences
+
+
+def read_gzi(gzi_file):
+    '''
+    Read a bgzip block index
+        inputs:
+            gzi_file (str): path to the .gzi index
+        outputs:
+            compressed (list): offset of each block in the compressed file
+            uncompressed (list): offset of each block in the uncompressed
+            data, in the same order
+    '''
+    with open(gzi_file, "rb") as f:
+        data = f.read()
+    count, = struct.unpack_from("<Q", data)
+    offsets = struct.unpack_from(f"<{2 * count}Q", data, 8)
+    # The first block is not in the index
+    return [0, *offsets[0::2]], [0, *offsets[1::2]]
+
+
+class ReferenceFasta:
+    """
+    Read-only view of an indexed reference FASTA. The file is memory-mapped
+    the first time a sequence is read, and can then be shared between
+    threads
+    """
+
+    def __init__(self, fasta_file):
+        self.fasta_file = fasta_file
+        self._sequences = read_fai(f"{fasta_file}.fai")
+        self._mmap = None
+        self._lock = threading.Lock()
+        with open(fasta_file, "rb") as f:
+            self._bgzf = f.read(len(BGZF_MAGIC)) == BGZF_MAGIC
+        if self._bgzf:
+            self._compressed, self._uncompressed = read_gzi(
+                f"{fasta_file}.gzi"
+            )
+            self._block = lru_cache(maxsize=BGZF_CACHE_BLOCKS)(
+                self._read_block
+            )
+
+    def _load(self):
+        if self._mmap is not None:
+            return
+        with self._lock:
+            if self._mmap is None:
+                with open(self.fasta_file, "rb") as f:
+                    self._mmap = mmap.mmap(
+                        f.fileno(), 0, access=mmap.ACCESS_READ
+                    )
+
+    def _read_block(self, offset):
+        # The BSIZE field of a bgzip block header is its size minus one
+        size = struct.unpack_from("<H", self._mmap, offset + 16)[0] + 1
+        return zlib.decompress(self._mmap[offset:offset + size], 31)
+
+    def _read(self, start, end):
+        self._load()
+        if not self._bgzf:
+            return self._mmap[start:end]
+
+        # Decompress the blocks holding the uncompressed byte range
+        block = bisect_right(self._uncompressed, start) - 1
+        position = self._uncompressed[block]
+        offset = self._compressed[block]
+        data = []
+        while position < end and offset < len(self._mmap):
+            block_data = self._block(offset)
+            if not block_data:
+                break
+            data.append(block_data)
+            position += len(block_data)
+            offset += struct.unpack_from("<H", self._mmap, offset + 16)[0] + 1
+        skip = start - self._uncompressed[block]
+        return b"".join(data)[skip:skip + end - start]
+
+    def sequence_name(self, chrom):
+        '''
+        Get the name a chromosome has in the FASTA, which may or may not have
+        a chr prefix
+            inputs:
+                chrom (str): the chromosome, e.g. 7, chr7 or MT
+            outputs:
+                name (str): the name of the sequence in the FASTA, or None if
+                the FASTA has no such sequence
+        '''
+        chrom = str(chrom)
+        for name in (
+            chrom, f"chr{chrom}", chrom[3:] if chrom.startswith("chr") else
+            None, CHROMOSOME_ALIASES.get(chrom)
+        ):
+            if name in self._sequences:
+                return name
+        return None
+
+    def fetch(self, chrom, position, length):
+        '''
+        Get bases of the reference genome
+            inputs:
+                chrom (str): the chromosome
+                position (int): the 1-based position of the first base
+                length (int): the number of bases
+            outputs:
+                sequence (str): the bases, in upper case, or None if the
+                chromosome is not in the FASTA or the bases are off its end
+        '''
+        name = self.sequence_name(chrom)
+        if name is None or position < 1:
+            return None
+        sequence_length, offset, line_bases, line_bytes = \
+            self._sequences[name]
+        if position - 1 + length > sequence_length:
+            return None
+
+        def byte(base):
+            return offset + base // line_bases * line_bytes + base % line_bases
+
+        first = position - 1
+        data = self._read(byte(first), byte(first + length - 1) + 1)
+        return data.replace(b"\n", b"").replace(b"\r", b"").decode().upper()
+
+    def close(self):
+        if self._mmap is not None:
+            if self._bgzf:
+                self._block.cache_clear()
+            self._mmap.close()
+            self._mmap = None
+
+
+def find_ref_mismatches(reference, variants):
+    '''
+    Check the reference alleles of many variants against a reference genome.
+    Variants are looked up in genome order, so the FASTA is read from start
+    to end rather than jumping back and forth. Alleles that are not bases,
+    e.g. a dash for an insertion, are not checked
+        inputs:
+            reference (ReferenceFasta): the reference genome
+            variants (iterable): a (key, chrom, position, ref) tuple for each
+            variant, where key is anything used to identify the variant
+        outputs:
+            mismatches (list): a (key, genome_sequence) tuple for each
+            variant whose ref does not match the genome, in the order given,
+            with a genome_sequence of None if the position is not in the
+            genome
+    '''
+    variants = list(variants)
+    genome_order = sorted(
+        range(len(variants)),
+        key=lambda i: (str(variants[i][1]), int(variants[i][2]))
+    )
+    mismatches = {}
+    for i in genome_order:
+        _, chrom, position, ref = variants[i]
+        ref = str(ref).upper()
+        if not ref.isalpha():
+            continue
+        sequence = reference.fetch(chrom, int(position), len(ref))
+        if sequence != ref:
+            mismatches[i] = sequence
+    return [(variants[i][0], mismatches[i]) for i in sorted(mismatches)]
+
+
+def parse_reference_fastas(values):
+    '''
+    Read reference FASTA options of the form ASSEMBLY=PATH
+        inputs:
+            values (list): the options, e.g. ["GRCh38=GRCh38.fa.gz"]
+        outputs:
+            fastas (dict): the path of the FASTA for each assembly
+    '''
+    fastas = {}
+    for value in values or []:
+        assembly, separator, path = value.partition("=")
+        if not separator or not assembly or not path:
+            raise ValueError(
+                f"Reference FASTA {value} should be given as ASSEMBLY=PATH, "
+                "e.g. GRCh38=GRCh38.fa.gz"
+            )
+        fastas[assembly] = path
+    return fastas
+
+
+def load_reference_fastas(values):
+    '''
+    Open the reference FASTA of each assembly given as ASSEMBLY=PATH
+        inputs:
+            values (list): the options, e.g. ["GRCh38=GRCh38.fa.gz"]
+        outputs:
+            references (dict): the ReferenceFasta for each assembly
+    '''
+    return {
+        assembly: ReferenceFasta(path)
+        for assembly, path in parse_reference_fastas(values).items()
+    }
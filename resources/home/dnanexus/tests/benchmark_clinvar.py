@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the ClinVar mode against the local ClinVar API stand-in in
+mock_clinvar_api.py. For each run size it builds a variant CSV, extracts the
+payloads to NDJSON, submits them and polls for accession IDs, then reports
+submissions per second, end-to-end time to accession and peak memory.
+
+Run from resources/home/dnanexus with:
+    python3 -m tests.benchmark_clinvar --sizes 100 10000 100000
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+from pull_from_csv import stream_clinvar_information, write_clinvar_ndjson
+from push_to_clinvar import (
+    batch_clinvar_records, make_headers, read_clinvar_ndjson,
+    submit_clinvar_records
+)
+from get_clinvar_accession import poll_submissions
+import api_client
+import get_clinvar_accession
+from tests.mock_clinvar_api import start_mock_clinvar_api
+
+TEST_VARIANT_CSV = os.path.join(
+    os.path.dirname(__file__), "test_data", "test_variant.csv"
+)
+
+
+def make_variant_csv(size, path):
+    '''
+    Write a variant CSV of the given number of rows, each a copy of the test
+    variant with a unique local ID
+        inputs:
+            size (int): number of variants
+            path (str): path of the CSV to write
+        outputs:
+            None
+    '''
+    template = pd.read_csv(TEST_VARIANT_CSV)
+    df = template.loc[template.index.repeat(size)].reset_index(drop=True)
+    df["Local ID"] = [f"uid_{i}" for i in range(size)]
+    df["Start"] = df["Start"] + df.index
+    df.to_csv(path, index=False)
+
+
+def run_benchmark(size, api_url, args):
+    '''
+    Build, submit and poll for the accessions of a run of variants
+        inputs:
+            size (int): number of variants
+            api_url (str): url of the mock ClinVar API
+            args: parsed command line arguments
+        outputs:
+            result (dict): timings and memory use of the run
+    '''
+    headers = make_headers("benchmark")
+    policy = {
+        'initial_interval': args.poll_interval,
+        'max_interval': args.poll_interval * 8,
+        'processing_interval': args.poll_interval,
+        'deadline': args.poll_deadline
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            make_variant_csv(size, "variants.csv")
+            get_clinvar_accession.SUMMARY_FILE_CACHE.clear()
+            tracemalloc.start()
+            with open(os.devnull, "w") as devnull, \
+                    contextlib.redirect_stdout(devnull):
+                start = time.perf_counter()
+                write_clinvar_ndjson(
+                    stream_clinvar_information("variants.csv", args.chunksize),
+                    "clinvar_data.ndjson.gz"
+                )
+                built = time.perf_counter()
+
+                records = read_clinvar_ndjson("clinvar_data.ndjson.gz")
+                if args.batch_size > 1:
+                    records = batch_clinvar_records(
+                        records, args.batch_size, 1000000
+                    )
+                succeeded, failed = submit_clinvar_records(
+                    api_url, headers, records, args.max_in_flight
+                )
+                submitted = time.perf_counter()
+
+                df = pd.read_csv("submission_ids.txt", sep=r"\s+")
+                accessions = poll_submissions(
+                    list(zip(df["Local_ID"], df["ClinVar_Submission_ID"])),
+                    headers, api_url, policy
+                )
+                finished = time.perf_counter()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            os.chdir(cwd)
+
+    return {
+        "variants": size,
+        "build_seconds": round(built - start, 3),
+        "submit_seconds": round(submitted - built, 3),
+        "submissions_per_second": round(size / (submitted - built), 1),
+        "time_to_accession_seconds": round(finished - built, 3),
+        "submissions_succeeded": succeeded,
+        "submissions_failed": failed,
+        "accessioned": sum(a is not None for a in accessions.values()),
+        "peak_traced_memory_mb": round(peak / 1e6, 1),
+        "max_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3, 1
+        ),
+    }
+
+
+def main():
+    '''
+    Script entry point
+    '''
+    parser = argparse.ArgumentParser(
+                            description="Benchmark ClinVar submission and "
+                            "accession polling against a local mock API",
+                            formatter_class=(
+                                argparse.ArgumentDefaultsHelpFormatter
+                                )
+                        )
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[100, 10000, 100000]
+    )
+    parser.add_argument('--chunksize', type=int, default=10000)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--max_in_flight', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error_rate', type=float, default=0.0)
+    parser.add_argument('--rate_limit_rate', type=float, default=0.0)
+    parser.add_argument('--processing_delay', type=float, default=1.0)
+    parser.add_argument('--poll_interval', type=float, default=0.5)
+    parser.add_argument('--poll_deadline', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Write the results to a JSON file")
+    args = parser.parse_args()
+
+    server, api_url = start_mock_clinvar_api(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        processing_delay=args.processing_delay,
+        seed=args.seed
+    )
+    api_client.configure_sessions(max(args.max_in_flight, 10))
+
+    results = []
+    try:
+        for size in args.sizes:
+            result = run_benchmark(size, api_url, args)
+            print(json.dumps(result))
+            results.append(result)
+    finally:
+        server.shutdown()
+        api_client.close_sessions()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
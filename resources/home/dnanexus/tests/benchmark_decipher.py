@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the decipher mode against the local OpenCGA and DECIPHER API
+stand-ins in mock_opencga_api.py and mock_decipher_api.py. For each case size
+it pulls a case with that many primary findings and HPO terms from OpenCGA
+and pushes it to DECIPHER twice, once as a new patient and once as an
+existing one, then reports the time and number of requests of each step.
+
+Run from resources/home/dnanexus with:
+    python3 -m tests.benchmark_decipher --findings 1 100 500 --hpo_terms 1 200
+"""
+import argparse
+import contextlib
+import json
+import os
+import time
+from pyopencga.opencga_config import ClientConfiguration
+from pyopencga.opencga_client import OpencgaClient
+from pull_from_opencga import pull_case
+from push_to_decipher import submit_case_to_decipher
+import api_client
+import push_to_decipher
+from tests.mock_decipher_api import start_mock_decipher_api
+from tests.mock_opencga_api import start_mock_opencga_api
+
+HEADERS = {
+    "Content-Type": "application/vnd.api+json",
+    "X-Auth-Token-Client": "benchmark",
+    "X-Auth-Token-Account": "benchmark"
+}
+
+
+def run_benchmark(findings, hpo_terms, oc, opencga, decipher):
+    '''
+    Time pulling a case of a given size and pushing it to DECIPHER twice
+        inputs:
+            findings (int): number of primary findings in the case
+            hpo_terms (int): number of HPO terms in the case
+            oc: an OpenCGA client logged in to the mock OpenCGA API
+            opencga: the mock OpenCGA API server
+            decipher: the mock DECIPHER API server
+        outputs:
+            result (dict): timings and request counts of the run
+    '''
+    case_id = f"CASE-F{findings}-P{hpo_terms}"
+    result = {"findings": findings, "hpo_terms": hpo_terms}
+
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        requests_before = opencga.request_count
+        start = time.perf_counter()
+        case = pull_case(case_id, "study", oc)
+        result["pull_seconds"] = round(time.perf_counter() - start, 4)
+        result["pull_requests"] = opencga.request_count - requests_before
+
+        for push in ["new_patient", "existing_patient"]:
+            requests_before = decipher.request_count
+            start = time.perf_counter()
+            submit_case_to_decipher(case, HEADERS, 1)
+            result[f"{push}_push_seconds"] = round(
+                time.perf_counter() - start, 4
+            )
+            result[f"{push}_push_requests"] = (
+                decipher.request_count - requests_before
+            )
+    return result
+
+
+def main():
+    '''
+    Script entry point
+    '''
+    parser = argparse.ArgumentParser(
+                            description="Benchmark pulling cases from OpenCGA "
+                            "and pushing them to DECIPHER against local mock "
+                            "APIs",
+                            formatter_class=(
+                                argparse.ArgumentDefaultsHelpFormatter
+                                )
+                        )
+    parser.add_argument(
+        '--findings', type=int, nargs='+', default=[1, 10, 100, 500]
+    )
+    parser.add_argument(
+        '--hpo_terms', type=int, nargs='+', default=[1, 20, 200]
+    )
+    parser.add_argument('--opencga_latency', type=float, default=0.0)
+    parser.add_argument('--decipher_latency', type=float, default=0.0)
+    parser.add_argument('--output', help="Write the results to a JSON file")
+    args = parser.parse_args()
+
+    opencga, host = start_mock_opencga_api(args.opencga_latency)
+    decipher, api_url = start_mock_decipher_api(args.decipher_latency)
+    push_to_decipher.API_URL = api_url
+
+    results = []
+    try:
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull):
+            oc = OpencgaClient(ClientConfiguration({"rest": {"host": host}}))
+            oc.login(user="benchmark", password="benchmark")
+        for findings in args.findings:
+            for hpo_terms in args.hpo_terms:
+                result = run_benchmark(
+                    findings, hpo_terms, oc, opencga, decipher
+                )
+                print(json.dumps(result))
+                results.append(result)
+    finally:
+        opencga.shutdown()
+        decipher.shutdown()
+        api_client.close_sessions()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the ClinVar submission API, used to load test
+push_to_clinvar.py and get_clinvar_accession.py without contacting NCBI.
+
+Serves:
+    POST /apitest/v1/submissions                  - create a submission
+    GET  /apitest/v1/submissions/{id}/actions     - submission status
+    GET  /files/{id}.json                         - submission summary file
+
+Each response can be delayed, replaced by a server error or a 429 with a
+Retry-After header, and accession IDs only appear once a submission has been
+processing for a set time.
+
+Run from resources/home/dnanexus with:
+    python3 -m tests.mock_clinvar_api --port 8080
+"""
+import argparse
+import itertools
+import time
+from tests.mock_server import JsonHandler, start_server, serve_until_interrupted
+
+SUBMISSIONS_PATH = "/apitest/v1/submissions"
+
+
+class MockClinvarHandler(JsonHandler):
+    """
+    Request handler for the mock ClinVar API. Settings and submissions are
+    held on the server so they are shared by every request
+    """
+
+    def inject_faults(self):
+        """
+        Apply the configured latency, and reply with a server error or rate
+        limit response instead of handling the request if one is drawn.
+        Returns True if a response has already been sent
+        """
+        server = self.server
+        self.wait()
+        with server.lock:
+            draw = server.random.random()
+        if draw < server.rate_limit_rate:
+            self.send_json(
+                429, {"message": "Too many requests"},
+                {"Retry-After": str(server.retry_after)}
+            )
+            return True
+        if draw < server.rate_limit_rate + server.error_rate:
+            self.send_json(500, {"message": "Internal server error"})
+            return True
+        return False
+
+    def do_POST(self):
+        body = self.read_json()
+        if self.inject_faults():
+            return
+        if self.path.rstrip("/") != SUBMISSIONS_PATH:
+            self.send_json(404, {"message": "Not found"})
+            return
+
+        content = body["actions"][0]["data"]["content"]
+        local_ids = [
+            record["localID"] for record in content["clinvarSubmission"]
+        ]
+        server = self.server
+        with server.lock:
+            submission_id = f"SUB{next(server.counter)}"
+            server.submissions[submission_id] = {
+                "created": time.monotonic(),
+                "local_ids": local_ids
+            }
+        self.send_json(201, {"id": submission_id})
+
+    def do_GET(self):
+        if self.inject_faults():
+            return
+        parts = self.path.strip("/").split("/")
+        if self.path.startswith(SUBMISSIONS_PATH) and parts[-1] == "actions":
+            self.get_actions(parts[-2])
+        elif parts[0] == "files" and len(parts) == 2:
+            self.get_summary_file(parts[1].replace(".json", ""))
+        else:
+            self.send_json(404, {"message": "Not found"})
+
+    def get_submission(self, submission_id):
+        with self.server.lock:
+            submission = self.server.submissions.get(submission_id)
+        if submission is None:
+            self.send_json(404, {"message": "Unknown submission"})
+        return submission
+
+    def get_actions(self, submission_id):
+        submission = self.get_submission(submission_id)
+        if submission is None:
+            return
+        age = time.monotonic() - submission["created"]
+        if age < self.server.processing_delay / 2:
+            status, responses = "submitted", []
+        elif age < self.server.processing_delay:
+            status, responses = "processing", []
+        else:
+            host, port = self.server.server_address[:2]
+            status = "processed"
+            responses = [{
+                "status": "processed",
+                "files": [{
+                    "url": f"http://{host}:{port}/files/{submission_id}.json"
+                }]
+            }]
+        self.send_json(200, {"actions": [{
+            "id": f"{submission_id}-1",
+            "status": status,
+            "targetDb": "clinvar",
+            "responses": responses
+        }]})
+
+    def get_summary_file(self, submission_id):
+        submission = self.get_submission(submission_id)
+        if submission is None:
+            return
+        etag = f'"{submission_id}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        number = submission_id.replace("SUB", "")
+        self.send_json(200, {
+            "batchProcessingStatus": "Success",
+            "submissions": [
+                {
+                    "identifiers": {
+                        "localID": local_id,
+                        "clinvarAccession": f"SCV{number}{i:06d}"
+                    },
+                    "processingStatus": "Success"
+                }
+                for i, local_id in enumerate(submission["local_ids"])
+            ]
+        }, {"ETag": etag})
+
+
+def start_mock_clinvar_api(latency=0, error_rate=0, rate_limit_rate=0,
+                           retry_after=1, processing_delay=0, seed=None,
+                           port=0):
+    '''
+    Start the mock ClinVar API in a background thread
+        inputs:
+            latency (float): seconds to wait before answering each request
+            error_rate (float): fraction of requests answered with a 500
+            rate_limit_rate (float): fraction of requests answered with a 429
+            retry_after (int): Retry-After seconds sent with each 429
+            processing_delay (float): seconds after submission before an
+            accession ID is available
+            seed (int): seed for the random fault injection, optional
+            port (int): port to listen on, a free port if 0
+        outputs:
+            server: the running server, stop it with server.shutdown()
+            api_url (str): url to use in place of the ClinVar test API url
+    '''
+    server = start_server(
+        MockClinvarHandler, latency, seed, port,
+        error_rate=error_rate,
+        rate_limit_rate=rate_limit_rate,
+        retry_after=retry_after,
+        processing_delay=processing_delay,
+        counter=itertools.count(1),
+        submissions={}
+    )
+    api_url = f"http://127.0.0.1:{server.server_port}{SUBMISSIONS_PATH}"
+    return server, api_url
+
+
+def main():
+    '''
+    Run the mock ClinVar API until interrupted
+    '''
+    parser = argparse.ArgumentParser(
+                            description="Local stand-in for the ClinVar API",
+                            formatter_class=(
+                                argparse.ArgumentDefaultsHelpFormatter
+                                )
+                        )
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--error_rate', type=float, default=0)
+    parser.add_argument('--rate_limit_rate', type=float, default=0)
+    parser.add_argument('--retry_after', type=int, default=1)
+    parser.add_argument('--processing_delay', type=float, default=0)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    server, api_url = start_mock_clinvar_api(
+        args.latency, args.error_rate, args.rate_limit_rate,
+        args.retry_after, args.processing_delay, args.seed, args.port
+    )
+    serve_until_interrupted(server, f"Mock ClinVar API running at {api_url}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the DECIPHER JSON:API, used to test and profile
+push_to_decipher.py without DECIPHER credentials.
+
+Serves:
+    POST /api/patients                  - create a patient and its person
+    GET  /api/patients                  - list patients, filtered by
+                                          filter[clinical_reference] and
+                                          paged by page[number]/page[size]
+    GET  /api/patients/{id}/people      - people for a patient
+    POST /api/phenotypes                - add an array of phenotypes
+    POST /api/variants                  - add one variant or an array
+
+Phenotypes with an HPO term in the server's invalid_hpo_terms, and variants
+without a chromosome, position, ref or alt, are rejected with a 422 and a
+JSON:API error pointing at each bad item (or with no pointer, if the server
+is started with error_pointers=False); nothing in a rejected request is
+saved. If the server is started with a fail_status, every phenotype and
+variant request is answered with that status instead, e.g. 401 or 500.
+Saved phenotypes and variants are kept in server.created.
+
+Run from resources/home/dnanexus with:
+    python3 -m tests.mock_decipher_api --port 8081
+"""
+import argparse
+import itertools
+from urllib.parse import urlsplit, parse_qs, urlencode
+from tests.mock_server import JsonHandler, start_server, serve_until_interrupted
+
+API_PATH = "/api/"
+DEFAULT_PAGE_SIZE = 20
+
+
+class MockDecipherHandler(JsonHandler):
+    """
+    Request handler for the mock DECIPHER API. Settings and records are held
+    on the server so they are shared by every request
+    """
+
+    def route(self):
+        path = urlsplit(self.path).path
+        if not path.startswith(API_PATH):
+            return []
+        return path[len(API_PATH):].strip("/").split("/")
+
+    def do_GET(self):
+        self.wait()
+        parts = self.route()
+        if parts == ["patients"]:
+            self.list_patients(parse_qs(urlsplit(self.path).query))
+        elif len(parts) == 3 and parts[0] == "patients" \
+                and parts[2] == "people":
+            self.get_people(parts[1])
+        else:
+            self.send_json(404, {"errors": [{"detail": "Not found"}]})
+
+    def do_POST(self):
+        body = self.read_json()
+        self.wait()
+        parts = self.route()
+        if self.server.fail_status and parts in (["phenotypes"], ["variants"]):
+            status = self.server.fail_status
+            self.send_json(status, {"errors": [{
+                "status": str(status), "detail": "Request failed"
+            }]})
+        elif parts == ["patients"]:
+            self.create_patient(body["data"])
+        elif parts == ["phenotypes"]:
+            self.create_items(
+                body["data"], "phenotypes", self.phenotype_error
+            )
+        elif parts == ["variants"]:
+            self.create_items(
+                body["data"], "variants", self.variant_error
+            )
+        else:
+            self.send_json(404, {"errors": [{"detail": "Not found"}]})
+
+    def create_patient(self, data):
+        server = self.server
+        reference = data["attributes"]["clinical_reference"]
+        with server.lock:
+            if reference in server.patients:
+                self.send_json(422, {"errors": [{
+                    "status": "422",
+                    "detail": "Clinical reference must be unique within the "
+                    "project",
+                    "source": {"pointer": "/data/attributes/clinical_reference"}
+                }]})
+                return
+            patient_id = str(next(server.counter))
+            person_id = str(next(server.counter))
+            patient = {
+                "type": "Patient",
+                "id": patient_id,
+                "attributes": data["attributes"],
+                "relationships": {"People": {"data": [
+                    {"type": "Person", "id": person_id}
+                ]}}
+            }
+            server.patients[reference] = patient
+            server.people[patient_id] = person_id
+        self.send_json(201, {"data": [patient]})
+
+    def list_patients(self, query):
+        with self.server.lock:
+            patients = list(self.server.patients.values())
+        reference = query.get("filter[clinical_reference]")
+        if reference:
+            patients = [
+                patient for patient in patients
+                if patient["attributes"]["clinical_reference"] == reference[0]
+            ]
+
+        number = int(query.get("page[number]", ["1"])[0])
+        size = int(query.get("page[size]", [str(DEFAULT_PAGE_SIZE)])[0])
+        page = patients[(number - 1) * size:number * size]
+        links = {}
+        if number * size < len(patients):
+            host, port = self.server.server_address[:2]
+            next_query = {key: value[0] for key, value in query.items()}
+            next_query["page[number]"] = number + 1
+            next_query["page[size]"] = size
+            links["next"] = (
+                f"http://{host}:{port}{API_PATH}patients?"
+                + urlencode(next_query)
+            )
+        self.send_json(200, {"data": page, "links": links})
+
+    def get_people(self, patient_id):
+        with self.server.lock:
+            person_id = self.server.people.get(patient_id)
+        if person_id is None:
+            self.send_json(404, {"errors": [{"detail": "Unknown patient"}]})
+            return
+        self.send_json(200, {"data": [{
+            "type": "Person",
+            "id": person_id,
+            "attributes": {"patient_id": int(patient_id)}
+        }]})
+
+    def phenotype_error(self, item):
+        term = str(item["attributes"].get("hpo_term_id", ""))
+        if not term.isdigit() or term in self.server.invalid_hpo_terms:
+            return "Invalid HPO term"
+        return None
+
+    def variant_error(self, item):
+        attributes = item["attributes"]
+        for field in ["chr", "start", "ref_sequence", "alt_sequence"]:
+            if not attributes.get(field):
+                return f"Missing {field}"
+        return None
+
+    def create_items(self, data, resource, validate):
+        """
+        Save one item or an array of items, or reject the whole request with
+        an error for every invalid item
+        """
+        items = data if isinstance(data, list) else [data]
+        errors = []
+        for index, item in enumerate(items):
+            detail = validate(item)
+            if detail is not None:
+                pointer = f"/data/{index}" if isinstance(data, list) \
+                    else "/data"
+                error = {"status": "422", "detail": detail}
+                if self.server.error_pointers:
+                    error["source"] = {"pointer": pointer}
+                errors.append(error)
+        if errors:
+            self.send_json(422, {"errors": errors})
+            return
+
+        created = []
+        with self.server.lock:
+            for item in items:
+                created.append({**item, "id": str(next(self.server.counter))})
+            self.server.created[resource].extend(created)
+        self.send_json(201, {"data": created})
+
+
+def start_mock_decipher_api(latency=0, invalid_hpo_terms=(), port=0,
+                            error_pointers=True, fail_status=None):
+    '''
+    Start the mock DECIPHER API in a background thread
+        inputs:
+            latency (float): seconds to wait before answering each request
+            invalid_hpo_terms: HPO term numbers (without "HP:") to reject
+            port (int): port to listen on, a free port if 0
+            error_pointers (bool): if False, errors for invalid items do not
+            say which item they refer to
+            fail_status (int): status to answer every phenotype and variant
+            request with, optional
+        outputs:
+            server: the running server, stop it with server.shutdown()
+            api_url (str): url to use in place of the DECIPHER API url
+    '''
+    server = start_server(
+        MockDecipherHandler, latency, port=port,
+        invalid_hpo_terms=set(invalid_hpo_terms),
+        error_pointers=error_pointers,
+        fail_status=fail_status,
+        counter=itertools.count(1),
+        patients={},
+        people={},
+        created={"phenotypes": [], "variants": []}
+    )
+    api_url = f"http://127.0.0.1:{server.server_port}{API_PATH}"
+    return server, api_url
+
+
+def main():
+    '''
+    Run the mock DECIPHER API until interrupted
+    '''
+    parser = argparse.ArgumentParser(
+                            description="Local stand-in for the DECIPHER API",
+                            formatter_class=(
+                                argparse.ArgumentDefaultsHelpFormatter
+                                )
+                        )
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--invalid_hpo_terms', nargs='*', default=[])
+    parser.add_argument('--no_error_pointers', action='store_true')
+    args = parser.parse_args()
+
+    server, api_url = start_mock_decipher_api(
+        args.latency, args.invalid_hpo_terms, args.port,
+        not args.no_error_pointers
+    )
+    serve_until_interrupted(server, f"Mock DECIPHER API running at {api_url}")
+
+
+if __name__ == "__main__":
+    main()
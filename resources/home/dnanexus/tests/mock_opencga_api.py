@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the parts of the OpenCGA REST API used by
+pull_from_opencga.py, so the decipher mode can be run and profiled without
+OpenCGA credentials.
+
+Serves:
+    HEAD any path                                   - host check
+    GET  {host}/webservices/rest/v2/meta/about      - server version
+    POST {host}/webservices/rest/v2/users/login     - login token
+    GET  {host}/webservices/rest/v2/analysis/clinical/search
+                                                    - clinical analyses
+    GET  {host}/webservices/rest/v2/analysis/clinical/interpretation/{id}/info
+                                                    - interpretations
+
+Cases are generated from their IDs: a case ID of the form CASE-F{n}-P{m}
+returns a case with n primary findings and m HPO phenotypes, and
+CASE-F{n}-P{m}-S{k} also has k secondary findings, so any size of case can
+be requested without setting up data first. The interpretation of a case
+has the case ID followed by ".1". Any other ID returns a
+case with one finding and one phenotype, unless it is one of the server's
+missing_cases, which are never found. The include option is applied to the
+cases returned, as OpenCGA does.
+
+Run from resources/home/dnanexus with:
+    python3 -m tests.mock_opencga_api --port 8082
+"""
+import argparse
+import re
+from urllib.parse import urlsplit, parse_qs
+from tests.mock_server import JsonHandler, start_server, serve_until_interrupted
+
+REST_PATH = "webservices/rest/v2/"
+CASE_ID_PATTERN = re.compile(r"^CASE-F(\d+)-P(\d+)(?:-S(\d+))?$")
+OPENCGA_VERSION = "2.4.9"
+
+# Genotype, type and alleles of the findings in a generated case, in turn
+FINDING_TEMPLATES = [
+    ("0/1", "SNV", "C", "T"),
+    ("1/1", "INDEL", "G", "GA"),
+    ("0/1", "SNV", "A", "G"),
+    ("1/2", "INDEL", "T", "TA,TAA"),
+    ("0/1", "DELETION", "CT", "C"),
+]
+
+
+def make_finding(index):
+    '''
+    Make a primary finding in the structure returned by OpenCGA, including
+    the annotation that makes up most of the size of a real finding
+        inputs:
+            index (int): position of the finding in the case
+        outputs:
+            finding (dict): the finding
+    '''
+    genotype, variant_type, ref, alt = FINDING_TEMPLATES[
+        index % len(FINDING_TEMPLATES)
+    ]
+    chrom = str(index % 22 + 1)
+    start = 100000 + index * 100
+    if variant_type == "SNV":
+        finding_id = f"{chrom}:{start}:{ref}:{alt}"
+    else:
+        # OpenCGA normalises indels, so the ID has a dash for the missing
+        # allele and the VCF nomenclature is only in the call
+        first_alt = alt.split(",")[0]
+        if len(ref) < len(first_alt):
+            finding_id = f"{chrom}:{start + 1}:-:{first_alt[len(ref):]}"
+        else:
+            finding_id = f"{chrom}:{start + 1}:{ref[len(first_alt):]}:-"
+    return {
+        "id": finding_id,
+        "type": variant_type,
+        "chromosome": chrom,
+        "start": start,
+        "reference": ref,
+        "alternate": alt,
+        "studies": [{
+            "studyId": "mock@project:study",
+            "files": [{
+                "fileId": "case.vcf.gz",
+                "call": {"variantId": f"{chrom}:{start}:{ref}:{alt}"},
+                "data": {"FILTER": "PASS", "QUAL": "100"}
+            }],
+            "sampleDataKeys": ["GT", "AD", "DP"],
+            "samples": [
+                {"sampleId": "sample", "data": [genotype, "10,10", "20"]}
+            ]
+        }],
+        "annotation": {
+            "consequenceTypes": [{
+                "geneName": f"GENE{index}",
+                "ensemblTranscriptId": f"ENST{index:011d}.{n}",
+                "sequenceOntologyTerms": [
+                    {"accession": "SO:0001583", "name": "missense_variant"}
+                ],
+                "proteinVariantAnnotation": {
+                    "position": index,
+                    "reference": "ALA",
+                    "alternate": "VAL",
+                    "substitutionScores": [
+                        {"score": 0.01, "source": "sift"},
+                        {"score": 0.9, "source": "polyphen"}
+                    ]
+                }
+            } for n in range(5)],
+            "populationFrequencies": [
+                {"study": "GNOMAD_GENOMES", "population": population,
+                 "altAlleleFreq": 0.0001}
+                for population in ["ALL", "AFR", "AMR", "EAS", "NFE", "SAS"]
+            ]
+        },
+        "status": "NOT_REVIEWED",
+        "comments": []
+    }
+
+
+def make_case(case_id):
+    '''
+    Make a clinical analysis for a case ID
+        inputs:
+            case_id (str): the case ID, of the form CASE-F{n}-P{m}-S{k} to
+            get a case with n primary findings, m phenotypes and k secondary
+            findings
+        outputs:
+            case (dict): the clinical analysis
+    '''
+    match = CASE_ID_PATTERN.match(case_id)
+    findings, phenotypes, secondary = (
+        (int(match.group(1)), int(match.group(2)), int(match.group(3) or 0))
+        if match else (1, 1, 0)
+    )
+    return {
+        "id": case_id,
+        "type": "SINGLE",
+        "proband": {
+            "id": f"{case_id}-PROBAND",
+            "sex": {"id": "FEMALE"},
+            "phenotypes": [
+                {"id": f"HP:{1 + i:07d}", "name": f"Phenotype {i}",
+                 "source": "HPO", "status": "OBSERVED"}
+                for i in range(phenotypes)
+            ],
+            "disorders": [{"id": "OMIM:000000"}],
+            "modificationDate": "20240101000000",
+            "samples": [{"id": "sample"}]
+        },
+        "interpretation": {
+            "id": f"{case_id}.1",
+            "primaryFindings": [make_finding(i) for i in range(findings)],
+            "secondaryFindings": [
+                make_finding(findings + i) for i in range(secondary)
+            ]
+        },
+        "files": [{"id": "case.vcf.gz"}],
+        "audit": [{"action": "CREATE", "message": "Mock case"}]
+    }
+
+
+def project(value, fields):
+    '''
+    Keep only the given fields of a result, as the OpenCGA include option does
+        inputs:
+            value: a result, or part of one
+            fields (dict): nested dictionary of the field paths to keep, with
+            an empty dictionary for a field that is kept whole
+        outputs:
+            value: the result with only the given fields
+    '''
+    if not fields:
+        return value
+    if isinstance(value, list):
+        return [project(item, fields) for item in value]
+    if isinstance(value, dict):
+        return {
+            key: project(value[key], subfields)
+            for key, subfields in fields.items() if key in value
+        }
+    return value
+
+
+def include_tree(include):
+    '''
+    Turn the OpenCGA include option into the nested fields used by project
+        inputs:
+            include (str): comma-separated field paths
+        outputs:
+            fields (dict): nested dictionary of the field paths
+    '''
+    fields = {}
+    for path in include.split(","):
+        node = fields
+        for key in path.strip().split("."):
+            node = node.setdefault(key, {})
+    return fields
+
+
+def opencga_response(results):
+    '''
+    Wrap results in the response structure used by the OpenCGA REST API
+        inputs:
+            results (list): the results
+        outputs:
+            response (dict): the OpenCGA response
+    '''
+    return {
+        "apiVersion": "v2",
+        "time": 1,
+        "events": [],
+        "params": {},
+        "responses": [{
+            "time": 1,
+            "events": [],
+            "numResults": len(results),
+            "numMatches": len(results),
+            "results": results
+        }]
+    }
+
+
+class MockOpencgaHandler(JsonHandler):
+    """
+    Request handler for the mock OpenCGA API
+    """
+
+    def route(self):
+        url = urlsplit(self.path)
+        _, _, resource = url.path.partition(REST_PATH)
+        return resource.strip("/"), parse_qs(url.query)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        self.wait()
+        resource, query = self.route()
+        if resource == "meta/about":
+            self.send_json(200, opencga_response(
+                [{"Program": "OpenCGA", "Version": OPENCGA_VERSION}]
+            ))
+        elif resource == "analysis/clinical/search":
+            case_ids = ",".join(query.get("id", [])).split(",")
+            fields = include_tree(query["include"][0]) \
+                if "include" in query else {}
+            self.send_json(200, opencga_response([
+                project(make_case(case_id), fields) for case_id in case_ids
+                if case_id and case_id not in self.server.missing_cases
+            ]))
+        elif resource.startswith("analysis/clinical/interpretation/") \
+                and resource.endswith("/info"):
+            interpretation_ids = resource.split("/")[3].split(",")
+            fields = include_tree(query["include"][0]) \
+                if "include" in query else {}
+            self.send_json(200, opencga_response([
+                project(
+                    make_case(interpretation_id.rsplit(".", 1)[0])[
+                        "interpretation"
+                    ], fields
+                ) for interpretation_id in interpretation_ids
+            ]))
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        self.read_json()
+        self.wait()
+        resource, _ = self.route()
+        if resource == "users/login":
+            self.send_json(200, opencga_response(
+                [{"token": "mock-token", "refreshToken": "mock-refresh"}]
+            ))
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+
+def start_mock_opencga_api(latency=0, port=0, missing_cases=()):
+    '''
+    Start the mock OpenCGA API in a background thread
+        inputs:
+            latency (float): seconds to wait before answering each request
+            port (int): port to listen on, a free port if 0
+            missing_cases: case IDs that are not found by searches
+        outputs:
+            server: the running server, stop it with server.shutdown()
+            host (str): host to use in place of the OpenCGA host
+    '''
+    server = start_server(
+        MockOpencgaHandler, latency, port=port,
+        missing_cases=set(missing_cases)
+    )
+    host = f"http://127.0.0.1:{server.server_port}/opencga"
+    return server, host
+
+
+def main():
+    '''
+    Run the mock OpenCGA API until interrupted
+    '''
+    parser = argparse.ArgumentParser(
+                            description="Local stand-in for the OpenCGA API",
+                            formatter_class=(
+                                argparse.ArgumentDefaultsHelpFormatter
+                                )
+                        )
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--latency', type=float, default=0)
+    args = parser.parse_args()
+
+    server, host = start_mock_opencga_api(args.latency, args.port)
+    serve_until_interrupted(server, f"Mock OpenCGA API running at {host}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Shared pieces of the local API stand-ins used to test and benchmark
+eggd_pandora without contacting the real services.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class JsonHandler(BaseHTTPRequestHandler):
+    """
+    Request handler that answers with JSON, after the latency configured on
+    the server
+    """
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, so don't let Nagle's
+    # algorithm hold back the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        return json.loads(body) if body else None
+
+    def send_json(self, status, content, headers=None):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def wait(self):
+        """
+        Apply the configured latency and count the request
+        """
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+        if server.latency:
+            time.sleep(server.latency)
+
+
+def start_server(handler, latency=0, seed=None, port=0, **settings):
+    '''
+    Start a mock API server in a background thread
+        inputs:
+            handler: request handler class
+            latency (float): seconds to wait before answering each request
+            seed (int): seed for any random behaviour, optional
+            port (int): port to listen on, a free port if 0
+            settings: any other settings, set as attributes of the server
+        outputs:
+            server: the running server, stop it with server.shutdown()
+    '''
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.random = random.Random(seed)
+    server.lock = threading.Lock()
+    server.request_count = 0
+    for key, value in settings.items():
+        setattr(server, key, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve_until_interrupted(server, message):
+    '''
+    Keep a mock API running in the foreground until interrupted
+        inputs:
+            server: the running server
+            message (str): message to print once the server is running
+        outputs:
+            None
+    '''
+    print(message)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -2,10 +2,31 @@
 import pandas as pd
 import pytest
 import os
+import json
+import argparse
+import struct
+import time
+import zlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from push_to_decipher import *
 from pull_from_opencga import *
 from pull_from_csv import *
 from push_to_clinvar import *
+from get_clinvar_accession import *
+import api_client
+import checkpoint_store
+import push_to_decipher
+import opencga_to_decipher
+import pull_from_csv
+from opencga_to_decipher import run_case_pipeline
+from hpo_index import *
+from variant_record import *
+from reference_fasta import *
+from tests.mock_clinvar_api import start_mock_clinvar_api
+from tests.mock_decipher_api import start_mock_decipher_api
+from tests.mock_opencga_api import start_mock_opencga_api, make_case
+import get_clinvar_accession
 
 
 class TestDecipher:
@@ -234,6 +255,281 @@ class TestDecipher:
                 },
             ]
 
+    def test_mock_decipher_api_round_trip(self, monkeypatch):
+        """
+        Test that a case pushed twice to the local DECIPHER API stand-in is
+        added once, and that an invalid HPO term is left out
+        """
+        server, api_url = start_mock_decipher_api(
+            invalid_hpo_terms=["0000121"]
+        )
+        monkeypatch.setattr(push_to_decipher, "API_URL", api_url)
+        case = {
+            "sex": "46_xx",
+            "clinical_reference": "12345",
+            "phenotype_list": ["HP:0000119", "HP:0000121", "HP:0000377"],
+            "variant_list": [
+                {"variant_id": "1:10108:C:CT", "type": "INDEL",
+                 "zygosity": "0/1"},
+                {"variant_id": "1:927003:C:T", "type": "SNV",
+                 "zygosity": "1/1"}
+            ]
+        }
+
+        try:
+            person_id, patient_id = submit_patient_to_decipher(case, {}, 1)
+            submit_phenotypes_to_decipher(case, {}, person_id)
+            submit_variants_to_decipher(case, {}, person_id)
+            assert submit_patient_to_decipher(case, {}, 1) == (
+                person_id, int(patient_id)
+            )
+        finally:
+            server.shutdown()
+
+        assert list(server.patients) == ["12345"]
+        assert [
+            phenotype["attributes"]["hpo_term_id"]
+            for phenotype in server.created["phenotypes"]
+        ] == ["0000119", "0000377"]
+        assert len(server.created["variants"]) == 2
+
+    def test_pointer_index(self):
+        """
+        Test that the array index is read from JSON:API error pointers
+        """
+        assert pointer_index({"source": {"pointer": "/data/3"}}) == 3
+        assert pointer_index(
+            {"source": {"pointer": "/data/12/attributes/chr"}}
+        ) == 12
+        assert pointer_index({"source": {"pointer": "/data"}}) is None
+        assert pointer_index({"detail": "Server error"}) is None
+
+    def test_variants_submitted_in_chunks(self, monkeypatch):
+        """
+        Test that variants are submitted in arrays of the chunk size, and
+        that a rejected variant is reported by its variant_id while the rest
+        of its chunk is still submitted
+        """
+        server, api_url = start_mock_decipher_api()
+        monkeypatch.setattr(push_to_decipher, "API_URL", api_url)
+        case = {
+            "sex": "46_xx",
+            "variant_list": [
+                {"variant_id": f"1:{1000 + i}:C:T", "type": "SNV",
+                 "zygosity": "0/1"}
+                for i in range(5)
+            ] + [
+                {"variant_id": "2:2000::T", "type": "SNV", "zygosity": "0/1"},
+                {"variant_id": "12:21912765:G:GA,GAA", "type": "INDEL",
+                 "zygosity": "1/2"},
+                {"variant_id": "3:3000:A:G", "type": "SNV", "zygosity": "0/0"}
+            ]
+        }
+
+        try:
+            failed = submit_variants_to_decipher(case, {}, "2", chunk_size=3)
+        finally:
+            server.shutdown()
+
+        assert [(item["id"], item["detail"]) for item in failed] == [
+            ("2:2000::T", ["Missing ref_sequence"])
+        ]
+        assert len(server.created["variants"]) == 7
+        # Three chunks of three alleles, plus one resubmission of the chunk
+        # with the rejected variant
+        assert server.request_count == 4
+
+    def test_variant_chunk_size_must_be_positive(self):
+        """
+        Test that a chunk size below one is rejected rather than no variants
+        being submitted
+        """
+        case = {"sex": "46_xx", "variant_list": [
+            {"variant_id": "1:1000:C:T", "type": "SNV", "zygosity": "0/1"}
+        ]}
+        for chunk_size in [0, -1]:
+            with pytest.raises(ValueError):
+                submit_variants_to_decipher(case, {}, "2", chunk_size)
+
+    def test_existing_patient_found_by_filter(self, monkeypatch):
+        """
+        Test that an existing patient is found with a filtered lookup rather
+        than by listing every patient
+        """
+        server, api_url = start_mock_decipher_api()
+        monkeypatch.setattr(push_to_decipher, "API_URL", api_url)
+
+        try:
+            ids = {}
+            for i in range(45):
+                ids[str(i)] = submit_patient_to_decipher(
+                    {"sex": "46_xx", "clinical_reference": str(i)}, {}, 1
+                )
+            requests_before = server.request_count
+            person_id, patient_id = submit_patient_to_decipher(
+                {"sex": "46_xx", "clinical_reference": "40"}, {}, 1
+            )
+        finally:
+            server.shutdown()
+
+        assert (person_id, str(patient_id)) == ids["40"]
+        # The failed POST, one filtered GET and the GET for the person
+        assert server.request_count - requests_before == 3
+
+    def test_patient_cache(self, tmp_path, monkeypatch):
+        """
+        Test that a patient in the local patient cache is not looked up in
+        DECIPHER, and that the cache is saved and loaded
+        """
+        server, api_url = start_mock_decipher_api()
+        monkeypatch.setattr(push_to_decipher, "API_URL", api_url)
+        cache_file = str(tmp_path / "patient_cache.json")
+        case = {"sex": "46_xx", "clinical_reference": "12345"}
+
+        try:
+            patient_cache = load_patient_cache(cache_file)
+            assert patient_cache == {}
+            ids = submit_patient_to_decipher(case, {}, 1, patient_cache)
+            save_patient_cache(patient_cache, cache_file)
+            requests_before = server.request_count
+            cached_ids = submit_patient_to_decipher(
+                case, {}, 1, load_patient_cache(cache_file)
+            )
+        finally:
+            server.shutdown()
+
+        assert cached_ids == ids
+        assert server.request_count == requests_before
+
+    def test_phenotypes_checked_against_hpo_index(self, tmp_path,
+                                                  monkeypatch):
+        """
+        Test that with an HPO index, unknown terms are left out and obsolete
+        terms replaced before submission, so phenotypes are submitted in one
+        request
+        """
+        server, api_url = start_mock_decipher_api(
+            invalid_hpo_terms=["0009999", "0000005"]
+        )
+        monkeypatch.setattr(push_to_decipher, "API_URL", api_url)
+        build_hpo_index(TestHpoIndex.ontology, str(tmp_path / "hp.idx"))
+        hpo_index = HpoIndex(str(tmp_path / "hp.idx"))
+        case = {"phenotype_list": ["HP:0001250", "HP:0009999", "HP:0000005"]}
+
+        try:
+            submit_phenotypes_to_decipher(case, {}, "2", hpo_index)
+        finally:
+            server.shutdown()
+            hpo_index.close()
+
+        assert server.request_count == 1
+        assert [
+            phenotype["attributes"]["hpo_term_id"]
+            for phenotype in server.created["phenotypes"]
+        ] == ["0001250"]
+
+    def test_all_invalid_phenotypes_removed_at_once(self, tmp_path,
+                                                    monkeypatch):
+        """
+        Test that every phenotype an error points at is removed before the
+        phenotypes are submitted again, and that they are written to the
+        skipped items file
+        """
+        server, api_url = start_mock_decipher_api(
+            invalid_hpo_terms=["0000002", "0000005", "0000007"]
+        )
+        monkeypatch.setattr(push_to_decipher, "API_URL", api_url)
+        case = {"phenotype_list": [f"HP:{i:07d}" for i in range(1, 9)]}
+
+        try:
+            skipped = submit_phenotypes_to_decipher(case, {}, "2")
+        finally:
+            server.shutdown()
+
+        assert server.request_count == 2
+        assert len(server.created["phenotypes"]) == 5
+        skipped_file = tmp_path / "skipped.json"
+        write_skipped_items(skipped, str(skipped_file))
+        assert [
+            (item["resource"], item["id"], item["detail"])
+            for item in json.loads(skipped_file.read_text())
+        ] == [
+            ("phenotypes", "HP:0000002", ["Invalid HPO term"]),
+            ("phenotypes", "HP:0000005", ["Invalid HPO term"]),
+            ("phenotypes", "HP:0000007", ["Invalid HPO term"])
+        ]
+
+    def test_invalid_items_found_by_bisecting(self, monkeypatch):
+        """
+        Test that invalid items are isolated by splitting the array when the
+        errors do not point at an item
+        """
+        server, api_url = start_mock_decipher_api(
+            invalid_hpo_terms=["0000011"], error_pointers=False
+        )
+        monkeypatch.setattr(push_to_decipher, "API_URL", api_url)
+        case = {"phenotype_list": [f"HP:{i:07d}" for i in range(64)]}
+
+        try:
+            skipped = submit_phenotypes_to_decipher(case, {}, "2")
+        finally:
+            server.shutdown()
+
+        assert [item["id"] for item in skipped] == ["HP:0000011"]
+        assert len(server.created["phenotypes"]) == 63
+        # One failed request and two per halving of the 64 phenotypes
+        assert server.request_count == 1 + 2 * 6
+
+    @pytest.mark.parametrize("status", [500, 401])
+    def test_failed_requests_not_skipped(self, monkeypatch, status):
+        """
+        Test that a request failing for a reason other than invalid items
+        fails the case, rather than its items being split up and reported as
+        skipped
+        """
+        server, api_url = start_mock_decipher_api(fail_status=status)
+        monkeypatch.setattr(push_to_decipher, "API_URL", api_url)
+        case = {"phenotype_list": [f"HP:{i:07d}" for i in range(64)]}
+
+        try:
+            with pytest.raises(RuntimeError, match=f"HTTP {status}"):
+                submit_phenotypes_to_decipher(case, {}, "2")
+        finally:
+            server.shutdown()
+
+        assert server.request_count == 1
+        assert server.created["phenotypes"] == []
+
+    def test_streamed_variants_submitted_as_read(self, monkeypatch):
+        """
+        Test that a variant list streamed from findings is submitted a chunk
+        at a time as it is read, rather than read in full first
+        """
+        read = []
+
+        def findings():
+            for i in range(7):
+                read.append(i)
+                yield {
+                    "type": "SNV", "id": f"1:{1000 + i}:C:T",
+                    "studies": [{"samples": [{"data": ["0/1"]}]}]
+                }
+
+        submitted = []
+        monkeypatch.setattr(
+            push_to_decipher, "submit_json_api_array",
+            lambda url, headers, items: submitted.append(
+                (len(read), len(items))
+            ) or []
+        )
+        case = {
+            "sex": "46_xx", "variant_list": iter_proband_variants(findings())
+        }
+
+        assert submit_variants_to_decipher(case, {}, "2", chunk_size=3) == []
+        # (findings read, alleles submitted) for each request
+        assert submitted == [(3, 3), (6, 3), (7, 1)]
+
 
 class TestOpenCGA:
     """
@@ -287,7 +583,7 @@ class TestOpenCGA:
         Test that the function to extract proband variants works
         """
         variant_list = extract_proband_variants(self.interpretation)
-        assert variant_list == [
+        assert [variant.to_dict() for variant in variant_list] == [
             {"variant_id": "1:10108:C:CT", "type": "INDEL", "zygosity": "0/1"},
             {"variant_id": "1:927003:C:T", "type": "SNV", "zygosity": "1|1"},
         ]
@@ -315,6 +611,326 @@ class TestOpenCGA:
             ],
         }
 
+    def test_mock_opencga_api_case(self):
+        """
+        Test that a case pulled from the local OpenCGA API stand-in has the
+        number of findings and phenotypes given in its ID
+        """
+        server, host = start_mock_opencga_api()
+        try:
+            oc = OpencgaClient(ClientConfiguration({"rest": {"host": host}}))
+            oc.login(user="test", password="test")
+            case = extract_case_from_opencga("CASE-F5-P3", "study", oc)
+        finally:
+            server.shutdown()
+
+        result = case.get_result(result_pos=0)
+        variants = extract_proband_variants(
+            result["interpretation"]["primaryFindings"]
+        )
+        assert extract_proband_phenotypes(result["proband"]) == [
+            "HP:0000001", "HP:0000002", "HP:0000003"
+        ]
+        assert [variant["variant_id"] for variant in variants] == [
+            "1:100000:C:T", "2:100100:G:GA", "3:100200:A:G",
+            "4:100300:T:TA,TAA", "5:100400:CT:C"
+        ]
+
+    def test_included_fields_cover_extraction(self):
+        """
+        Test that a case fetched with only the included fields gives the same
+        DECIPHER data as the full case, and leaves out the rest
+        """
+        server, host = start_mock_opencga_api()
+        try:
+            oc = OpencgaClient(ClientConfiguration({"rest": {"host": host}}))
+            oc.login(user="test", password="test")
+            case = extract_case_from_opencga("CASE-F10-P5", "study", oc)
+        finally:
+            server.shutdown()
+
+        result = case.get_result(result_pos=0)
+        assert build_case_json(result) == build_case_json(
+            make_case("CASE-F10-P5")
+        )
+        assert "annotation" not in result["interpretation"]["primaryFindings"][0]
+        assert "audit" not in result
+
+    def test_proband_variants_streamed(self):
+        """
+        Test that variants are extracted from a generator of findings one at
+        a time, and findings of an unknown type are skipped
+        """
+        findings = iter(self.interpretation + [{"type": "CNV"}])
+        variants = iter_proband_variants(findings)
+        assert next(variants)["variant_id"] == "1:10108:C:CT"
+        assert [variant["variant_id"] for variant in variants] == [
+            "1:927003:C:T"
+        ]
+
+    def test_findings_streamed_with_secondary_findings(self):
+        """
+        Test that the findings of a case fetched without them are fetched one
+        finding list at a time, including secondary findings if asked
+        """
+        server, host = start_mock_opencga_api()
+        try:
+            oc = OpencgaClient(ClientConfiguration({"rest": {"host": host}}))
+            oc.login(user="test", password="test")
+            case = extract_case_from_opencga(
+                "CASE-F3-P1-S2", "study", oc, case_include_fields(())
+            )
+            clinical_analysis = case.get_result(result_pos=0)
+            assert PRIMARY_FINDINGS not in clinical_analysis["interpretation"]
+            requests_before = server.request_count
+            case_dict = build_case_json(clinical_analysis, case_findings(
+                clinical_analysis, (PRIMARY_FINDINGS, SECONDARY_FINDINGS),
+                "study", oc
+            ))
+            # pyopencga logs in again after each call
+            fetches = (server.request_count - requests_before) // 2
+        finally:
+            server.shutdown()
+
+        full_case = make_case("CASE-F3-P1-S2")
+        assert case_dict["variant_list"] == extract_proband_variants(
+            full_case["interpretation"]["primaryFindings"]
+            + full_case["interpretation"]["secondaryFindings"]
+        )
+        assert len(case_dict["variant_list"]) == 5
+        assert fetches == 2
+
+    def test_streamed_findings_fetched_as_variants_read(self):
+        """
+        Test that with stream_findings the findings of a case are only
+        fetched from OpenCGA as its variant list is read
+        """
+        server, host = start_mock_opencga_api()
+        try:
+            oc = OpencgaClient(ClientConfiguration({"rest": {"host": host}}))
+            oc.login(user="test", password="test")
+            case_dict = pull_case(
+                "CASE-F3-P1-S2", "study", oc,
+                (PRIMARY_FINDINGS, SECONDARY_FINDINGS), stream_findings=True
+            )
+            requests_before = server.request_count
+            first = next(case_dict["variant_list"])
+            # pyopencga logs in again after each call
+            first_fetches = (server.request_count - requests_before) // 2
+            variants = [first, *case_dict["variant_list"]]
+            fetches = (server.request_count - requests_before) // 2
+        finally:
+            server.shutdown()
+
+        full_case = make_case("CASE-F3-P1-S2")
+        assert variants == extract_proband_variants(
+            full_case["interpretation"]["primaryFindings"]
+            + full_case["interpretation"]["secondaryFindings"]
+        )
+        assert (first_fetches, fetches) == (1, 2)
+
+    def test_read_case_ids(self, tmp_path):
+        """
+        Test that case IDs from the command line and a case file are combined
+        without duplicates or blank lines
+        """
+        case_file = tmp_path / "cases.txt"
+        case_file.write_text("CASE2\n\nCASE3\nCASE1\n")
+        assert read_case_ids(["CASE1", "CASE2"], str(case_file)) == [
+            "CASE1", "CASE2", "CASE3"
+        ]
+
+    def test_cases_searched_in_batches(self):
+        """
+        Test that many cases are fetched with one search per batch of case
+        IDs, in the order they were given
+        """
+        server, host = start_mock_opencga_api()
+        cases = [f"CASE-F1-P{i}" for i in range(25)]
+        try:
+            oc = OpencgaClient(ClientConfiguration({"rest": {"host": host}}))
+            oc.login(user="test", password="test")
+            requests_before = server.request_count
+            results = list(extract_cases_from_opencga(
+                cases, "study", oc, batch_size=10
+            ))
+            # pyopencga logs in again after each call
+            searches = (server.request_count - requests_before) // 2
+        finally:
+            server.shutdown()
+
+        assert searches == 3
+        assert [case for case, _ in results] == cases
+        assert [result["id"] for _, result in results] == cases
+
+    def test_write_case_batch(self, tmp_path):
+        """
+        Test that each case found is written as a line of the batch output,
+        and cases that are not found are returned
+        """
+        server, host = start_mock_opencga_api(missing_cases=["CASE-MISSING"])
+        output_file = str(tmp_path / "cases.ndjson")
+        try:
+            oc = OpencgaClient(ClientConfiguration({"rest": {"host": host}}))
+            oc.login(user="test", password="test")
+            missing = write_case_batch(
+                ["CASE-F2-P1", "CASE-MISSING", "CASE-F1-P3"], "study", oc,
+                output_file
+            )
+        finally:
+            server.shutdown()
+
+        with open(output_file, encoding="utf-8") as f:
+            cases = [json.loads(line) for line in f]
+        assert missing == ["CASE-MISSING"]
+        assert [case["case_id"] for case in cases] == [
+            "CASE-F2-P1", "CASE-F1-P3"
+        ]
+        assert [len(case["variant_list"]) for case in cases] == [2, 1]
+        assert [len(case["phenotype_list"]) for case in cases] == [1, 3]
+
+
+class TestOpencgaToDecipher:
+    """
+    Tests for pulling a case from OpenCGA and pushing it to DECIPHER in one
+    process with opencga_to_decipher.py
+    """
+
+    def run_main(self, tmp_path, monkeypatch, *extra_args,
+                 cases=("--case", "CASE-F4-P3"), missing_cases=()):
+        opencga, host = start_mock_opencga_api(missing_cases=missing_cases)
+        decipher, api_url = start_mock_decipher_api()
+        monkeypatch.setattr(push_to_decipher, "API_URL", api_url)
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / "opencga.json").write_text(
+            json.dumps({"USER": "test", "PASSWORD": "test"})
+        )
+        (tmp_path / "decipher.json").write_text(
+            json.dumps({"CLIENT_KEY": "client", "USER_KEY": "user"})
+        )
+        monkeypatch.setattr("sys.argv", [
+            "opencga_to_decipher.py",
+            "--opencga_configuration", "opencga.json",
+            "--decipher_configuration", "decipher.json",
+            *cases, "--study", "study", "--submitter", "1",
+            "--host", host, *extra_args
+        ])
+        try:
+            opencga_to_decipher.main()
+        finally:
+            opencga.shutdown()
+            decipher.shutdown()
+            api_client.close_sessions()
+        return decipher
+
+    @pytest.mark.parametrize("option", [
+        "--fetch_workers", "--push_workers", "--queue_size"
+    ])
+    def test_pipeline_sizes_must_be_positive(self, tmp_path, monkeypatch,
+                                             option):
+        """
+        Test that zero workers or a zero queue size are rejected before any
+        case is pulled, rather than hanging or failing part way
+        """
+        with pytest.raises(SystemExit):
+            self.run_main(tmp_path, monkeypatch, option, "0")
+
+    def test_case_pushed_in_process(self, tmp_path, monkeypatch):
+        """
+        Test that a case is pulled and pushed without writing the case JSON
+        """
+        decipher = self.run_main(tmp_path, monkeypatch)
+
+        assert list(decipher.patients) == ["CASE-F4-P3-PROBAND"]
+        assert len(decipher.created["phenotypes"]) == 3
+        assert len(decipher.created["variants"]) == 5
+        assert (tmp_path / "decipher_url.txt").read_text().startswith(
+            "https://www.deciphergenomics.org/patient/"
+        )
+        assert not (tmp_path / "case_phenotype_and_variant_data.json").exists()
+
+    def test_case_json_written_for_debugging(self, tmp_path, monkeypatch):
+        """
+        Test that the case JSON is written if asked for
+        """
+        self.run_main(tmp_path, monkeypatch, "--case_json", "case.json")
+
+        case = json.loads((tmp_path / "case.json").read_text())
+        assert case["clinical_reference"] == "CASE-F4-P3-PROBAND"
+        assert len(case["variant_list"]) == 4
+
+    def test_case_pipeline_keeps_input_order(self):
+        """
+        Test that the pipeline reports cases in input order when they finish
+        out of order, and reports which stage a case failed at
+        """
+        def fetch(case_id):
+            if case_id == "missing":
+                raise RuntimeError("Case not found")
+            time.sleep(0.01 * (5 - int(case_id)))
+            return {"case": case_id}
+
+        def push(case_id, case):
+            if case_id == "3":
+                raise RuntimeError("Push failed")
+            return {"pushed": case["case"]}
+
+        report = run_case_pipeline(
+            ["1", "2", "3", "missing", "4"], fetch, push, 3, 2, 1
+        )
+
+        assert [result["case_id"] for result in report] == [
+            "1", "2", "3", "missing", "4"
+        ]
+        assert report[0] == {"case_id": "1", "pushed": "1",
+                             "status": "submitted"}
+        assert report[2]["stage"] == "push"
+        assert report[3] == {"case_id": "missing", "status": "failed",
+                             "stage": "fetch", "error": "Case not found"}
+
+    def test_batch_of_cases_pushed(self, tmp_path, monkeypatch):
+        """
+        Test that a batch of cases is pulled and pushed, with a report of
+        each case
+        """
+        decipher = self.run_main(
+            tmp_path, monkeypatch, "--fetch_workers", "2",
+            "--push_workers", "2",
+            cases=("--cases", "CASE-F2-P1", "CASE-F3-P2", "CASE-F1-P1")
+        )
+
+        assert sorted(decipher.patients) == [
+            "CASE-F1-P1-PROBAND", "CASE-F2-P1-PROBAND", "CASE-F3-P2-PROBAND"
+        ]
+        assert len(decipher.created["variants"]) == 6
+        report = json.loads((tmp_path / "decipher_report.json").read_text())
+        assert [result["case_id"] for result in report] == [
+            "CASE-F2-P1", "CASE-F3-P2", "CASE-F1-P1"
+        ]
+        assert all(result["status"] == "submitted" for result in report)
+        assert all(
+            result["decipher_url"].startswith(
+                "https://www.deciphergenomics.org/patient/"
+            ) for result in report
+        )
+
+    def test_batch_reports_missing_case(self, tmp_path, monkeypatch):
+        """
+        Test that a case missing from OpenCGA does not stop the rest of the
+        batch, and fails the run once the report is written
+        """
+        with pytest.raises(RuntimeError, match="CASE-F1-P2"):
+            self.run_main(
+                tmp_path, monkeypatch,
+                cases=("--cases", "CASE-F1-P1", "CASE-F1-P2"),
+                missing_cases=["CASE-F1-P2"]
+            )
+
+        report = json.loads((tmp_path / "decipher_report.json").read_text())
+        assert report[0]["status"] == "submitted"
+        assert report[1]["status"] == "failed"
+        assert report[1]["stage"] == "fetch"
+
 
 class TestCSV:
     """
@@ -399,6 +1015,61 @@ class TestCSV:
             }
         )
 
+    def test_extract_clinvar_information_from_df(self):
+        """
+        Test that the columnar builder gives the same output as extracting
+        each row of the df individually
+        """
+        df = pd.concat([self.test_data] * 3, ignore_index=True)
+        df.loc[1, "Organisation ID"] = 509428
+        df.loc[2, "Ref genome"] = "GRCh38.p13"
+        df.loc[2, "Comment on classification"] = float("nan")
+
+        expected = [
+            extract_clinvar_information(row) for _, row in df.iterrows()
+        ]
+
+        assert extract_clinvar_information_from_df(df) == expected
+
+    def test_extract_clinvar_information_from_df_invalid(self):
+        """
+        Check the columnar builder raises the same error as the per-row
+        function if a column contains an invalid value
+        """
+        df = pd.concat([self.test_data] * 2, ignore_index=True)
+        df.loc[1, "Germline classification"] = "Invalid"
+
+        with pytest.raises(RuntimeError):
+            extract_clinvar_information_from_df(df)
+
+    def test_stream_clinvar_information(self, tmp_path):
+        """
+        Test that reading the CSV in chunks yields the same payloads as
+        reading the whole CSV at once
+        """
+        df = pd.concat([self.test_data] * 5, ignore_index=True)
+        df["Local ID"] = [f"uid_{i}" for i in range(5)]
+        variant_csv = tmp_path / "variants.csv"
+        df.to_csv(variant_csv, index=False)
+
+        streamed = stream_clinvar_information(str(variant_csv), 2)
+
+        assert not isinstance(streamed, list)
+        assert list(streamed) == extract_clinvar_information_from_df(df)
+
+    def test_ndjson_round_trip(self, tmp_path):
+        """
+        Test that payloads written to a gzipped NDJSON file are read back
+        unchanged by push_to_clinvar.py
+        """
+        clinvar_dicts = extract_clinvar_information_from_df(
+            pd.concat([self.test_data] * 3, ignore_index=True)
+        )
+        output_file = tmp_path / "clinvar_data.ndjson.gz"
+
+        assert write_clinvar_ndjson(clinvar_dicts, str(output_file)) == 3
+        assert list(read_clinvar_ndjson(str(output_file))) == clinvar_dicts
+
     def test_assembly_38(self):
         """
         Check build 38 is selected if dias standard VEP build 38 reference
@@ -451,6 +1122,90 @@ class TestCSV:
             add_lab_specific_guidelines(12345, {})
 
 
+    def test_valid_csv_has_no_errors(self):
+        """
+        Test that the example variant CSV passes validation
+        """
+        assert validate_variant_df(self.test_data) == []
+
+    def test_every_error_in_csv_reported(self):
+        """
+        Test that validation reports every invalid value in the CSV with its
+        row and column, rather than stopping at the first
+        """
+        df = pd.concat([self.test_data] * 4, ignore_index=True)
+        df["Local ID"] = ["uid_0", "uid_1", "uid_0", "uid_3"]
+        df.loc[1, "Germline classification"] = "Pathogenicc"
+        df.loc[2, "Ref genome"] = "hg19"
+        df.loc[3, "Organisation ID"] = 12345
+        df.loc[3, "Start"] = -5
+        df.loc[3, "Alternate allele"] = None
+
+        errors = validate_variant_df(df)
+
+        assert [(error["row"], error["column"]) for error in errors] == [
+            (3, "Germline classification"),
+            (4, "Local ID"),
+            (4, "Ref genome"),
+            (5, "Alternate allele"),
+            (5, "Organisation ID"),
+            (5, "Start"),
+        ]
+        assert errors[0]["value"] == "Pathogenicc"
+        assert errors[3]["value"] is None
+
+    def test_missing_column_reported(self):
+        """
+        Test that a missing column is reported once, not for every row
+        """
+        errors = validate_variant_df(self.test_data.drop(columns="Start"))
+
+        assert errors == [{
+            "row": None, "column": "Start", "value": None,
+            "error": "Column is missing from the variant CSV"
+        }]
+
+    def test_duplicate_local_ids_found_across_chunks(self, tmp_path):
+        """
+        Test that a Local ID repeated in a later chunk of the CSV is reported
+        """
+        df = pd.concat([self.test_data] * 5, ignore_index=True)
+        df["Local ID"] = ["uid_0", "uid_1", "uid_2", "uid_3", "uid_0"]
+        variant_csv = tmp_path / "variants.csv"
+        df.to_csv(variant_csv, index=False)
+
+        errors = validate_variant_csv(str(variant_csv), chunksize=2)
+
+        assert [(error["row"], error["column"]) for error in errors] == [
+            (6, "Local ID")
+        ]
+
+    def test_invalid_csv_fails_before_output(self, tmp_path, monkeypatch):
+        """
+        Test that no variant is written out from an invalid CSV, and the
+        errors are written to the validation report
+        """
+        df = pd.concat([self.test_data] * 3, ignore_index=True)
+        df["Local ID"] = ["uid_0", "uid_1", "uid_2"]
+        df.loc[2, "Ref genome"] = "hg19"
+        variant_csv = tmp_path / "variants.csv"
+        df.to_csv(variant_csv, index=False)
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(
+            "sys.argv", ["pull_from_csv.py", "--variant_csv", str(variant_csv)]
+        )
+
+        with pytest.raises(RuntimeError, match="1 errors"):
+            pull_from_csv.main()
+
+        report = json.loads(
+            (tmp_path / "variants_validation_report.json").read_text()
+        )
+        assert report["valid"] is False
+        assert report["errors"][0]["row"] == 4
+        assert not list(tmp_path.glob("*_clinvar_data.json"))
+
+
 class TestClinvar:
     """
     Tests for push_to_clinvar.py script
@@ -492,8 +1247,883 @@ class TestClinvar:
         with pytest.raises(TypeError):
             make_headers(12345)
 
+    @staticmethod
+    def make_record(local_id, url="cuh"):
+        """
+        Make a minimal record in the format written by pull_from_csv.py
+        """
+        return {
+            "clinvarSubmission": [{"localID": local_id}],
+            "assertionCriteria": {"url": url},
+        }
+
+    def test_batch_clinvar_records(self):
+        """
+        Test that records are packed into submissions of at most batch_size
+        records, and that records for different labs are not mixed
+        """
+        records = [self.make_record(f"uid_{i}") for i in range(5)]
+        records.append(self.make_record("uid_nuh", url="nuh"))
+
+        batches = list(batch_clinvar_records(records, 2, 1000))
+
+        assert [
+            [r["localID"] for r in batch["clinvarSubmission"]]
+            for batch in batches
+        ] == [["uid_0", "uid_1"], ["uid_2", "uid_3"], ["uid_4"], ["uid_nuh"]]
+        assert batches[3]["assertionCriteria"] == {"url": "nuh"}
+
+    def test_batch_clinvar_records_max_bytes(self):
+        """
+        Test that a batch is closed once adding a record would take it over
+        the maximum size
+        """
+        records = [self.make_record(f"uid_{i}") for i in range(3)]
+        record_bytes = len(json.dumps({"localID": "uid_0"}))
+
+        batches = list(
+            batch_clinvar_records(records, 10, record_bytes * 2)
+        )
+
+        assert [len(b["clinvarSubmission"]) for b in batches] == [2, 1]
+
+
+    def test_find_clinvar_records(self, tmp_path):
+        """
+        Test that records are found from a directory of per-variant JSON
+        files, a glob pattern and an NDJSON file
+        """
+        records = [self.make_record(f"uid_{i}") for i in range(3)]
+        for record in records:
+            local_id = record["clinvarSubmission"][0]["localID"]
+            with open(tmp_path / f"csv-{local_id}_clinvar_data.json", "w") as f:
+                json.dump(record, f)
+        ndjson = tmp_path / "clinvar_data.ndjson"
+        with open(ndjson, "w") as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+
+        assert list(find_clinvar_records(str(tmp_path))) == records
+        assert list(
+            find_clinvar_records(str(tmp_path / "*_clinvar_data.json"))
+        ) == records
+        assert list(find_clinvar_records(str(ndjson))) == records
+
+    def test_find_clinvar_records_no_match(self, tmp_path):
+        """
+        Test that an error is raised if no ClinVar data is found
+        """
+        with pytest.raises(RuntimeError):
+            list(find_clinvar_records(str(tmp_path / "*.json")))
+
+
+    class SubmissionHandler(BaseHTTPRequestHandler):
+        """
+        Stand-in for the ClinVar submission endpoint, which answers later
+        requests faster so responses arrive out of order
+        """
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(
+                int(self.headers["Content-Length"])
+            ))
+            local_id = body["actions"][0]["data"]["content"][
+                "clinvarSubmission"][0]["localID"]
+            time.sleep(0.05 * (5 - int(local_id[-1])))
+            if local_id == "uid_3":
+                status, response = 400, {"errors": [{"message": "bad"}]}
+            else:
+                status, response = 201, {"id": f"SUB{local_id[-1]}"}
+            content = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    def test_submit_clinvar_records_concurrently(self, tmp_path, monkeypatch):
+        """
+        Test that concurrent submissions are written to submission_ids.txt in
+        input order, with failed submissions recorded as errors
+        """
+        monkeypatch.chdir(tmp_path)
+        server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), self.SubmissionHandler
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        records = [self.make_record(f"uid_{i}") for i in range(5)]
+
+        try:
+            result = submit_clinvar_records(
+                f"http://127.0.0.1:{server.server_port}/", {}, records, 3
+            )
+        finally:
+            server.shutdown()
+
+        assert result == (4, 1)
+        with open("submission_ids.txt") as f:
+            assert f.read().splitlines() == [
+                "Local_ID\tClinVar_Submission_ID",
+                "uid_0\tSUB0",
+                "uid_1\tSUB1",
+                "uid_2\tSUB2",
+                "uid_3\tSubmission_error_check_logs",
+                "uid_4\tSUB4",
+            ]
+
+
+    class RateLimitedHandler(BaseHTTPRequestHandler):
+        """
+        Stand-in for the ClinVar submission endpoint that rate limits the
+        first two requests
+        """
+        protocol_version = "HTTP/1.1"
+        requests_seen = 0
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            type(self).requests_seen += 1
+            if self.requests_seen <= 2:
+                status, response = 429, {"message": "Too many requests"}
+            else:
+                status, response = 201, {"id": "SUB1"}
+            content = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header("Retry-After", "7")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    def test_rate_limited_submission_retried(self, tmp_path, monkeypatch):
+        """
+        Test that a submission rate limited with a 429 is sent again after
+        the Retry-After wait rather than being recorded as failed
+        """
+        monkeypatch.chdir(tmp_path)
+        sleeps = []
+        monkeypatch.setattr(time, "sleep", sleeps.append)
+        server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), self.RateLimitedHandler
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        try:
+            result = submit_clinvar_records(
+                f"http://127.0.0.1:{server.server_port}/", {},
+                [self.make_record("uid_1")]
+            )
+        finally:
+            server.shutdown()
+
+        assert result == (1, 0)
+        assert self.RateLimitedHandler.requests_seen == 3
+        assert sleeps == [7, 7]
+
+    def test_max_in_flight_must_be_positive(self):
+        """
+        Test that --max_in_flight only accepts whole numbers above zero
+        """
+        assert positive_int("4") == 4
+        for value in ["0", "-2", "two"]:
+            with pytest.raises(argparse.ArgumentTypeError):
+                positive_int(value)
+
+    def test_resume_skips_submitted_records(self, tmp_path, monkeypatch):
+        """
+        Test that variants recorded as submitted in the checkpoint store are
+        not submitted again, and are still written to submission_ids.txt
+        """
+        monkeypatch.chdir(tmp_path)
+        store = checkpoint_store.open_store(str(tmp_path / "state.sqlite"))
+        checkpoint_store.mark_built(store, "uid_0")
+        checkpoint_store.mark_submitted(store, "uid_0", "SUB0")
+        checkpoint_store.mark_built(store, "uid_1")
+
+        records = [self.make_record(f"uid_{i}") for i in range(3)]
+        remaining = list(skip_submitted_records(records, store))
+        assert remaining == records[1:]
+
+        write_clinvar_response(remaining[0], {"id": "SUB1"}, store)
+        write_clinvar_response(remaining[1], {"errors": []}, store)
+        write_submission_ids_from_store(store)
+
+        with open("submission_ids.txt") as f:
+            assert f.read().splitlines() == [
+                "Local_ID\tClinVar_Submission_ID",
+                "uid_0\tSUB0",
+                "uid_1\tSUB1",
+                "uid_2\tSubmission_error_check_logs",
+            ]
+
+
+class TestClinvarAccession:
+    """
+    Tests for get_clinvar_accession.py script
+    """
+
+    response = {
+        "submissions": [
+            {"identifiers": {"localID": "uid_1", "clinvarAccession": "SCV1"}},
+            {"identifiers": {"localID": "uid_2", "clinvarAccession": "SCV2"}},
+        ]
+    }
+
+    def test_get_accession_id_for_local_id(self):
+        """
+        Test that the accession for the matching local ID is returned for a
+        batch submission
+        """
+        assert get_accession_id(self.response, "uid_2") == "SCV2"
+
+    def test_poll_submissions(self, monkeypatch):
+        """
+        Test that all pending submissions are checked each round with one
+        sleep per round, and that resolved submissions are not checked again
+        """
+        ready_in_round = {
+            "SUB1": 0, "SUB2": 2, "SUB3": float("inf"), "SUB5": 1
+        }
+        checks = []
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+
+        def fetch_status(submission_id, headers, api_url):
+            checks.append(submission_id)
+            if submission_id == "SUB5" and sleeps:
+                return {}, "error", None
+            if len(sleeps) < ready_in_round[submission_id]:
+                return {}, "submitted", None
+            return {"submissions": [{"identifiers": {
+                "localID": f"uid_{submission_id[3:]}",
+                "clinvarAccession": f"SCV-{submission_id}"
+            }}]}, "processed", None
+
+        monkeypatch.setattr(
+            get_clinvar_accession, "fetch_submission_status", fetch_status
+        )
+        monkeypatch.setattr(
+            get_clinvar_accession.time, "monotonic", lambda: sum(sleeps)
+        )
+        monkeypatch.setattr(get_clinvar_accession.time, "sleep", sleep)
+
+        accessions = poll_submissions(
+            [("uid_1", "SUB1"), ("uid_2", "SUB2"), ("uid_3", "SUB3"),
+             ("uid_4", "Submission_error_check_logs"), ("uid_5", "SUB5")],
+            {}, "url", {"initial_interval": 10, "jitter": 0}
+        )
+
+        assert accessions == {
+            "uid_1": "SCV-SUB1", "uid_2": "SCV-SUB2", "uid_3": None,
+            "uid_4": None, "uid_5": None
+        }
+        assert sleeps[:3] == [10, 20, 40]
+        assert sum(sleeps) == DEFAULT_POLL_POLICY["deadline"]
+        assert checks[:8] == [
+            "SUB1", "SUB2", "SUB3", "SUB5", "SUB2", "SUB3", "SUB5", "SUB2"
+        ]
+        assert set(checks[8:]) == {"SUB3"}
+
+    def test_poll_submissions_deadline(self, monkeypatch):
+        """
+        Test that polling stops once the deadline has passed
+        """
+        clock = [0]
+        monkeypatch.setattr(
+            get_clinvar_accession, "fetch_submission_status",
+            lambda *args: ({}, "submitted", None)
+        )
+        monkeypatch.setattr(
+            get_clinvar_accession.time, "monotonic", lambda: clock[0]
+        )
+        monkeypatch.setattr(
+            get_clinvar_accession.time, "sleep",
+            lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+        )
+
+        accessions = poll_submissions(
+            [("uid_1", "SUB1")], {}, "url",
+            {"initial_interval": 100, "max_interval": 400, "jitter": 0,
+             "deadline": 1000}
+        )
+
+        assert accessions == {"uid_1": None}
+        assert clock[0] == 1000
+
+    def test_poll_submissions_resume(self, tmp_path, monkeypatch):
+        """
+        Test that variants recorded as accessioned in the checkpoint store
+        are not polled again, and new accessions are saved to the store
+        """
+        store = checkpoint_store.open_store(str(tmp_path / "state.sqlite"))
+        checkpoint_store.mark_submitted(store, "uid_1", "SUB1")
+        checkpoint_store.mark_accessioned(store, "uid_1", "SCV1")
+        checks = []
+
+        def fetch_status(submission_id, headers, api_url):
+            checks.append(submission_id)
+            return {"submissions": [{"identifiers": {
+                "localID": "uid_2", "clinvarAccession": "SCV2"
+            }}]}, "processed", None
+
+        monkeypatch.setattr(
+            get_clinvar_accession, "fetch_submission_status", fetch_status
+        )
+
+        accessions = poll_submissions(
+            [("uid_1", "SUB1"), ("uid_2", "SUB2")], {}, "url", store=store
+        )
+
+        assert accessions == {"uid_1": "SCV1", "uid_2": "SCV2"}
+        assert checks == ["SUB2"]
+        assert checkpoint_store.get_accession_ids(store) == {
+            "uid_1": "SCV1", "uid_2": "SCV2"
+        }
+
+    class SummaryFileHandler(BaseHTTPRequestHandler):
+        """
+        Stand-in for a ClinVar summary file that supports ETags
+        """
+        protocol_version = "HTTP/1.1"
+        requests_seen = []
+        content = {"submissions": []}
+
+        def do_GET(self):
+            etag = self.headers.get("If-None-Match")
+            self.requests_seen.append(etag)
+            if etag == '"v1"':
+                self.send_response(304)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            content = json.dumps(self.content).encode()
+            self.send_response(200)
+            self.send_header("ETag", '"v1"')
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    def test_fetch_summary_file_cached(self):
+        """
+        Test that summary files are re-fetched conditionally and not fetched
+        at all once the submission has finished processing
+        """
+        server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), self.SummaryFileHandler
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/summary.json"
+        cache = {}
+
+        try:
+            contents = [
+                fetch_summary_file(url, {}, status, cache)
+                for status in ["processing", "processing", "processed",
+                               "processed"]
+            ]
+        finally:
+            server.shutdown()
+
+        assert contents == [{"submissions": []}] * 4
+        assert self.SummaryFileHandler.requests_seen == [
+            None, '"v1"', '"v1"'
+        ]
+
+    def test_batch_summary_in_processing_not_final(self):
+        """
+        Test that a batch summary file fetched while the submission is still
+        processing is fetched again, even though it has a
+        batchProcessingStatus
+        """
+        class Handler(self.SummaryFileHandler):
+            requests_seen = []
+            content = {"batchProcessingStatus": "In processing"}
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/summary.json"
+        cache = {}
+
+        try:
+            for _ in range(2):
+                fetch_summary_file(url, {}, "processing", cache)
+        finally:
+            server.shutdown()
+
+        assert cache[url]["terminal"] is False
+        assert Handler.requests_seen == [None, '"v1"']
+
+    def test_mock_clinvar_api_round_trip(self, tmp_path, monkeypatch):
+        """
+        Test that variants submitted to the local ClinVar API stand-in are
+        given accession IDs once processed
+        """
+        monkeypatch.chdir(tmp_path)
+        server, api_url = start_mock_clinvar_api(processing_delay=0.2)
+        records = [
+            {"clinvarSubmission": [{"localID": f"uid_{i}"}]} for i in range(3)
+        ]
+
+        try:
+            submit_clinvar_records(api_url, {}, records, 2)
+            df = pd.read_csv("submission_ids.txt", sep=r"\s+")
+            accessions = poll_submissions(
+                list(zip(df["Local_ID"], df["ClinVar_Submission_ID"])),
+                {}, api_url, {"initial_interval": 0.1, "deadline": 10}
+            )
+        finally:
+            server.shutdown()
+
+        assert all(
+            accession.startswith("SCV") for accession in accessions.values()
+        )
+        assert list(accessions) == ["uid_0", "uid_1", "uid_2"]
+
+    def test_next_poll_interval(self):
+        """
+        Test that the poll interval backs off up to the maximum, is capped
+        while submissions are processing and honours Retry-After
+        """
+        policy = {**DEFAULT_POLL_POLICY, "jitter": 0}
+
+        assert next_poll_interval(0, policy) == 30
+        assert next_poll_interval(2, policy) == 120
+        assert next_poll_interval(10, policy) == 600
+        assert next_poll_interval(10, policy, ["processing"]) == 60
+        assert next_poll_interval(
+            10, policy, ["processing", "submitted"]
+        ) == 600
+        assert next_poll_interval(0, policy, retry_after=90) == 90
+
+    def test_parse_retry_after(self):
+        """
+        Test Retry-After headers in seconds are parsed, and missing or
+        invalid headers are ignored
+        """
+        assert parse_retry_after("120") == 120
+        assert parse_retry_after(None) is None
+        assert parse_retry_after("soon") is None
+
+    def test_rate_limited_status_check_not_waited_on(self):
+        """
+        Test that a rate limited status check is returned straight away with
+        its Retry-After, rather than the session waiting and retrying, so the
+        poll schedule decides the wait
+        """
+        server, api_url = start_mock_clinvar_api(
+            rate_limit_rate=1, retry_after=600
+        )
+        api_client.close_sessions()
+        start = time.monotonic()
+        try:
+            result = fetch_submission_status("SUB1", {}, api_url)
+        finally:
+            server.shutdown()
+            api_client.close_sessions()
+
+        assert result == (None, None, 600)
+        assert server.request_count == 1
+        assert time.monotonic() - start < 5
+
+    def test_get_accession_id_single_record(self):
+        """
+        Test that the first accession is returned if no local ID is given
+        """
+        assert get_accession_id(self.response) == "SCV1"
+
+    def test_get_accession_id_missing_local_id(self):
+        """
+        Test that no accession is returned for a local ID with no record in
+        a batch summary, rather than another variant's accession
+        """
+        assert get_accession_id(self.response, "uid_missing") is None
+
+
+class TestHpoIndex:
+    """
+    Tests for the HPO index in hpo_index.py
+    """
+
+    ontology = os.path.join(
+        os.path.dirname(__file__), "test_data", "hp.obo"
+    )
+
+    @pytest.fixture
+    def hpo_index(self, tmp_path):
+        index_file = str(tmp_path / "hp.idx")
+        build_hpo_index(self.ontology, index_file)
+        hpo_index = HpoIndex(index_file)
+        yield hpo_index
+        hpo_index.close()
+
+    def test_normalise_terms(self, hpo_index):
+        """
+        Test that current terms are kept, alternative and obsolete IDs are
+        replaced and unknown terms are rejected
+        """
+        assert hpo_index.normalise("HP:0001250") == "HP:0001250"
+        assert hpo_index.normalise("HP:0001333") == "HP:0000707"
+        assert hpo_index.normalise("HP:0000005") == "HP:0001250"
+        assert hpo_index.normalise("HP:0000006") is None
+        assert hpo_index.normalise("HP:9999999") is None
+        assert hpo_index.normalise("not a term") is None
+
+    def test_index_loaded_lazily(self, hpo_index):
+        """
+        Test that the index file is only mapped when a term is looked up
+        """
+        assert hpo_index._mmap is None
+        hpo_index.normalise("HP:0001250")
+        assert hpo_index._mmap is not None
+
+    def test_ancestors(self, hpo_index):
+        """
+        Test that the ancestors of a term are found through its parents
+        """
+        assert hpo_index.ancestors("HP:0001250") == {
+            "HP:0000707", "HP:0000118", "HP:0000001"
+        }
+
+    def test_normalise_phenotypes(self, hpo_index):
+        """
+        Test that a phenotype list is normalised, deduplicated and, if asked,
+        pruned of terms implied by more specific terms
+        """
+        phenotypes = ["HP:0001333", "HP:0001250", "HP:0000005", "HP:1234567"]
+        assert normalise_phenotypes(phenotypes, hpo_index) == (
+            ["HP:0000707", "HP:0001250"], ["HP:1234567"]
+        )
+        assert normalise_phenotypes(phenotypes, hpo_index, True) == (
+            ["HP:0001250"], ["HP:1234567"]
+        )
+
+    def test_load_hpo_index_from_json(self, tmp_path):
+        """
+        Test that an index is built next to an OBO Graphs JSON ontology
+        """
+        ontology = tmp_path / "hp.json"
+        ontology.write_text(json.dumps({"graphs": [{
+            "nodes": [
+                {"id": "http://purl.obolibrary.org/obo/HP_0000118",
+                 "meta": {"basicPropertyValues": [{
+                     "pred": ALT_ID_PREDICATE, "val": "HP:0000002"
+                 }]}},
+                {"id": "http://purl.obolibrary.org/obo/HP_0000003",
+                 "meta": {"deprecated": True, "basicPropertyValues": [{
+                     "pred": REPLACED_BY_PREDICATE, "val": "HP:0000118"
+                 }]}}
+            ],
+            "edges": []
+        }]}))
+
+        hpo_index = load_hpo_index(str(ontology))
+        try:
+            assert hpo_index.index_file == f"{ontology}.idx"
+            assert hpo_index.normalise("HP:0000002") == "HP:0000118"
+            assert hpo_index.normalise("HP:0000003") == "HP:0000118"
+        finally:
+            hpo_index.close()
+
+
+class TestVariantRecord:
+    """
+    Tests for the variant records in variant_record.py
+    """
+
+    def test_variant_parsed_once(self):
+        """
+        Test that the variant ID and genotype are split into their parts
+        """
+        record = VariantRecord("12:21912765:G:GT,GTT,GTTT", "INDEL", "1|3")
+
+        assert record.chrom == "12"
+        assert record.pos == 21912765
+        assert record.ref == "G"
+        assert record.alts == ("GT", "GTT", "GTTT")
+        assert record.genotype == (1, 3)
+        assert record.alt_indices() == [1, 3]
+        assert parse_genotype("./1") == (None, 1)
+
+    def test_records_from_findings(self):
+        """
+        Test that records are made for a whole list of findings, reading
+        indels from the call and skipping findings of an unknown type
+        """
+        findings = make_case("CASE-F5-P1")["interpretation"]["primaryFindings"]
+
+        records = VariantRecord.from_findings(findings + [{"type": "CNV"}])
+
+        assert [record.to_dict() for record in records] == [
+            {"variant_id": "1:100000:C:T", "type": "SNV", "zygosity": "0/1"},
+            {"variant_id": "2:100100:G:GA", "type": "INDEL",
+             "zygosity": "1/1"},
+            {"variant_id": "3:100200:A:G", "type": "SNV", "zygosity": "0/1"},
+            {"variant_id": "4:100300:T:TA,TAA", "type": "INDEL",
+             "zygosity": "1/2"},
+            {"variant_id": "5:100400:CT:C", "type": "DELETION",
+             "zygosity": "0/1"},
+        ]
+
+    def test_records_and_dictionaries_formatted_the_same(self):
+        """
+        Test that the zygosity and DECIPHER payload of a record match those of
+        the case JSON dictionary it was written to
+        """
+        for variant in TestDecipher.case["variant_list"]:
+            record = as_variant_record(variant)
+            zygosity = calculate_zygosity(variant, "46_xx")
+
+            assert calculate_zygosity(record, "46_xx") == zygosity
+            assert format_variant_json_for_decipher(
+                record, 123, zygosity, "sequence_variant"
+            ) == format_variant_json_for_decipher(
+                variant, 123, zygosity, "sequence_variant"
+            )
+
+    def test_no_call_not_submitted(self):
+        """
+        Test that a variant with no alt allele called is not submitted
+        """
+        record = VariantRecord("1:14907:A:G", "SNV", "./.")
+
+        assert format_variant_json_for_decipher(
+            record, 123, "homozygous", "sequence_variant"
+        ) is None
+
+    def test_records_written_to_case_json(self, tmp_path):
+        """
+        Test that records are written to the case JSON as dictionaries
+        """
+        case = build_case_json(make_case("CASE-F2-P1"))
+        write_case_json(case, tmp_path / "case.json")
+
+        written = json.loads((tmp_path / "case.json").read_text())
+        assert written["variant_list"] == [
+            variant.to_dict() for variant in case["variant_list"]
+        ]
+        with pytest.raises(TypeError):
+            json.dumps({"value": object()}, default=variant_record_json)
+
+
+class TestReferenceFasta:
+    """
+    Tests for checking reference alleles against a reference FASTA with
+    reference_fasta.py
+    """
+
+    reference_file = os.path.join(
+        os.path.dirname(__file__), "test_data/reference.fa"
+    )
+
+    @staticmethod
+    def write_bgzf(path, data, block_size):
+        """
+        Write data as bgzip blocks of block_size bytes, with a .gzi index
+        """
+        def block(chunk):
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+            deflated = compressor.compress(chunk) + compressor.flush()
+            return (
+                b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff"
+                + struct.pack("<H2sHH", 6, b"BC", 2, len(deflated) + 25)
+                + deflated + struct.pack("<II", zlib.crc32(chunk), len(chunk))
+            )
+
+        compressed = bytearray()
+        offsets = []
+        for start in range(0, len(data), block_size):
+            if start:
+                offsets.append((len(compressed), start))
+            compressed += block(data[start:start + block_size])
+        compressed += block(b"")
+        with open(path, "wb") as f:
+            f.write(compressed)
+        with open(f"{path}.gzi", "wb") as f:
+            f.write(struct.pack("<Q", len(offsets)))
+            for offset in offsets:
+                f.write(struct.pack("<QQ", *offset))
+
+    def bgzip_reference(self, tmp_path):
+        bgzf_file = tmp_path / "reference.fa.gz"
+        with open(self.reference_file, "rb") as f:
+            self.write_bgzf(bgzf_file, f.read(), 50)
+        with open(f"{self.reference_file}.fai", "rb") as f:
+            (tmp_path / "reference.fa.gz.fai").write_bytes(f.read())
+        return ReferenceFasta(str(bgzf_file))
+
+    def test_fetch_across_lines(self):
+        """
+        Test that bases are read across line ends, in upper case, and that
+        positions off the end of a chromosome are not found
+        """
+        reference = ReferenceFasta(self.reference_file)
+        try:
+            assert reference.fetch("1", 1, 3) == "GCT"
+            assert reference.fetch("1", 39, 4) == "CTTG"
+            assert reference.fetch("chr7", 2, 3) == "TGA"
+            assert reference.fetch("1", 129, 3) is None
+            assert reference.fetch("2", 1, 1) is None
+        finally:
+            reference.close()
+
+    def test_bgzip_matches_plain(self, tmp_path):
+        """
+        Test that a bgzip compressed FASTA gives the same bases as the plain
+        FASTA, including across compressed blocks
+        """
+        plain = ReferenceFasta(self.reference_file)
+        compressed = self.bgzip_reference(tmp_path)
+        try:
+            for chrom, length in [("1", 130), ("7", 95)]:
+                for position in range(1, length - 8):
+                    assert compressed.fetch(chrom, position, 9) == \
+                        plain.fetch(chrom, position, 9)
+        finally:
+            plain.close()
+            compressed.close()
+
+    def test_find_ref_mismatches(self):
+        """
+        Test that only variants whose ref does not match the genome are
+        returned, in the order given, and dashes are not checked
+        """
+        reference = ReferenceFasta(self.reference_file)
+        try:
+            mismatches = find_ref_mismatches(reference, [
+                ("a", "7", 2, "TG"), ("b", "1", 1, "A"), ("c", "1", 5, "-"),
+                ("d", "1", 200, "A"), ("e", "1", 41, "t")
+            ])
+        finally:
+            reference.close()
+
+        assert mismatches == [("b", "G"), ("d", None)]
+
+    def test_reference_fasta_options(self):
+        """
+        Test that reference FASTAs are read as ASSEMBLY=PATH
+        """
+        assert parse_reference_fastas(["GRCh37=a.fa", "GRCh38=b.fa.gz"]) == {
+            "GRCh37": "a.fa", "GRCh38": "b.fa.gz"
+        }
+        with pytest.raises(ValueError):
+            parse_reference_fastas(["b.fa.gz"])
+
+    def test_csv_reference_alleles_checked(self):
+        """
+        Test that reference alleles in the variant CSV that don't match the
+        genome of their build are reported, and other builds are not checked
+        """
+        df = pd.concat([TestCSV.test_data] * 3, ignore_index=True)
+        df["Local ID"] = ["uid_0", "uid_1", "uid_2"]
+        df["Start"] = [1, 2, 3]
+        df["Reference allele"] = ["C", "G", "T"]
+        df.loc[2, "Ref genome"] = "GRCh38.p13"
+
+        reference = ReferenceFasta(self.reference_file)
+        try:
+            errors = validate_variant_df(df, references={"GRCh37": reference})
+        finally:
+            reference.close()
+
+        assert errors == [{
+            "row": 3, "column": "Reference allele", "value": "G",
+            "error": "Reference allele does not match GRCh37 at 7:2, which "
+            "is T"
+        }]
+
+    def test_decipher_variants_checked(self, monkeypatch):
+        """
+        Test that a variant whose REF does not match GRCh38 is not submitted
+        to DECIPHER and is reported as skipped
+        """
+        server, api_url = start_mock_decipher_api()
+        monkeypatch.setattr(push_to_decipher, "API_URL", api_url)
+        reference = ReferenceFasta(self.reference_file)
+        case = {"sex": "46_xx", "variant_list": [
+            {"variant_id": "1:1:G:A", "type": "SNV", "zygosity": "0/1"},
+            {"variant_id": "1:2:G:A", "type": "SNV", "zygosity": "0/1"},
+        ]}
+        try:
+            skipped = submit_variants_to_decipher(
+                case, {}, 1, reference=reference
+            )
+        finally:
+            server.shutdown()
+            reference.close()
+            api_client.close_sessions()
+
+        assert [variant["attributes"]["start"]
+                for variant in server.created["variants"]] == ["1"]
+        assert skipped == [{
+            "resource": "variants", "id": "1:2:G:A",
+            "detail": ["Reference allele G does not match GRCh38, which is C"],
+            "attributes": None
+        }]
+
+
+class TestApiClient:
+    """
+    Tests for the shared sessions in api_client.py
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def log_message(self, *args):
+            pass
+
+    def test_one_session_per_host(self):
+        """
+        Test that the same session is returned for urls on the same host and
+        a different one for another host
+        """
+        api_client.close_sessions()
+        session = api_client.get_session("https://example.org/api/patients")
+
+        assert api_client.get_session("https://example.org/api/") is session
+        assert api_client.get_session("https://example.com/") is not session
+        api_client.close_sessions()
+
+    def test_connections_reused(self):
+        """
+        Test that repeated requests to a host reuse one open connection
+        """
+        server = ThreadingHTTPServer(("127.0.0.1", 0), self.Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/"
+        api_client.close_sessions()
+
+        try:
+            for _ in range(3):
+                api_client.get_session(url).get(url)
+            stats = api_client.connection_stats()
+        finally:
+            server.shutdown()
+            api_client.close_sessions()
+
+        assert stats[f"127.0.0.1:{server.server_port}"] == {
+            "requests": 3, "connections": 1, "reused": 2
+        }
+
+
 if __name__ == "__main__":
     opencga = TestOpenCGA()
     decipher = TestDecipher()
     csv = TestCSV()
     clinvar = TestClinvar()
+    clinvar_accession = TestClinvarAccession()
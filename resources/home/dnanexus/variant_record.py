@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Compact record of an interpreted variant, parsed once from an OpenCGA
+finding or from a variant in the case JSON, so the DECIPHER zygosity and
+payload builders read its chromosome, position, alleles and genotype
+without splitting the variant ID and genotype strings again.
+
+A variant ID has the VCF nomenclature chrom:pos:ref:alt, with several alt
+alleles separated by commas, e.g. 12:21912765:G:GA,GAA. The genotype, e.g.
+1/2 or 0|1, is kept as a tuple of allele indices, with None for a missing
+allele. Records can be read like the variant dictionaries of the case JSON,
+e.g. record["variant_id"], and written to it with to_dict().
+"""
+from collections.abc import Iterator
+
+# Variant types that can be read from an OpenCGA finding. For indels the ID
+# of the finding is normalised, with a dash for the missing allele, so the
+# VCF nomenclature is read from the call instead
+SNV_TYPES = ("SNV",)
+INDEL_TYPES = ("INDEL", "DELETION", "INSERTION")
+
+
+def parse_genotype(genotype):
+    '''
+    Split a genotype into its allele indices
+        inputs:
+            genotype (str): the genotype, e.g. 0/1, 1|2 or ./.
+        outputs:
+            indices (tuple): the allele index of each allele in the genotype,
+            or None for a missing allele
+    '''
+    return tuple(
+        int(allele) if allele.isdigit() else None
+        for allele in genotype.replace("|", "/").split("/")
+    )
+
+
+class VariantRecord:
+    """
+    An interpreted variant, with its variant ID split into its chromosome,
+    position, reference and alternate alleles and its genotype split into
+    allele indices
+    """
+
+    __slots__ = (
+        "variant_id", "type", "zygosity", "chrom", "pos", "ref", "alts",
+        "genotype"
+    )
+
+    def __init__(self, variant_id, variant_type, zygosity):
+        chrom, pos, ref, alts = variant_id.split(":")
+        self.variant_id = variant_id
+        self.type = variant_type
+        self.zygosity = zygosity
+        self.chrom = chrom
+        self.pos = int(pos)
+        self.ref = ref
+        self.alts = tuple(alts.split(","))
+        self.genotype = parse_genotype(zygosity)
+
+    @classmethod
+    def from_dict(cls, variant):
+        '''
+        Make a record from a variant in the case JSON
+            inputs:
+                variant (dict): the variant_id, type and zygosity of the
+                variant
+            outputs:
+                record (VariantRecord): the variant record
+        '''
+        return cls(variant["variant_id"], variant["type"], variant["zygosity"])
+
+    @classmethod
+    def from_finding(cls, finding):
+        '''
+        Make a record from an OpenCGA finding
+            inputs:
+                finding (dict): a finding from a case interpretation
+            outputs:
+                record (VariantRecord): the variant record, or None if the
+                finding is not a type of variant that can be read
+        '''
+        variant_type = finding["type"]
+        if variant_type not in INDEL_TYPES + SNV_TYPES:
+            print("Could not determine variant type")
+            return None
+        study = finding["studies"][0]
+        if variant_type in INDEL_TYPES:
+            variant_id = study["files"][0]["call"]["variantId"]
+        else:
+            variant_id = finding["id"]
+        return cls(variant_id, variant_type, study["samples"][0]["data"][0])
+
+    @classmethod
+    def from_findings(cls, findings):
+        '''
+        Make records for a whole list of OpenCGA findings, e.g. the primary
+        findings of an interpretation
+            inputs:
+                findings (iterable): findings from a case interpretation
+            outputs:
+                records (list): a VariantRecord for each finding that is a
+                type of variant that can be read
+        '''
+        records = []
+        for finding in findings:
+            record = cls.from_finding(finding)
+            if record is not None:
+                records.append(record)
+        return records
+
+    def alt_indices(self):
+        '''
+        Get the alternate alleles called in the genotype
+            outputs:
+                indices (list): the distinct non-reference allele indices in
+                the genotype, in order
+        '''
+        return sorted({index for index in self.genotype if index})
+
+    def to_dict(self):
+        '''
+        Get the variant as it is written to the case JSON
+            outputs:
+                variant (dict): the variant_id, type and zygosity
+        '''
+        return {
+            "variant_id": self.variant_id,
+            "type": self.type,
+            "zygosity": self.zygosity
+        }
+
+    def __getitem__(self, key):
+        if key not in ("variant_id", "type", "zygosity"):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        if not isinstance(other, VariantRecord):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"VariantRecord({self.variant_id!r}, {self.type!r}, " \
+            f"{self.zygosity!r})"
+
+
+def as_variant_record(variant):
+    '''
+    Get a variant as a record, parsing it if it is a case JSON dictionary
+        inputs:
+            variant (VariantRecord or dict): the variant
+        outputs:
+            record (VariantRecord): the variant record
+    '''
+    if isinstance(variant, VariantRecord):
+        return variant
+    return VariantRecord.from_dict(variant)
+
+
+def variant_record_json(value):
+    '''
+    Convert variant records, and variant lists streamed as generators, for
+    json.dump(), for use as its default argument
+        inputs:
+            value: a value json cannot serialise itself
+        outputs:
+            variant (dict or list): the variant as it is written to the case
+            JSON, or the list of variants read from the generator
+    '''
+    if isinstance(value, VariantRecord):
+        return value.to_dict()
+    if isinstance(value, Iterator):
+        return list(value)
+    raise TypeError(
+        f"Object of type {type(value).__name__} is not JSON serializable"
+    )
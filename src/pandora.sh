@@ -4,44 +4,157 @@ set -exo pipefail #if any part goes wrong, job will fail
 pip install pytest
 dx-download-all-inputs
 
+# Gather a reference FASTA input and its indexes into one directory and print
+# the path of the FASTA, or nothing if the input was not given. The input must
+# hold exactly one FASTA (.fa, .fasta or .fna, optionally gzipped)
+reference_fasta() {
+    if [ -d "/home/dnanexus/in/$1" ]
+    then
+        mkdir -p "/home/dnanexus/$1"
+        find "/home/dnanexus/in/$1" -type f -exec mv -t "/home/dnanexus/$1" {} +
+        mapfile -t FASTAS < <(find "/home/dnanexus/$1" -type f \( \
+            -name '*.fa' -o -name '*.fasta' -o -name '*.fna' -o \
+            -name '*.fa.gz' -o -name '*.fasta.gz' -o -name '*.fna.gz' \))
+        if [ ${#FASTAS[@]} -eq 0 ]
+        then
+            echo "No reference FASTA (.fa, .fasta or .fna, optionally gzipped) found in the $1 input" >&2
+            exit 1
+        elif [ ${#FASTAS[@]} -gt 1 ]
+        then
+            echo "More than one reference FASTA found in the $1 input: ${FASTAS[*]}" >&2
+            exit 1
+        fi
+        echo "${FASTAS[0]}"
+    fi
+}
+
 # Run python scripts based on running_mode
 if [ "$running_mode" = "decipher" ]
 then
     pip install pyopencga
-    python3 /home/dnanexus/pull_from_opencga.py \
-        --configuration /home/dnanexus/in/opencga_config/*.json \
-        --case $opencga_case_id \
-        --study $opencga_study_name
 
-    python3 /home/dnanexus/push_to_decipher.py \
-        --configuration /home/dnanexus/in/decipher_api_keys/*.json \
-        --data_for_decipher case_phenotype_and_variant_data.json \
+    # Start from the patient cache of previous runs, if one was given
+    mkdir -p /home/dnanexus/out/decipher_patient_cache /home/dnanexus/out/decipher_skipped_items
+    PATIENT_CACHE=/home/dnanexus/out/decipher_patient_cache/decipher_patient_cache.json
+    if [ -n "$decipher_patient_cache_path" ]
+    then
+        cp "$decipher_patient_cache_path" $PATIENT_CACHE
+    fi
+
+    DECIPHER_ARGS=(
+        --opencga_configuration /home/dnanexus/in/opencga_config/*.json
+        --decipher_configuration /home/dnanexus/in/decipher_api_keys/*.json
+        --study $opencga_study_name
         --submitter $decipher_submitter_id
+        --patient_cache $PATIENT_CACHE
+        --skipped_items /home/dnanexus/out/decipher_skipped_items/decipher_skipped_items.json
+    )
+    if [ -n "$hpo_ontology_path" ]
+    then
+        DECIPHER_ARGS+=(--hpo_ontology "$hpo_ontology_path")
+    fi
+    if [ "$prune_hpo_ancestors" = "true" ]
+    then
+        DECIPHER_ARGS+=(--prune_hpo_ancestors)
+    fi
+    if [ "$include_secondary_findings" = "true" ]
+    then
+        DECIPHER_ARGS+=(--include_secondary_findings)
+    fi
+    GRCH38_FASTA=$(reference_fasta reference_genome_grch38)
+    if [ -n "$GRCH38_FASTA" ]
+    then
+        DECIPHER_ARGS+=(--reference_fasta "$GRCH38_FASTA")
+    fi
 
-    DECIPHER_URL=$(cat decipher_url.txt)
+    BATCH_STATUS=0
+    if [ -n "$opencga_case_ids_path" ]
+    then
+        # Pull a batch of cases from OpenCGA while earlier cases are being
+        # submitted to DECIPHER, reporting the result of each case. If any
+        # case fails, the report, skipped items and patient cache are still
+        # uploaded before the job fails
+        mkdir -p /home/dnanexus/out/decipher_report
+        python3 /home/dnanexus/opencga_to_decipher.py "${DECIPHER_ARGS[@]}" \
+            --case_file "$opencga_case_ids_path" \
+            --report /home/dnanexus/out/decipher_report/decipher_report.json \
+            || BATCH_STATUS=$?
+    else
+        # Pull the case from OpenCGA and submit it to DECIPHER in one process
+        python3 /home/dnanexus/opencga_to_decipher.py "${DECIPHER_ARGS[@]}" \
+            --case $opencga_case_id
 
-    dx-jobutil-add-output link_to_patient_in_decipher "$DECIPHER_URL" --class=string
+        DECIPHER_URL=$(cat decipher_url.txt)
+
+        dx-jobutil-add-output link_to_patient_in_decipher "$DECIPHER_URL" --class=string
+    fi
+    dx-upload-all-outputs
+    exit $BATCH_STATUS
 elif [ "$running_mode" = "clinvar" ]
 then
     pip install pandas
-    python3 /home/dnanexus/pull_from_csv.py \
-        --variant_csv /home/dnanexus/in/variant_csv/*.csv
 
-    for json in $(ls /home/dnanexus/*_clinvar_data.json)
+    # Check reference alleles against the reference genome of each build
+    # given
+    REFERENCE_ARGS=()
+    for BUILD in 37 38
     do
-        python3 /home/dnanexus/push_to_clinvar.py \
-        --clinvar_api_key /home/dnanexus/in/clinvar_api_key/*.txt \
-        --clinvar_json $json \
-        --clinvar_testing $clinvar_testing
+        FASTA=$(reference_fasta reference_genome_grch$BUILD)
+        if [ -n "$FASTA" ]
+        then
+            REFERENCE_ARGS+=("GRCh$BUILD=$FASTA")
+        fi
     done
+    if [ ${#REFERENCE_ARGS[@]} -gt 0 ]
+    then
+        REFERENCE_ARGS=(--reference_fasta "${REFERENCE_ARGS[@]}")
+    fi
+
+    # Start from the checkpoint store of a previous run, if one was given,
+    # so variants it already submitted are not submitted again
+    mkdir -p /home/dnanexus/out/clinvar_state_db
+    STATE_DB=/home/dnanexus/out/clinvar_state_db/clinvar_state.sqlite
+    if [ -n "$clinvar_state_db_path" ]
+    then
+        cp "$clinvar_state_db_path" $STATE_DB
+    fi
+
+    # If a step fails, upload the checkpoint store to the project before the
+    # job fails, as outputs of a failed job are not kept, so a rerun can be
+    # given it as the clinvar_state_db input. Any log left by a crashed script
+    # is first written back into the database file
+    upload_state_db() {
+        if [ -f $STATE_DB ]
+        then
+            python3 -c "import sqlite3, sys; sqlite3.connect(sys.argv[1]).execute('PRAGMA wal_checkpoint(TRUNCATE)')" $STATE_DB
+            dx upload $STATE_DB --project "$DX_PROJECT_CONTEXT_ID" \
+                --path "/clinvar_state_db_${DX_JOB_ID}.sqlite" --brief
+        fi
+    }
+    trap upload_state_db ERR
+
+    python3 /home/dnanexus/pull_from_csv.py \
+        --variant_csv /home/dnanexus/in/variant_csv/*.csv \
+        --output_format ndjson \
+        --output_file /home/dnanexus/clinvar_data.ndjson.gz \
+        "${REFERENCE_ARGS[@]}"
+
+    python3 /home/dnanexus/push_to_clinvar.py \
+        --clinvar_api_key /home/dnanexus/in/clinvar_api_key/*.txt \
+        --clinvar_input /home/dnanexus/clinvar_data.ndjson.gz \
+        --clinvar_testing $clinvar_testing \
+        --batch_size ${clinvar_batch_size:-1} \
+        --max_in_flight ${clinvar_max_in_flight:-1} \
+        --state_db $STATE_DB
     mkdir -p /home/dnanexus/out/clinvar_submission_id
     mv submission_ids.txt /home/dnanexus/out/clinvar_submission_id
 
     python3 /home/dnanexus/get_clinvar_accession.py \
     --submission_file /home/dnanexus/out/clinvar_submission_id/submission_ids.txt \
     --clinvar_api_key /home/dnanexus/in/clinvar_api_key/*.txt \
-    --clinvar_testing $clinvar_testing
-    mkdir /home/dnanexus/out/clinvar_accession_id
+    --clinvar_testing $clinvar_testing \
+    --state_db $STATE_DB
+    mkdir -p /home/dnanexus/out/clinvar_accession_id
     mv accession_ids.txt /home/dnanexus/out/clinvar_accession_id
     dx-upload-all-outputs
 elif [ "$running_mode" = "get_clinvar_accession" ]